@@ -18,43 +18,91 @@ __name__ = "k3fs"
 from .fs import (
     FSUtilError,
     NotMountPoint,
+    AtomicFile,
+    ChecksumCache,
+    DirUsageCache,
+    IOLimiter,
 
     assert_mountpoint,
     calc_checksums,
+    calc_checksums_tree,
+    calc_fingerprint,
+    copy_file,
+    dir_usage,
+    find_duplicates,
     get_all_mountpoint,
     get_device,
     get_device_fs,
     get_disk_partitions,
     get_mountpoint,
+    get_mountpoints,
     get_path_fs,
     get_path_inode_usage,
+    get_path_partitions,
     get_path_usage,
+    get_remove_stats,
+    refresh_mount_table,
+    register_hasher,
+    set_makedirs_cache,
+    set_mount_table_cache,
+    sync_tree,
 
     fread,
+    fread_many,
+    fread_mmap,
     fwrite,
+    fwrite_many,
+    fwrite_stream,
+    iter_dirs,
+    iter_files,
     ls_dirs,
     ls_files,
     makedirs,
+    makedirs_many,
     remove,
 )
 __all__ = [
     "FSUtilError",
     "NotMountPoint",
+    "AtomicFile",
+    "ChecksumCache",
+    "DirUsageCache",
+    "IOLimiter",
     "assert_mountpoint",
     "calc_checksums",
+    "calc_checksums_tree",
+    "calc_fingerprint",
+    "copy_file",
+    "dir_usage",
+    "find_duplicates",
     "get_all_mountpoint",
     "get_device",
     "get_device_fs",
     "get_disk_partitions",
     "get_mountpoint",
+    "get_mountpoints",
     "get_path_fs",
     "get_path_inode_usage",
+    "get_path_partitions",
     "get_path_usage",
+    "get_remove_stats",
+    "refresh_mount_table",
+    "register_hasher",
+    "set_makedirs_cache",
+    "set_mount_table_cache",
+    "sync_tree",
 
+    "iter_dirs",
+    "iter_files",
     "ls_dirs",
     "ls_files",
     "makedirs",
+    "makedirs_many",
     "fread",
+    "fread_many",
+    "fread_mmap",
     "fwrite",
+    "fwrite_many",
+    "fwrite_stream",
     "remove",
 ]
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Asyncio equivalents of the blocking k3fs functions.
+
+Every call runs in a thread pool of the device the path resides on, as
+returned by `k3fs.get_device`, so that a slow disk does not occupy the
+threads of the others, and the event loop is never blocked::
+
+    data = await k3fs.aio.fread('/tmp/foo', mode='b')
+
+Long operations, `calc_checksums` and `remove`, report progress to the event
+loop after every block or dir, and stop at the next block or dir when the
+awaiting task is cancelled.
+Other calls can not be stopped once started, and run to the end in
+background if cancelled.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import threading
+
+from . import fs
+
+# Max number of threads per device.
+PER_DEVICE = 4
+
+
+class _Executors(object):
+    """
+    A bounded thread pool per device, created on first use.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executors = {}
+        self.per_device = PER_DEVICE
+
+    def get(self, device):
+
+        with self.lock:
+            # Threads do not survive fork.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.executors = {}
+
+            ex = self.executors.get(device)
+            if ex is None:
+                ex = concurrent.futures.ThreadPoolExecutor(self.per_device)
+                self.executors[device] = ex
+
+            return ex
+
+    def resize(self, per_device):
+        with self.lock:
+            self.per_device = per_device
+            executors, self.executors = self.executors, {}
+
+        for ex in executors.values():
+            ex.shutdown(wait=False)
+
+
+_executors = _Executors()
+
+
+def set_device_concurrency(n):
+    """
+    Set the max number of threads working on one device.
+    Running calls finish in the old pools.
+
+    :param n: is the number of threads per device. By default it is 4.
+    :return: Nothing
+    """
+
+    if n <= 0:
+        raise fs.FSUtilError('n must be positive')
+
+    _executors.resize(n)
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Job(object):
+    """
+    Carries progress from a worker thread to the event loop, and cancellation
+    from the event loop to the worker thread.
+    """
+
+    def __init__(self, loop, progress):
+        self.loop = loop
+        self.progress = progress
+        self.cancelled = threading.Event()
+        self.done = 0
+
+    def report(self, n):
+
+        # Called in worker thread.
+        if self.cancelled.is_set():
+            raise _Cancelled()
+
+        self.done += n
+        if self.progress is not None:
+            self.loop.call_soon_threadsafe(self.progress, self.done)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def _get_device(path):
+    try:
+        return fs.get_device(path)
+    except KeyError:
+        return None
+
+
+async def _run(path, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+
+    # Looking up the device resolves the path and it may block, too.
+    device = await loop.run_in_executor(None, _get_device, path)
+
+    ex = _executors.get(device)
+    return await loop.run_in_executor(ex, functools.partial(func, *args, **kwargs))
+
+
+async def _run_job(path, progress, func, *args, **kwargs):
+
+    # `func` is called with `job.report` as the last positional argument.
+
+    job = _Job(asyncio.get_event_loop(), progress)
+    try:
+        return await _run(path, func, *(args + (job.report,)), **kwargs)
+    except asyncio.CancelledError:
+        job.cancel()
+        raise
+
+
+async def fread(*paths, mode=''):
+    """
+    Read the entire file, as `k3fs.fread` does.
+    """
+    return await _run(os.path.join(*paths), fs.fread, *paths, mode=mode)
+
+
+async def fwrite(*paths_content, **kwargs):
+    """
+    Write a file, as `k3fs.fwrite` does, with the same arguments.
+    """
+    return await _run(os.path.join(*paths_content[:-1]), fs.fwrite, *paths_content, **kwargs)
+
+
+async def makedirs(*paths, **kwargs):
+    """
+    Make a dir and its parents, as `k3fs.makedirs` does, with the same
+    arguments.
+    """
+    return await _run(os.path.join(*paths), fs.makedirs, *paths, **kwargs)
+
+
+async def ls_files(*paths, pattern='.*'):
+    """
+    List files, as `k3fs.ls_files` does.
+    """
+    return await _run(os.path.join(*paths), fs.ls_files, *paths, pattern=pattern)
+
+
+async def ls_dirs(*paths):
+    """
+    List sub dirs, as `k3fs.ls_dirs` does.
+    """
+    return await _run(os.path.join(*paths), fs.ls_dirs, *paths)
+
+
+async def calc_checksums(path, progress=None, **kwargs):
+    """
+    Calculate checksums of a file, as `k3fs.calc_checksums` does, with the same
+    arguments.
+
+    Args:
+
+        progress(callable):
+            is called in the event loop with the total number of bytes hashed
+            so far, after every block.
+
+    Returns:
+        dict: of checksum name to hex string, or to `None` if not enabled.
+    """
+
+    def _calc(report):
+        return fs.calc_checksums(path, progress=report, **kwargs)
+
+    return await _run_job(path, progress, _calc)
+
+
+async def remove(*paths, onerror=None, concurrency=1, io_limit=None, progress=None):
+    """
+    Recursively delete `path`, as `k3fs.remove(fast=True)` does.
+
+    Args:
+
+        onerror(str or callable):
+            handles errors as `k3fs.remove` does. A callable is called in a
+            worker thread.
+
+        concurrency(int):
+            is the number of threads removing the tree. By default it is 1,
+            the thread of the device, to keep the pool bounded.
+
+        io_limit(IOLimiter):
+            limits the number of files and dirs removed per second.
+
+        progress(callable):
+            is called in the event loop with the total number of files and dirs
+            removed so far.
+            It is not called on a platform without `dir_fd` support.
+    """
+
+    path = os.path.join(*paths)
+
+    def _remove(report):
+        fs.remove(path, onerror=onerror, fast=True, concurrency=concurrency,
+                  io_limit=io_limit, progress=report)
+
+    return await _run_job(path, progress, _remove)
@@ -2,19 +2,73 @@
 # coding: utf-8
 
 import binascii
+import collections
+import concurrent.futures
+import ctypes
 import hashlib
 import errno
+import functools
+import fcntl
+import locale
+import mmap
 import os
+import queue
 import re
+import select
+import sqlite3
+import struct
 import sys
+import threading
+import zlib
 import psutil
 
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 import time
 import k3confloader
 
 READ_BLOCK = 32 * 1024 * 1024
 WRITE_BLOCK = 32 * 1024 * 1024
 
+# Max number of buffers in one writev()
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# ioctl to share the extents of a file with another file, aka reflink.
+# Supported by btrfs, xfs and others. _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors those mean a way of in-kernel copy does not work for these files, thus
+# the next way should be tried.
+_COPY_FALLBACK_ERRNO = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                            errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF])
+
+# Name of the dir at the root of a mount point, where `remove(background=True)`
+# moves trees to.
+TRASH_DIR = '.k3fs_trash'
+
+_SUPPORT_DIR_FD = (os.unlink in os.supports_dir_fd
+                   and os.scandir in os.supports_fd
+                   and hasattr(os, 'O_DIRECTORY')
+                   and hasattr(os, 'O_NOFOLLOW'))
+
+# The kernel reports POLLPRI|POLLERR on this file whenever a mount or umount
+# happens in the mount namespace of the process.
+MOUNTINFO = '/proc/self/mountinfo'
+
 
 class FSUtilError(Exception):
     pass
@@ -24,6 +78,442 @@ class NotMountPoint(FSUtilError):
     pass
 
 
+class IOLimiter(object):
+    """
+    A thread safe token bucket that limits the IO rate of all the operations
+    it is passed to, such as `calc_checksums(io_limit=limiter)`.
+
+    Share one `IOLimiter` between threads and calls to put a cap on the total
+    bandwidth, e.g., keep one per device found with `get_device`.
+
+    Args:
+
+        rate(int):
+            is the max bytes per second on average.
+
+        burst(int):
+            is the max bytes that can be consumed at once after being idle.
+            By default it is `rate`, i.e., one second of IO.
+    """
+
+    def __init__(self, rate, burst=None):
+
+        if rate <= 0:
+            raise FSUtilError('rate must be positive')
+
+        if burst is None:
+            burst = rate
+
+        if burst <= 0:
+            raise FSUtilError('burst must be positive')
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def consume(self, n):
+        """
+        Take `n` bytes from the bucket. Block until they are paid back if
+        the bucket does not have enough.
+
+        Tokens are taken at once and the bucket goes into debt, thus concurrent
+        callers queue up in order and a single `n` may be greater than `burst`.
+
+        :param n: is the number of bytes to read or write.
+        :return: the seconds slept.
+        """
+
+        with self.lock:
+            # Wall clock adjustments do not refill or drain the bucket.
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            self.tokens -= n
+            time_sleep = -self.tokens / self.rate
+
+        if time_sleep > 0:
+            time.sleep(time_sleep)
+            return time_sleep
+
+        return 0
+
+
+# Max number of access times of `ChecksumCache` hits to save at a time.
+_CHECKSUM_CACHE_USED_BATCH = 1024
+
+
+class ChecksumCache(object):
+    """
+    An on-disk cache of file checksums in an SQLite database, for
+    `calc_checksums(cache=cache)` to skip hashing unchanged files.
+
+    A file is identified by `(st_dev, st_ino)` and its checksums are valid
+    while its size and `st_mtime_ns` do not change. An entry of a changed file
+    is replaced by the next calculation.
+
+    Keep one cache per mount point, e.g., at `<mountpoint>/.k3fs_checksums`:
+    `st_dev` is not stable across reboot on every system.
+    It is thread safe, and can be shared by processes through the database
+    file, but not passed to a process.
+
+    Args:
+
+        path(str):
+            is the path of the database file. It is created if absent.
+
+        max_entries(int):
+            is the max number of checksums to keep, one per file and algorithm.
+            The least recently used ones are evicted. The time of a hit is
+            saved later in a batch, by the next `put()` or `close()`, so that
+            a hit does not write.
+    """
+
+    def __init__(self, path, max_entries=1024 * 1024):
+
+        if max_entries <= 0:
+            raise FSUtilError('max_entries must be positive')
+
+        self.path = path
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.conn = None
+        self.n = 0
+
+        # (st_dev, st_ino) -> access time not yet saved. Saved in batch, so
+        # that a hit does not write to the database.
+        self.used = {}
+
+        self._stats = {
+            'hit': 0,
+            'miss': 0,
+            'evicted': 0,
+        }
+
+    def _connect(self):
+
+        # An sqlite connection must not be used after fork.
+        if self.pid == os.getpid():
+            return self.conn
+
+        self.pid = os.getpid()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                          ' dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,'
+                          ' algo TEXT, digest TEXT, used REAL,'
+                          ' PRIMARY KEY (dev, ino, algo))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS checksums_used ON checksums (used)')
+        self.n = self.conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+
+        return self.conn
+
+    def get(self, st, names):
+        """
+        Find cached checksums of a file.
+
+        :param st: is the `os.stat()` result of the file.
+        :param names: is a list of wanted checksum names.
+        :return: a dict of checksum name to hex string, of the cached ones in
+        `names`. It is a hit if all of `names` are cached.
+        """
+
+        with self.lock:
+            conn = self._connect()
+
+            rows = conn.execute('SELECT algo, digest, size, mtime_ns FROM checksums'
+                                ' WHERE dev=? AND ino=?', (st.st_dev, st.st_ino)).fetchall()
+
+            rst = {}
+            for algo, digest, size, mtime_ns in rows:
+                if size == st.st_size and mtime_ns == st.st_mtime_ns and algo in names:
+                    rst[algo] = digest
+
+            if len(rst) > 0:
+                self.used[(st.st_dev, st.st_ino)] = time.time()
+                if len(self.used) >= _CHECKSUM_CACHE_USED_BATCH:
+                    self._commit_used(conn)
+
+            if len(rst) == len(set(names)):
+                self._stats['hit'] += 1
+            else:
+                self._stats['miss'] += 1
+
+            return rst
+
+    def put(self, st, checksums):
+        """
+        Save checksums of a file, and drop the entries of an older version of
+        it.
+
+        :param st: is the `os.stat()` result of the file before hashing.
+        :param checksums: is a dict of checksum name to hex string.
+        :return: Nothing
+        """
+
+        with self.lock:
+            conn = self._connect()
+            now = time.time()
+
+            conn.execute('BEGIN')
+            try:
+                cur = conn.execute('DELETE FROM checksums WHERE dev=? AND ino=?'
+                                   ' AND (size!=? OR mtime_ns!=?)',
+                                   (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+                self.n -= cur.rowcount
+
+                for algo, digest in checksums.items():
+                    cur = conn.execute('UPDATE checksums SET size=?, mtime_ns=?, digest=?, used=?'
+                                       ' WHERE dev=? AND ino=? AND algo=?',
+                                       (st.st_size, st.st_mtime_ns, digest, now,
+                                        st.st_dev, st.st_ino, algo))
+                    if cur.rowcount > 0:
+                        continue
+
+                    conn.execute('INSERT INTO checksums VALUES (?,?,?,?,?,?,?)',
+                                 (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                                  algo, digest, now))
+                    self.n += 1
+
+                self._save_used(conn)
+
+                if self.n > self.max_entries:
+                    self._evict(conn)
+
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _commit_used(self, conn):
+
+        conn.execute('BEGIN')
+        try:
+            self._save_used(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _save_used(self, conn):
+
+        if len(self.used) == 0:
+            return
+
+        used, self.used = self.used, {}
+        conn.executemany('UPDATE checksums SET used=? WHERE dev=? AND ino=?',
+                         [(t, dev, ino) for (dev, ino), t in used.items()])
+
+    def _evict(self, conn):
+
+        # Evict down to 90% of max_entries, so that it is not done on every
+        # put. Other processes may have changed the table, count it again.
+        n = conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+        target = self.max_entries - self.max_entries // 10
+        if n > target:
+            cur = conn.execute('DELETE FROM checksums WHERE rowid IN'
+                               ' (SELECT rowid FROM checksums ORDER BY used LIMIT ?)',
+                               (n - target,))
+            self._stats['evicted'] += cur.rowcount
+            n -= cur.rowcount
+
+        self.n = n
+
+    def stats(self):
+        """
+        :return: a dictionary in the following format:
+        {
+            'hit':     number of files found with all wanted checksums,
+            'miss':    number of files with any wanted checksum not found,
+            'evicted': number of checksums evicted,
+            'entries': number of checksums in the cache,
+        }
+        """
+        with self.lock:
+            rst = dict(self._stats)
+            rst['entries'] = self.n
+            return rst
+
+    def clear(self):
+        """
+        Remove all cached checksums.
+        """
+        with self.lock:
+            self._connect().execute('DELETE FROM checksums')
+            self.n = 0
+            self.used = {}
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self._commit_used(self.conn)
+                self.conn.close()
+            self.conn = None
+            self.pid = None
+
+
+class _MountTable(object):
+    """
+    Process wide cache of parsed mount table.
+
+    The cache is dropped when `/proc/self/mountinfo` reports a change.
+    On a system without `/proc/self/mountinfo` there is no way to learn about
+    changes, thus the mount table is parsed on every call.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = True
+
+        # all -> _Mounts
+        self.partitions = {}
+
+        self.pid = None
+        self.watch_f = None
+        self.poller = None
+
+    def get(self, all):
+        with self.lock:
+            if not self.enabled or not self._watch():
+                return _Mounts(_load_disk_partitions(all))
+
+            # poll() consumes the change event, thus a mount happens during
+            # loading below triggers another reload next time.
+            if len(self.poller.poll(0)) > 0:
+                self.partitions = {}
+
+            if all not in self.partitions:
+                self.partitions[all] = _Mounts(_load_disk_partitions(all))
+
+            return self.partitions[all]
+
+    def refresh(self):
+        with self.lock:
+            self.partitions = {}
+
+    def enable(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            self.partitions = {}
+
+    def _watch(self):
+
+        # `/proc/self` opened by parent refers to parent after fork.
+        pid = os.getpid()
+        if self.pid == pid:
+            return self.poller is not None
+
+        self.pid = pid
+        self.partitions = {}
+        self.poller = None
+        if self.watch_f is not None:
+            self.watch_f.close()
+            self.watch_f = None
+
+        if not hasattr(select, 'poll'):
+            return False
+
+        try:
+            self.watch_f = open(MOUNTINFO, 'rb')
+        except EnvironmentError:
+            return False
+
+        self.poller = select.poll()
+        self.poller.register(self.watch_f.fileno(), select.POLLPRI | select.POLLERR)
+
+        return True
+
+
+class _Mounts(object):
+    """
+    A parsed mount table and a prefix tree over its mount points for longest
+    prefix lookup.
+    """
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.tree = None
+
+    def mountpoint(self, path):
+        """
+        Find the longest mount point that is a prefix of `path`.
+        `path` must be an absolute path with symbolic links resolved.
+        """
+
+        # Built lazily: a table loaded only for `get_disk_partitions()` does not
+        # need it. Concurrent building is harmless.
+        tree = self.tree
+        if tree is None:
+            tree = self.tree = _build_mount_tree(self.partitions)
+
+        node = tree
+        mp = '/'
+        for name in path.split('/'):
+            if name == '':
+                continue
+
+            node = node.get(name)
+            if node is None:
+                break
+
+            if None in node:
+                mp = node[None]
+
+        return mp
+
+
+def _build_mount_tree(partitions):
+
+    # Every node is a dict of child name to child node.
+    # Key `None` holds the mount point path if the node is a mount point.
+    tree = {}
+    for mp in partitions:
+        if not mp.startswith('/'):
+            continue
+
+        node = tree
+        for name in mp.split('/'):
+            if name != '':
+                node = node.setdefault(name, {})
+
+        node[None] = mp
+
+    return tree
+
+
+_mount_table = _MountTable()
+
+
+def refresh_mount_table():
+    """
+    Drop the cached mount table.
+    The next mount point lookup parses the mount table again.
+    Normally it is not necessary because the cache is invalidated when
+    `/proc/self/mountinfo` changes.
+
+    :return: Nothing
+    """
+    _mount_table.refresh()
+
+
+def set_mount_table_cache(enabled):
+    """
+    Turn on or off the process wide mount table cache used by
+    `get_mountpoint`, `get_device`, `get_device_fs`, `get_path_fs` and
+    `get_disk_partitions`.
+    :param enabled: `True` to cache the parsed mount table, `False` to parse it on
+    every call. It is enabled by default.
+    :return: Nothing
+    """
+    _mount_table.enable(enabled)
+
+
 def assert_mountpoint(path):
     """
     Ensure that `path` must be a **mount point**.
@@ -54,14 +544,20 @@ def get_mountpoint(path):
     :param path: is a path that does have to be an existent file path.
     :return: the mount point path(one of output of command `mount` on linux)
     """
-    path = os.path.realpath(path)
+    mounts = _mount_table.get(True)
+    return mounts.mountpoint(os.path.realpath(path))
 
-    prt_by_mountpoint = get_disk_partitions()
 
-    while path != '/' and path not in prt_by_mountpoint:
-        path = os.path.dirname(path)
-
-    return path
+def get_mountpoints(paths):
+    """
+    Return the mount points where each of `paths` resides on.
+    It is the same as calling `get_mountpoint` for every path but the mount
+    table is looked up only once.
+    :param paths: is an iterable of paths that do not have to exist.
+    :return: a list of mount point paths in the same order as `paths`.
+    """
+    mounts = _mount_table.get(True)
+    return [mounts.mountpoint(os.path.realpath(p)) for p in paths]
 
 
 def get_device(path):
@@ -71,11 +567,53 @@ def get_device(path):
     :return: device path like `"/dev/sdb"` in string.
     """
 
-    prt_by_mountpoint = get_disk_partitions()
+    mounts = _mount_table.get(True)
+
+    mp = mounts.mountpoint(os.path.realpath(path))
+
+    return mounts.partitions[mp]['device']
+
+
+def get_path_partitions(paths):
+    """
+    Find the mount point information for many paths at once.
+    Paths are grouped by `st_dev` from `os.stat()` and every distinct device
+    is looked up in the mount table only once.
+    Paths those can not be `stat()` are looked up by their resolved path, like
+    `get_device` does.
+
+    A device mounted at more than one place(bind mount) is reported with the
+    mount point of the first path seen on it.
+
+    :param paths: is an iterable of file paths.
+    :return: a dictionary indexed by path, values are in the same format as the
+    values returned by `get_disk_partitions`, such as:
+    `{'device': '/dev/sdb1', 'mountpoint': '/data', 'fstype': 'xfs', 'opts': 'rw'}`.
+    Paths on the same device share one dictionary.
+    """
+    mounts = _mount_table.get(True)
+
+    prt_by_dev = {}
+    rst = {}
+
+    for path in paths:
+
+        try:
+            dev = os.stat(path).st_dev
+        except EnvironmentError:
+            dev = None
+
+        prt = prt_by_dev.get(dev)
+        if prt is None:
+            mp = mounts.mountpoint(os.path.realpath(path))
+            # The cached table is shared, give caller a copy.
+            prt = dict(mounts.partitions[mp])
+            if dev is not None:
+                prt_by_dev[dev] = prt
 
-    mp = get_mountpoint(path)
+        rst[path] = prt
 
-    return prt_by_mountpoint[mp]['device']
+    return rst
 
 
 def get_device_fs(device):
@@ -84,9 +622,9 @@ def get_device_fs(device):
     :param device: is a path of a device, such as `/dev/sdb1`.
     :return: the file-system name, such as `ext4` or `hfs`.
     """
-    prt_by_mp = get_disk_partitions()
+    prt_by_mp = _mount_table.get(True).partitions
 
-    for prt in list(prt_by_mp.values()):
+    for prt in prt_by_mp.values():
         if device == prt['device']:
             return prt['fstype']
     else:
@@ -101,6 +639,12 @@ def get_disk_partitions(all=True):
     otherwise `tmpfs` or `/proc` are not returned.
     :return: an dictionary indexed by mount point path:
     """
+    # The cached table is shared, give caller a copy.
+    prts = _mount_table.get(all).partitions
+    return dict([(mp, dict(prt)) for mp, prt in prts.items()])
+
+
+def _load_disk_partitions(all):
     # {
     #     '/': {'device': '/dev/disk1',
     #           'fstype': 'hfs',
@@ -139,10 +683,10 @@ def get_path_fs(path):
     :param path: is a file path on a file system.
     :return: the file-system name, such as `ext4` or `hfs`.
     """
-    mp = get_mountpoint(path)
-    prt_by_mp = get_disk_partitions()
+    mounts = _mount_table.get(True)
+    mp = mounts.mountpoint(os.path.realpath(path))
 
-    return prt_by_mp[mp]['fstype']
+    return mounts.partitions[mp]['fstype']
 
 
 def get_path_usage(path):
@@ -203,340 +747,3990 @@ def get_path_inode_usage(path):
         'percent': float(used) / total,
     }
 
-def makedirs(*paths, **kwargs):
+
+class DirUsageCache(object):
     """
-    Make directory.
-    If intermediate directory does not exist, create them too.
+    A cache of the entries of dirs for repeated `dir_usage(cache=cache)` scans.
+
+    For every dir it keeps the total of its non-dir entries and the names of
+    its sub dirs, valid while the modification time of the dir does not
+    change. Then an unchanged dir is not listed and its files are not
+    `stat()`-ed again.
+
+    A dir is modified only when entries are created, removed or renamed in it.
+    A file modified in place is not noticed, thus use it where files are
+    written once, or clear it from time to time.
+    A dir with an error while listing it is not cached.
+    It is thread safe and lives in memory.
 
     Args:
 
-        paths:
-            is a single part path such as `/tmp/foo` or a separated path such as
-            `('/tmp', 'foo')`.
+        max_entries(int):
+            is the max number of dirs to keep. The least recently used ones,
+            such as those of removed dirs, are evicted.
+    """
 
-        mode(int):
-            specifies permission mode for the dir created or existed.
-            By defaul it is `0755`.
+    def __init__(self, max_entries=1024 * 1024):
 
-        uid(int): specifies uid for the created dir.
-            By default they are `None` and the created dir inherits ownership from the
-            running python program.
+        if max_entries <= 0:
+            raise FSUtilError('max_entries must be positive')
 
-        gid(int): specifies uid for the created dir.
-            By default they are `None` and the created dir inherits ownership from the
-            running python program.
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
 
-    Raises:
-        OSError: if trying to create dir with the same path of a non-dir file,
-            or having other issue like permission denied.
-    """
+        # (st_dev, st_ino) -> (st_mtime_ns, _DirEntries)
+        self.dirs = collections.OrderedDict()
 
-    mode = kwargs.get('mode', 0o755)
-    uid = kwargs.get('uid') or k3confloader.conf.uid
-    gid = kwargs.get('gid') or k3confloader.conf.gid
+        self._stats = {
+            'hit': 0,
+            'miss': 0,
+            'evicted': 0,
+        }
 
-    path = os.path.join(*paths)
-    last_err = None
+    def get(self, st):
+        with self.lock:
+            key = (st.st_dev, st.st_ino)
+            v = self.dirs.get(key)
+            if v is not None and v[0] == st.st_mtime_ns:
+                self.dirs.move_to_end(key)
+                self._stats['hit'] += 1
+                return v[1]
 
-    # retry to deal with concurrent check-and-then-set issue
-    for _ in range(2):
+            self._stats['miss'] += 1
+            return None
 
-        if os.path.isdir(path):
+    def put(self, st, entries):
+        with self.lock:
+            key = (st.st_dev, st.st_ino)
+            self.dirs[key] = (st.st_mtime_ns, entries)
+            self.dirs.move_to_end(key)
 
-            if uid is not None and gid is not None:
-                os.chown(path, uid, gid)
+            while len(self.dirs) > self.max_entries:
+                self.dirs.popitem(last=False)
+                self._stats['evicted'] += 1
 
-            return
+    def stats(self):
+        """
+        :return: a dictionary in the following format:
+        {
+            'hit':     number of dirs found unchanged,
+            'miss':    number of dirs listed,
+            'evicted': number of dirs evicted,
+            'entries': number of dirs in the cache,
+        }
+        """
+        with self.lock:
+            rst = dict(self._stats)
+            rst['entries'] = len(self.dirs)
+            return rst
 
-        try:
-            os.makedirs(path, mode=mode)
-            if uid is not None and gid is not None:
-                os.chown(path, uid, gid)
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                last_err = e
-                # concurrent if-exist and makedirs
-            else:
-                raise
-    else:
-        raise last_err
+    def clear(self):
+        """
+        Remove all cached dirs.
+        """
+        with self.lock:
+            self.dirs = collections.OrderedDict()
 
 
-def ls_dirs(*paths):
+def dir_usage(*paths, one_fs=True, concurrency=8, cache=None, onerror=None):
     """
-    Get sorted sub directories of `paths`.
+    Collect the space usage of the directory tree `path`, like `du` does.
+    Dirs are listed with `os.scandir()` by a pool of `concurrency` threads.
+    Symbolic links are not followed. A file with several hard links in the tree
+    is counted once, by `(st_dev, st_ino)`.
 
     Args:
+
         paths:
-            is the directory path.
+            is the path of the dir.
+
+        one_fs(bool):
+            skip dirs on other devices than `path`: a dir with another
+            `st_dev` than `path` is skipped if `get_device` also tells another
+            device, e.g., a btrfs subvolume is not skipped.
+
+        concurrency(int):
+            is the number of threads.
+
+        cache(DirUsageCache):
+            skip listing dirs those are not modified since they are cached.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.scandir* or *os.lstat*. It may
+                be called from worker threads, one call at a time.
 
     Returns:
-        list: of all sub directory names.
+        dict: in the following format:
+        {
+            'size':      total apparent size in byte of all files and dirs,
+            'disk_size': total allocated size in byte, from `st_blocks`,
+            'files':     number of non-dir entries,
+            'dirs':      number of dirs, including `path`,
+        }
     """
 
     path = os.path.join(*paths)
-    files = os.listdir(path)
 
-    sub_dirs = []
-    for f in files:
-        if os.path.isdir(os.path.join(path, f)):
-            sub_dirs.append(f)
+    if onerror is None:
+        onerror = 'raise'
 
-    sub_dirs.sort()
+    if concurrency <= 0:
+        raise FSUtilError('concurrency must be positive')
 
-    return sub_dirs
+    st = os.lstat(path)
 
+    usage = _DirUsage(st.st_dev, get_device(path), one_fs, cache, onerror)
 
-def ls_files(*paths, pattern='.*'):
-    """
-    List all files that match `pattern` in `path`.
+    if not os.path.isdir(path) or os.path.islink(path):
+        usage.add_file(st)
+        return usage.result()
 
-    Args:
+    q = queue.LifoQueue()
+    q.put((path, st))
 
-        paths:
-            is a directory path.
+    threads = []
+    for _ in range(concurrency):
+        th = threading.Thread(target=_dir_usage_worker, args=(usage, q))
+        th.daemon = True
+        th.start()
+        threads.append(th)
 
-        pattern(str):
-            is a regular expression that matches wanted file names.
+    q.join()
 
-    Returns:
-        list: of sorted file names.
-    """
+    for th in threads:
+        q.put(None)
+    for th in threads:
+        th.join()
 
-    path = os.path.join(*paths)
-    fns = os.listdir(path)
+    if usage.error is not None:
+        raise usage.error
 
-    pt = re.compile(pattern)
+    return usage.result()
 
-    fns = sorted([x for x in fns
-                  if re.search(pt, x) is not None
-                  and os.path.isfile(os.path.join(path, x))
-                  ])
 
-    return fns
+def _dir_usage_worker(usage, q):
 
+    while True:
+        item = q.get()
+        if item is None:
+            return
 
-def fread(*paths, mode=''):
+        try:
+            if usage.error is None:
+                for sub in usage.scan(*item):
+                    q.put(sub)
+        except BaseException as e:
+            usage.fail(e)
+        finally:
+            q.task_done()
+
+
+class _DirEntries(object):
+    """
+    Non-dir entries of a dir, summed up, except those with more than one hard
+    link, and the names of its sub dirs.
     """
-    Read and return the entire file specified by `path`
 
-    Args:
+    def __init__(self):
+        self.size = 0
+        self.disk_size = 0
+        self.files = 0
 
-        paths:
-            is the path of the file to read.
+        # (st_dev, st_ino, size, disk_size) of files with several hard links.
+        self.links = []
 
-        mode(str):
-            If `mode='b'` it returns `bytes`.
-            If `mode=''` it returns a `str` decoded from `bytes`.
+        # (name, lstat() result or None)
+        self.subs = []
 
-    Returns:
-        file content in string or bytes.
-    """
-    path = os.path.join(*paths)
-    with open(path, 'r' + mode) as f:
-        return f.read()
+    def without_stats(self):
 
+        # A cached stat of a sub dir would be stale next time.
+        rst = _DirEntries()
+        rst.size = self.size
+        rst.disk_size = self.disk_size
+        rst.files = self.files
+        rst.links = self.links
+        rst.subs = [(name, None) for name, _ in self.subs]
 
-def fwrite(*paths_content, uid=None, gid=None, atomic=False, fsync=True):
-    """
-    Write `fcont` into file `path`.
+        return rst
 
-    Args
 
-        paths_content:
-            is the file path to write to and the content to write.
-            The last elt is content, e.g.:
-            `fwrite('/tmp', 'foo', 'bar')` write 'bar' into file '/tmp/foo'.
+class _DirUsage(object):
+
+    def __init__(self, dev, device, one_fs, cache, onerror):
+        self.lock = threading.Lock()
+        self.error = None
+
+        self.dev = dev
+        self.device = device
+        self.one_fs = one_fs
+        self.cache = cache
+
+        # st_dev -> if it is on the device of root.
+        self.same_fs = {dev: True}
+
+        self.size = 0
+        self.disk_size = 0
+        self.files = 0
+        self.dirs = 0
+        self.seen = set()
+
+        if callable(onerror):
+            onerror = self._serialize(onerror)
+        self.onerror = onerror
+
+    def _serialize(self, onerror):
+
+        def _onerror(func, path, exc_info):
+            with self.lock:
+                onerror(func, path, exc_info)
+
+        return _onerror
+
+    def fail(self, e):
+        with self.lock:
+            if self.error is None:
+                self.error = e
+
+    def add_file(self, st):
+        entries = _DirEntries()
+        _add_entry(entries, st)
+        self._add(entries)
+
+    def scan(self, path, st):
+        """
+        Count dir `path` and its non-dir entries, and return its sub dirs to
+        scan.
+        """
+
+        entries = None
+        if self.cache is not None:
+            entries = self.cache.get(st)
+
+        if entries is None:
+            entries, complete = self._list(path)
+            if entries is None:
+                return []
+
+            # `st` is taken before listing: if the dir is modified meanwhile,
+            # the cached entries are not used next time.
+            # Entries missed by an error are not cached, to be tried again.
+            if self.cache is not None and complete:
+                self.cache.put(st, entries.without_stats())
+
+        with self.lock:
+            self.size += st.st_size
+            self.disk_size += st.st_blocks * 512
+            self.dirs += 1
+
+        self._add(entries)
+
+        subs = []
+        for name, sub_st in entries.subs:
+            sub = os.path.join(path, name)
+
+            if sub_st is None:
+                try:
+                    sub_st = os.lstat(sub)
+                except os.error:
+                    _on_error(self.onerror, os.lstat, sub)
+                    continue
+
+            if self._on_same_fs(sub, sub_st):
+                subs.append((sub, sub_st))
+
+        return subs
+
+    def _list(self, path):
+
+        # Return the entries, or None if it can not be listed, and if no entry
+        # is missed by an error.
+
+        entries = _DirEntries()
+        complete = True
+
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries.subs.append((entry.name, entry.stat(follow_symlinks=False)))
+                        else:
+                            _add_entry(entries, entry.stat(follow_symlinks=False))
+                    except os.error:
+                        complete = False
+                        _on_error(self.onerror, os.lstat, entry.path)
+        except os.error:
+            _on_error(self.onerror, os.scandir, path)
+            return None, False
+
+        return entries, complete
+
+    def _on_same_fs(self, path, st):
+
+        if not self.one_fs:
+            return True
+
+        with self.lock:
+            same = self.same_fs.get(st.st_dev)
+
+        if same is None:
+            # A mount point: dirs below it have the same st_dev.
+            same = get_device(path) == self.device
+            with self.lock:
+                self.same_fs[st.st_dev] = same
+
+        return same
+
+    def _add(self, entries):
+
+        with self.lock:
+            self.size += entries.size
+            self.disk_size += entries.disk_size
+            self.files += entries.files
+
+            for dev, ino, size, disk_size in entries.links:
+                if (dev, ino) in self.seen:
+                    continue
+                self.seen.add((dev, ino))
+                self.size += size
+                self.disk_size += disk_size
+                self.files += 1
+
+    def result(self):
+        return {
+            'size': self.size,
+            'disk_size': self.disk_size,
+            'files': self.files,
+            'dirs': self.dirs,
+        }
+
+
+def _add_entry(entries, st):
+
+    disk_size = st.st_blocks * 512
+
+    if st.st_nlink > 1:
+        entries.links.append((st.st_dev, st.st_ino, st.st_size, disk_size))
+    else:
+        entries.size += st.st_size
+        entries.disk_size += disk_size
+        entries.files += 1
+
+
+def makedirs(*paths, **kwargs):
+    """
+    Make directory.
+    If intermediate directory does not exist, create them too.
+
+    Args:
+
+        paths:
+            is a single part path such as `/tmp/foo` or a separated path such as
+            `('/tmp', 'foo')`.
+
+        mode(int):
+            specifies permission mode for the dir created or existed.
+            By defaul it is `0755`.
+
+        uid(int): specifies uid for the created dir.
+            By default they are `None` and the created dir inherits ownership from the
+            running python program.
+
+        gid(int): specifies uid for the created dir.
+            By default they are `None` and the created dir inherits ownership from the
+            running python program.
+
+    Raises:
+        OSError: if trying to create dir with the same path of a non-dir file,
+            or having other issue like permission denied.
+    """
+
+    mode = kwargs.get('mode', 0o755)
+    uid = kwargs.get('uid') or k3confloader.conf.uid
+    gid = kwargs.get('gid') or k3confloader.conf.gid
+
+    path = os.path.join(*paths)
+
+    if _known_dirs.get(path, uid, gid):
+        return
+
+    _makedirs(path, mode, uid, gid)
+
+    _known_dirs.add(path, uid, gid)
+
+
+def _makedirs(path, mode, uid, gid):
+
+    last_err = None
+
+    # retry to deal with concurrent check-and-then-set issue
+    for _ in range(2):
+
+        if os.path.isdir(path):
+
+            if uid is not None and gid is not None:
+                os.chown(path, uid, gid)
+
+            return
+
+        try:
+            os.makedirs(path, mode=mode)
+            if uid is not None and gid is not None:
+                os.chown(path, uid, gid)
+            return
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                last_err = e
+                # concurrent if-exist and makedirs
+            else:
+                raise
+    else:
+        raise last_err
+
+
+def makedirs_many(paths, mode=0o755, uid=None, gid=None):
+    """
+    Make many directories, like calling `makedirs` for each of them, but with
+    fewer syscalls.
+    Paths are made parent first. A dir whose parent is in `paths` is made with a
+    single `mkdir()`, without checking its ancestors.
+
+    Args:
+
+        paths:
+            is an iterable of paths. A path is a str or a tuple of parts, such as
+            `('/tmp', 'foo')`.
+
+        mode(int):
+            specifies permission mode for the dirs created.
+
+        uid(int): specifies uid for the dirs.
+
+        gid(int): specifies gid for the dirs.
+
+    Raises:
+        OSError: if trying to create dir with the same path of a non-dir file,
+            or having other issue like permission denied.
+    """
+
+    uid = uid or k3confloader.conf.uid
+    gid = gid or k3confloader.conf.gid
+
+    normalized = set()
+    for path in paths:
+        if isinstance(path, (tuple, list)):
+            path = os.path.join(*path)
+        normalized.add(os.path.abspath(path))
+
+    made = set()
+
+    # Sorted: a parent goes before its children.
+    for path in sorted(normalized):
+
+        if _known_dirs.get(path, uid, gid):
+            made.add(path)
+            continue
+
+        if os.path.dirname(path) in made:
+            try:
+                os.mkdir(path, mode)
+            except OSError as e:
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
+
+            if uid is not None and gid is not None:
+                os.chown(path, uid, gid)
+        else:
+            _makedirs(path, mode, uid, gid)
+
+        made.add(path)
+        _known_dirs.add(path, uid, gid)
+
+
+class _KnownDirs(object):
+    """
+    A bounded LRU set of `(path, uid, gid)` of dirs made by `makedirs`, to
+    skip making and `chown()`-ing them again.
+    A dir removed since is found with a `stat()` on hit and dropped, thus
+    removing never needs to look into the cache.
+    """
+
+    def __init__(self, size=0):
+        self.lock = threading.Lock()
+        self.size = size
+        self.dirs = collections.OrderedDict()
+
+    def get(self, path, uid, gid):
+
+        if self.size == 0:
+            return False
+
+        key = (os.path.abspath(path), uid, gid)
+
+        with self.lock:
+            if key not in self.dirs:
+                return False
+
+            self.dirs.move_to_end(key)
+
+        if os.path.isdir(key[0]):
+            return True
+
+        with self.lock:
+            self.dirs.pop(key, None)
+
+        return False
+
+    def add(self, path, uid, gid):
+
+        if self.size == 0:
+            return
+
+        key = (os.path.abspath(path), uid, gid)
+
+        with self.lock:
+            self.dirs[key] = True
+            self.dirs.move_to_end(key)
+
+            while len(self.dirs) > self.size:
+                self.dirs.popitem(last=False)
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            while len(self.dirs) > self.size:
+                self.dirs.popitem(last=False)
+
+
+_known_dirs = _KnownDirs()
+
+
+def set_makedirs_cache(size):
+    """
+    Set the size of the process wide cache of dirs made by `makedirs` and
+    `makedirs_many`, with their uid and gid.
+    A dir in the cache is only checked with one `stat()`, and is not made
+    or `chown()`-ed again.
+
+    A dir found removed is dropped from the cache and made again. A dir
+    removed and made again by other means keeps the ownership it is made with.
+
+    :param size: is the max number of dirs to remember. `0` disables the
+    cache. It is disabled by default.
+    :return: Nothing
+    """
+    _known_dirs.resize(size)
+
+
+def ls_dirs(*paths):
+    """
+    Get sorted sub directories of `paths`.
+
+    Args:
+        paths:
+            is the directory path.
+
+    Returns:
+        list: of all sub directory names.
+    """
+
+    return sorted(iter_dirs(*paths))
+
+
+def iter_dirs(*paths):
+    """
+    Iterate over sub directory names of `paths`, in no particular order.
+    A symbolic link to a directory is also a sub directory.
+
+    It uses `os.scandir()`, thus the file type comes from the directory
+    entry without a `stat()` for every entry, on most file systems.
+
+    Args:
+        paths:
+            is the directory path.
+
+    Returns:
+        generator: of sub directory names.
+    """
+
+    path = os.path.join(*paths)
+
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                yield entry.name
+
+
+def ls_files(*paths, pattern='.*'):
+    """
+    List all files that match `pattern` in `path`.
+
+    Args:
+
+        paths:
+            is a directory path.
+
+        pattern(str):
+            is a regular expression that matches wanted file names.
+
+    Returns:
+        list: of sorted file names.
+    """
+
+    return sorted(iter_files(*paths, pattern=pattern))
+
+
+def iter_files(*paths, pattern='.*'):
+    """
+    Iterate over names of files that match `pattern` in `path`, in no
+    particular order. A symbolic link to a file is also a file.
+
+    It uses `os.scandir()`, thus the file type comes from the directory
+    entry without a `stat()` for every entry, on most file systems.
+
+    Args:
+
+        paths:
+            is a directory path.
+
+        pattern(str):
+            is a regular expression that matches wanted file names.
+
+    Returns:
+        generator: of file names.
+    """
+
+    path = os.path.join(*paths)
+
+    search = re.compile(pattern).search
+
+    with os.scandir(path) as it:
+        for entry in it:
+            if search(entry.name) is not None and entry.is_file():
+                yield entry.name
+
+
+def fread(*paths, mode=''):
+    """
+    Read and return the entire file specified by `path`
+
+    Args:
+
+        paths:
+            is the path of the file to read.
+
+        mode(str):
+            If `mode='b'` it returns `bytes`.
+            If `mode=''` it returns a `str` decoded from `bytes`.
+
+    Returns:
+        file content in string or bytes.
+    """
+    path = os.path.join(*paths)
+
+    if mode == 'b':
+        # Unbuffered: readall() sizes the result with fstat() and reads into it
+        # directly, without going through the buffered reader.
+        with open(path, 'rb', buffering=0) as f:
+            return f.read()
+
+    with open(path, 'r' + mode) as f:
+        return f.read()
+
+
+def fread_mmap(*paths, sequential=True, willneed=False):
+    """
+    Map the entire file specified by `path` into memory and return a read-only
+    view of it. Pages are read from the page cache on access, without a copy
+    into a python `bytes`.
+
+    The file stays mapped until the returned view and all views sliced from it
+    are released or garbage collected.
+
+    If another process truncates the file meanwhile, accessing a page beyond
+    the new end kills the process with `SIGBUS`. Do not use it on files those
+    may be truncated, use `fread` instead.
+
+    Args:
+
+        paths:
+            is the path of the file to read.
+
+        sequential(bool):
+            advise the kernel with `MADV_SEQUENTIAL` to read ahead aggressively
+            and drop pages soon after they are accessed.
+
+        willneed(bool):
+            advise the kernel with `MADV_WILLNEED` to start reading the entire
+            file in background.
+
+    Returns:
+        memoryview: of the file content.
+    """
+    path = os.path.join(*paths)
+
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return memoryview(b'')
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if sequential:
+        _madvise(mm, 'MADV_SEQUENTIAL', 0, size)
+    if willneed:
+        _madvise(mm, 'MADV_WILLNEED', 0, size)
+
+    return memoryview(mm)
+
+
+def fwrite(*paths_content, uid=None, gid=None, atomic=False, fsync=True, group_commit=False,
+           tmpfile=False):
+    """
+    Write `fcont` into file `path`.
+
+    Args
+
+        paths_content:
+            is the file path to write to and the content to write.
+            The last elt is content, e.g.:
+            `fwrite('/tmp', 'foo', 'bar')` write 'bar' into file '/tmp/foo'.
+
+            A `str` content is written in text mode.
+            A `bytes`, `bytearray`, `memoryview` or any other object supporting
+            the buffer protocol is written with `os.write()` directly from its
+            buffer, without a copy.
+            An iterable of such objects is written with `os.writev()`, many
+            chunks per syscall. Chunks of an iterator other than a `list` or
+            `tuple` may share a buffer, thus small ones are copied, and large
+            ones are written before pulling the next.
 
         uid:
             specifies the user_id the file belongs to.
 
-        gid:
-            specifies the group_id the file belongs to.
+        gid:
+            specifies the group_id the file belongs to.
+
+            By default they are `None`, which means the file that has been written
+            inheirts ownership of the running python script.
+
+        atomic(bool):
+            atomically write fcont to the path.
+
+            Write fcont to a temporary file, then rename to the path.
+            The temporary file names of same path in one process distinguish with
+            nanosecond, it is not atomic if the temporary files of same path
+            created at the same nanosecond.
+            The renaming will be an atomic operation (this is a POSIX requirement).
+
+        fsync(bool):
+            specify if need to synchronize data to storage device.
+            With `atomic`, the dir is synchronized after renaming too, thus the
+            rename is durable. Without `atomic`, the dir is not synchronized,
+            thus a new file may be lost on power failure. Use `group_commit`
+            for that.
+
+        group_commit(bool):
+            make the write durable together with concurrent `fwrite` calls
+            from other threads. It blocks until the batch is durable.
+            Background threads fsync the open fds of a batch in parallel,
+            rename the temporary files if `atomic`, then fsync every affected
+            dir once.
+            While a batch is being synchronized the next one accumulates.
+            It implies `fsync`.
+
+        tmpfile(bool):
+            with `atomic`, create the temporary file without a name with
+            `O_TMPFILE`, on a file system known to support it(by
+            `get_path_fs`), and give it a random name only right before
+            renaming. A crash while writing leaves nothing behind.
+            On other file systems, or with `group_commit`, the temporary file
+            has a random name and is created with `O_EXCL`.
+            Either way concurrent writers never share a temporary file.
+
+    """
+
+    fcont = paths_content[-1]
+    path = os.path.join(*paths_content[:-1])
+
+    if group_commit:
+        return _fwrite_group_commit(path, fcont, uid, gid, atomic, tmpfile)
+
+    if not atomic:
+        return _write_file(path, fcont, uid, gid, fsync)
+
+    if tmpfile:
+        with AtomicFile(path, uid=uid, gid=gid, fsync=fsync, tmpfile=True) as f:
+            _write_content(f.fd, fcont)
+        return
+
+    tmp_path = _tmp_path(path)
+    _write_file(tmp_path, fcont, uid, gid, fsync)
+
+    try:
+        os.rename(tmp_path, path)
+    except EnvironmentError:
+        os.remove(tmp_path)
+        raise
+
+    if fsync:
+        _fsync_dir_of(path)
+
+
+def _tmp_path(path):
+    return '{path}._tmp_.{pid}_{timestamp}'.format(
+        path=path,
+        pid=os.getpid(),
+        timestamp=int(time.time() * (1000 ** 3)),
+    )
+
+
+def _random_tmp_path(path):
+    return '{path}._tmp_.{pid}_{rand}'.format(
+        path=path,
+        pid=os.getpid(),
+        rand=binascii.hexlify(os.urandom(8)).decode(),
+    )
+
+
+# File systems those support O_TMPFILE and linking it with linkat().
+TMPFILE_FS = ('ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'tmpfs', 'f2fs')
+
+
+def _open_tmp(path, tmpfile):
+
+    # Return an fd to write to and the path of it, which is None for an
+    # O_TMPFILE.
+
+    if not tmpfile:
+        tmp_path = _tmp_path(path)
+        return os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666), tmp_path
+
+    parent = os.path.dirname(os.path.abspath(path))
+
+    if hasattr(os, 'O_TMPFILE'):
+        try:
+            fs = get_path_fs(parent)
+        except KeyError:
+            fs = None
+
+        if fs in TMPFILE_FS:
+            try:
+                return os.open(parent, os.O_TMPFILE | os.O_WRONLY, 0o666), None
+            except OSError as e:
+                # Not supported by kernel or by this mount.
+                if e.errno not in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+                    raise
+
+    return _open_excl_tmp(path)
+
+
+def _open_excl_tmp(path):
+
+    while True:
+        tmp_path = _random_tmp_path(path)
+        try:
+            return os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), tmp_path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _link_tmpfile(fd, path):
+
+    # linkat() can not replace an existent file. Link an O_TMPFILE to a
+    # random name then rename it.
+    # os.link() calls linkat(AT_SYMLINK_FOLLOW) only with a dir fd, otherwise
+    # it calls link(), which does not follow the magic link in /proc.
+
+    fd_dir = os.open('/proc/self/fd', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        while True:
+            tmp_path = _random_tmp_path(path)
+            try:
+                os.link(str(fd), tmp_path, src_dir_fd=fd_dir, follow_symlinks=True)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+    finally:
+        os.close(fd_dir)
+
+    try:
+        os.rename(tmp_path, path)
+    except EnvironmentError:
+        os.remove(tmp_path)
+        raise
+
+
+def _fwrite_group_commit(path, fcont, uid, gid, atomic, tmpfile):
+
+    if not atomic:
+        tmp_path = None
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    elif tmpfile:
+        fd, tmp_path = _open_excl_tmp(path)
+    else:
+        tmp_path = _tmp_path(path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    # The committer synchronizes the fd written to, not a file reopened by
+    # name, which may be write only or replaced meanwhile.
+    try:
+        _write_content(fd, fcont)
+        _chown_fd(fd, uid, gid)
+
+        if atomic:
+            _group_committer.commit(fd, tmp_path, rename_to=path)
+        else:
+            _group_committer.commit(fd, path)
+    except EnvironmentError:
+        if tmp_path is not None and os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        os.close(fd)
+
+
+class _CommitRequest(object):
+
+    def __init__(self, fd, path, rename_to):
+        self.fd = fd
+        self.path = path
+        self.rename_to = rename_to
+        self.done = threading.Event()
+        self.error = None
+
+
+# Number of threads synchronizing files of a batch of group commit.
+_GROUP_COMMIT_THREADS = 8
+
+
+class _GroupCommitter(object):
+    """
+    Synchronizes files written by concurrent `fwrite(group_commit=True)` in
+    batches with one background thread. Files and dirs of a batch are
+    synchronized in parallel by a small pool, so that the file system can
+    merge them into one journal commit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pid = None
+        self.pending = []
+        self.pool = None
+
+    def commit(self, fd, path, rename_to=None):
+
+        req = _CommitRequest(fd, path, rename_to)
+
+        with self.lock:
+            # Threads do not survive fork.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = []
+                self.pool = concurrent.futures.ThreadPoolExecutor(_GROUP_COMMIT_THREADS)
+
+                th = threading.Thread(target=self._work, args=(self.pool,))
+                th.daemon = True
+                th.start()
+
+            self.pending.append(req)
+            self.cond.notify()
+
+        req.done.wait()
+
+        if req.error is not None:
+            raise req.error
+
+    def _work(self, pool):
+
+        while True:
+            with self.lock:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+
+                batch, self.pending = self.pending, []
+
+            try:
+                _commit_batch(batch, pool)
+            except BaseException as e:
+                for req in batch:
+                    if req.error is None:
+                        req.error = e
+            finally:
+                for req in batch:
+                    req.done.set()
+
+
+_group_committer = _GroupCommitter()
+
+
+def _commit_batch(batch, pool):
+
+    # A file must be durable before it is renamed to its final path, and the
+    # rename is durable once the dir is synchronized.
+
+    futs = [(req, pool.submit(os.fsync, req.fd)) for req in batch]
+
+    reqs_by_dir = collections.OrderedDict()
+
+    for req, fut in futs:
+        try:
+            fut.result()
+            path = req.path
+            if req.rename_to is not None:
+                os.rename(req.path, req.rename_to)
+                path = req.rename_to
+        except EnvironmentError as e:
+            req.error = e
+            continue
+
+        d = os.path.dirname(os.path.abspath(path))
+        reqs_by_dir.setdefault(d, []).append(req)
+
+    futs = [(reqs, pool.submit(_fsync_path, d)) for d, reqs in reqs_by_dir.items()]
+
+    for reqs, fut in futs:
+        try:
+            fut.result()
+        except EnvironmentError as e:
+            for req in reqs:
+                req.error = e
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir_of(path):
+    # Make a new name of `path`, by creating or renaming, durable.
+    _fsync_path(os.path.dirname(os.path.abspath(path)))
+
+
+def _write_file(path, fcont, uid=None, gid=None, fsync=True):
+
+    uid = uid or k3confloader.conf.uid
+    gid = gid or k3confloader.conf.gid
+
+    if isinstance(fcont, str):
+        with open(path, 'w') as f:
+            f.write(fcont)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+    else:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            _write_content(fd, fcont)
+
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    if uid is not None and gid is not None:
+        os.chown(path, uid, gid)
+
+
+class AtomicFile(object):
+    """
+    A file written incrementally to a temporary file `<path>._tmp_.<pid>_<ns>`,
+    then renamed to `path` on `commit()`, thus readers of `path` see either
+    the old or the complete new content.
+
+    Used as a context manager, it commits if the block exits normally and
+    removes the temporary file otherwise::
+
+        with AtomicFile('/tmp/foo', sha1=True) as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        f.checksums['sha1']
+
+    Args:
+
+        paths:
+            is the path of the file to write.
+
+        uid, gid(int):
+            specify the ownership of the file, as `fwrite` does.
+
+        fsync(bool):
+            synchronize the file to storage device before renaming, and the
+            dir of it after renaming.
+
+        sha1, md5, crc32, sha256(bool):
+            calculate checksums of the content as it is written, with the same
+            algorithms as `calc_checksums`.
+
+        algorithms(list):
+            are names of more checksums to calculate, as `calc_checksums`
+            accepts.
+
+        tmpfile(bool):
+            create the temporary file with `O_TMPFILE` or `O_EXCL` and a random
+            name, as `fwrite(tmpfile=True)` does. Then `tmp_path` is `None`
+            for an `O_TMPFILE`.
+    """
+
+    def __init__(self, *paths, uid=None, gid=None, fsync=True,
+                 sha1=False, md5=False, crc32=False, sha256=False, tmpfile=False,
+                 algorithms=None):
+
+        self.path = os.path.join(*paths)
+
+        self.uid = uid or k3confloader.conf.uid
+        self.gid = gid or k3confloader.conf.gid
+        self.fsync = fsync
+
+        self.hashers = [(name, _hasher_factory(name)())
+                        for name in _checksum_names(sha1, md5, crc32, sha256, algorithms)]
+
+        # Set by `commit()`, in the same format as `calc_checksums` returns.
+        self.checksums = None
+        self.size = 0
+
+        self.fd, self.tmp_path = _open_tmp(self.path, tmpfile)
+
+    def write(self, buf):
+        """
+        Write a `bytes`-like `buf` entirely.
+        """
+        view = _byte_view(buf)
+        _write_all(self.fd, view)
+
+        for _, h in self.hashers:
+            h.update(view)
+
+        self.size += len(view)
+
+    def commit(self):
+        """
+        Close the temporary file and rename it to `path`.
+        """
+
+        try:
+            if self.fsync:
+                os.fsync(self.fd)
+
+            if self.uid is not None and self.gid is not None:
+                os.fchown(self.fd, self.uid, self.gid)
+
+            if self.tmp_path is None:
+                _link_tmpfile(self.fd, self.path)
+            else:
+                os.rename(self.tmp_path, self.path)
+        except EnvironmentError:
+            self.abort()
+            raise
+
+        os.close(self.fd)
+        self.fd = None
+
+        if self.fsync:
+            _fsync_dir_of(self.path)
+
+        checksums = _new_checksums()
+        for name, h in self.hashers:
+            checksums[name] = h.hexdigest()
+
+        self.checksums = checksums
+
+    def abort(self):
+        """
+        Close and remove the temporary file. `path` is not touched.
+        """
+
+        if self.fd is None:
+            return
+
+        os.close(self.fd)
+        self.fd = None
+
+        if self.tmp_path is not None and os.path.lexists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def fwrite_stream(*paths_source, uid=None, gid=None, fsync=True,
+                  sha1=False, md5=False, crc32=False, sha256=False,
+                  block_size=WRITE_BLOCK, tmpfile=False, algorithms=None):
+    """
+    Atomically write content from an iterable or a file-like object into
+    file `path`, with constant memory, and optionally calculate checksums of
+    it at the same time. See `AtomicFile`.
+
+    Args:
+
+        paths_source:
+            is the file path to write to and the source to write.
+            The last elt is the source, e.g.:
+            `fwrite_stream('/tmp', 'foo', open('/tmp/bar', 'rb'))`.
+
+            A source with `readinto()` or `read()` is read in blocks of
+            `block_size` until EOF. Otherwise it is iterated over for chunks
+            of `bytes`-like objects.
+
+        uid, gid(int):
+            specify the ownership of the file, as `fwrite` does.
+
+        fsync(bool):
+            synchronize the file to storage device before renaming, and the
+            dir of it after renaming.
+
+        sha1, md5, crc32, sha256(bool):
+            specify which checksums to calculate.
+
+        algorithms(list):
+            are names of more checksums to calculate, as `calc_checksums`
+            accepts.
+
+        block_size(int):
+            is the size to read from a file-like source at a time.
+
+        tmpfile(bool):
+            create the temporary file as `fwrite(tmpfile=True)` does.
+
+    Returns:
+        dict: of checksum name to hex string, or to `None` if not enabled.
+    """
+
+    source = paths_source[-1]
+
+    with AtomicFile(*paths_source[:-1], uid=uid, gid=gid, fsync=fsync,
+                    sha1=sha1, md5=md5, crc32=crc32, sha256=sha256, tmpfile=tmpfile,
+                    algorithms=algorithms) as f:
+
+        if hasattr(source, 'readinto'):
+            buf = _buffer_pool.get(block_size)
+            try:
+                view = memoryview(buf)
+                while True:
+                    n = source.readinto(buf)
+                    if not n:
+                        break
+                    f.write(view[:n])
+            finally:
+                _buffer_pool.put(buf)
+
+        elif hasattr(source, 'read'):
+            while True:
+                chunk = source.read(block_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+        else:
+            for chunk in source:
+                f.write(chunk)
+
+    return f.checksums
+
+
+def copy_file(src, dst, uid=None, gid=None, atomic=False, fsync=True, tmpfile=False,
+              sha1=False, md5=False, crc32=False, sha256=False,
+              block_size=WRITE_BLOCK, io_limit=None, reflink=True, keep_stat=False,
+              algorithms=None):
+    """
+    Copy the content of file `src` to file `dst`.
+
+    If `src` and the dir of `dst` are on the same device(by `get_device`), the
+    content is copied in kernel without going through user space: by a reflink
+    with `FICLONE` if `reflink` is enabled and the file system supports it,
+    otherwise by `os.copy_file_range()`, or `os.sendfile()`.
+    Otherwise, or if the kernel refuses, it is copied through a pooled buffer.
+
+    With any checksum enabled, the content is always copied through the buffer
+    and hashed on the way, so that it is read only once.
+
+    Args:
+
+        src(str):
+            is the path of the file to copy.
+
+        dst(str):
+            is the path of the file to write to.
+
+        uid, gid(int):
+            specify the ownership of `dst`, as `fwrite` does.
+
+        atomic(bool):
+            write to a temporary file and rename it to `dst`, as `AtomicFile`
+            does.
+
+        fsync(bool):
+            synchronize `dst` to storage device.
+
+        tmpfile(bool):
+            with `atomic`, create the temporary file as `fwrite(tmpfile=True)`
+            does.
+
+        sha1, md5, crc32, sha256(bool):
+            specify which checksums of the content to calculate.
+
+        algorithms(list):
+            are names of more checksums to calculate, as `calc_checksums`
+            accepts.
+
+        block_size(int):
+            is the max size in byte to copy in one syscall.
+
+        io_limit(int or IOLimiter):
+            is the max bytes to copy per second, as `calc_checksums` accepts.
+            By default it is `None`, no limit. A reflink is not charged.
+
+        reflink(bool):
+            try to share the extents of `src` with `FICLONE`.
+
+        keep_stat(bool):
+            also copy the permission mode and the access and modification time
+            of `src` to `dst`.
+
+    Returns:
+        dict: of checksum name to hex string, or to `None` if not enabled.
+    """
+
+    if block_size <= 0:
+        raise FSUtilError('block_size must be positive integer')
+
+    if not isinstance(io_limit, IOLimiter) and io_limit == 0:
+        raise FSUtilError('io_limit shoud not be zero')
+
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise FSUtilError('{src} and {dst} are the same file'.format(src=src, dst=dst))
+
+    names = _checksum_names(sha1, md5, crc32, sha256, algorithms)
+    hashers = [(name, _hasher_factory(name)()) for name in names]
+
+    with open(src, 'rb', buffering=0) as f:
+
+        src_st = os.fstat(f.fileno())
+
+        if atomic:
+            af = AtomicFile(dst, uid=uid, gid=gid, fsync=fsync, tmpfile=tmpfile)
+            fd = af.fd
+        else:
+            af = None
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+        try:
+            done = False
+            if len(hashers) == 0 and _same_device(src, dst):
+                done = _copy_in_kernel(f.fileno(), fd, block_size, io_limit, reflink)
+
+            if not done:
+                _copy_buffered(f, fd, hashers, block_size, io_limit)
+
+            if keep_stat:
+                os.fchmod(fd, src_st.st_mode & 0o7777)
+                os.utime(fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+
+            if af is not None:
+                af.commit()
+            else:
+                if fsync:
+                    os.fsync(fd)
+                _chown_fd(fd, uid, gid)
+        except BaseException:
+            if af is not None:
+                af.abort()
+            raise
+        finally:
+            if af is None:
+                os.close(fd)
+
+    checksums = _new_checksums()
+    for name, h in hashers:
+        checksums[name] = h.hexdigest()
+
+    return checksums
+
+
+def _same_device(src, dst):
+    try:
+        return get_device(src) == get_device(os.path.dirname(os.path.abspath(dst)))
+    except KeyError:
+        return False
+
+
+def _chown_fd(fd, uid, gid):
+
+    uid = uid or k3confloader.conf.uid
+    gid = gid or k3confloader.conf.gid
+
+    if uid is not None and gid is not None:
+        os.fchown(fd, uid, gid)
+
+
+def _copy_in_kernel(src_fd, dst_fd, block_size, io_limit, reflink):
+
+    # Return True if copied, or False if the kernel can not copy these files.
+    # Then the file positions of both fds are where to continue from, a way
+    # that fails after copying some bytes leaves them moved forward.
+
+    if reflink:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNO:
+                raise
+
+    # os.copy_file_range() is available since python 3.8
+    ways = []
+    if hasattr(os, 'copy_file_range'):
+        ways.append(lambda: os.copy_file_range(src_fd, dst_fd, block_size))
+    if hasattr(os, 'sendfile'):
+        ways.append(lambda: os.sendfile(dst_fd, src_fd, None, block_size))
+
+    for copy in ways:
+        try:
+            while True:
+                t0 = time.time()
+                n = copy()
+                if n == 0:
+                    return True
+
+                _throttle(io_limit, block_size, t0, n)
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNO:
+                raise
+
+    return False
+
+
+def _copy_buffered(f, fd, hashers, block_size, io_limit):
+
+    buf = _buffer_pool.get(block_size)
+    try:
+        for view in _read_blocks(f, [buf], io_limit):
+            for _, h in hashers:
+                h.update(view)
+            _write_all(fd, view)
+    finally:
+        _buffer_pool.put(buf)
+
+
+def _write_content(fd, fcont):
+
+    # Write `fcont` of any type `fwrite` accepts. `str` is encoded the way
+    # text mode `open()` does.
+
+    if isinstance(fcont, str):
+        fcont = fcont.encode(locale.getpreferredencoding(False))
+
+    try:
+        view = memoryview(fcont)
+    except TypeError:
+        _writev_all(fd, fcont)
+    else:
+        _write_all(fd, view)
+
+
+def _byte_view(buf):
+
+    # A flat view of bytes of any object supporting the buffer protocol. A non
+    # contiguous one, such as a strided slice, is copied.
+
+    view = memoryview(buf)
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+
+    return view.cast('B')
+
+
+def _write_all(fd, view):
+
+    # os.write() may write less than asked.
+    view = _byte_view(view)
+    while len(view) > 0:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+# Max size of a chunk from an iterator that is copied to be written with
+# others in one writev(). A larger one is written at once.
+_WRITEV_COPY_MAX = 64 * 1024
+
+
+def _writev_all(fd, chunks):
+
+    if not hasattr(os, 'writev'):
+        for chunk in chunks:
+            _write_all(fd, memoryview(chunk))
+        return
+
+    # Chunks of an iterator, such as a generator, may be views of one buffer
+    # refilled for the next chunk. Thus a chunk must not be referred to after
+    # pulling the next one: it is copied, or written at once if it is large.
+    reused = not isinstance(chunks, (list, tuple))
+
+    views = []
+    for chunk in chunks:
+        view = _byte_view(chunk)
+        if len(view) == 0:
+            continue
+
+        if reused:
+            if len(view) > _WRITEV_COPY_MAX:
+                _writev_views(fd, views)
+                views = []
+                _write_all(fd, view)
+                continue
+
+            view = memoryview(bytes(view))
+
+        views.append(view)
+
+        # Up to IOV_MAX buffers per writev().
+        if len(views) >= IOV_MAX:
+            _writev_views(fd, views)
+            views = []
+
+    _writev_views(fd, views)
+
+
+def _writev_views(fd, views):
+
+    while len(views) > 0:
+        n = os.writev(fd, views)
+
+        # Drop written buffers and cut the partially written one.
+        i = 0
+        while i < len(views) and n >= len(views[i]):
+            n -= len(views[i])
+            i += 1
+
+        views = views[i:]
+        if n > 0:
+            views[0] = views[0][n:]
+
+
+def fread_many(paths, mode='b', backend=None, concurrency=8, read_size=64 * 1024,
+               onerror=None):
+    """
+    Read many entire files, like calling `fread` for each of them, with far
+    fewer syscalls for small files.
+
+    With the `io_uring` backend, files are handled in batches of up to
+    `IO_URING_ENTRIES`: one `io_uring_enter()` opens all files of a batch, one
+    reads up to `read_size` bytes of every file, and one closes them all.
+    The rest of a larger file is read with `pread()`.
+
+    Args:
+
+        paths:
+            is an iterable of file paths.
+
+        mode(str):
+            If `mode='b'` it returns `bytes`.
+            If `mode=''` it returns `str` decoded from `bytes`, with universal
+            newlines, as `fread` does.
+
+        backend(str):
+            - "io_uring": use io_uring, which requires linux 5.6 on x86_64.
+            - "threads": read every file in a pool of `concurrency` threads.
+            - `None`: "io_uring" if it is supported, otherwise "threads".
+
+        concurrency(int):
+            is the number of threads of the "threads" backend.
+
+        read_size(int):
+            is the number of bytes to read in the batch, which is best to be
+            not smaller than most of the files.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.open* or *os.read*.
+            The content of a failed file is `None`.
+
+    Returns:
+        list: of file contents in the order of `paths`.
+    """
+
+    if onerror is None:
+        onerror = 'raise'
+
+    if read_size <= 0:
+        raise FSUtilError('read_size must be positive integer')
+
+    paths = list(paths)
+    backend = _batch_backend(backend)
+
+    if backend == 'threads':
+        rst = _run_many(concurrency, _read_one, [(p,) for p in paths], paths, onerror)
+    else:
+        ring = _get_io_uring()
+        rst = []
+        for i in range(0, len(paths), ring.entries):
+            rst.extend(_io_uring_read(ring, paths[i:i + ring.entries], read_size, onerror))
+
+    if mode == 'b':
+        return rst
+
+    enc = locale.getpreferredencoding(False)
+    return [None if cont is None else
+            cont.decode(enc).replace('\r\n', '\n').replace('\r', '\n')
+            for cont in rst]
+
+
+def fwrite_many(items, uid=None, gid=None, fsync=True, backend=None, concurrency=8,
+                onerror=None):
+    """
+    Write many files, like calling `fwrite` for each of them, with far fewer
+    syscalls for small files.
+
+    With the `io_uring` backend, files are handled in batches of up to
+    `IO_URING_ENTRIES`: one `io_uring_enter()` opens all files of a batch, one
+    writes them all, one synchronizes them all if `fsync`, and one closes them
+    all.
+
+    Args:
+
+        items:
+            is an iterable of `(path, content)`. `content` is of any type
+            `fwrite` accepts.
+
+        uid, gid(int):
+            specify the ownership of the files, as `fwrite` does.
+
+        fsync(bool):
+            synchronize the files to storage device.
+
+        backend(str):
+            - "io_uring": use io_uring, which requires linux 5.6 on x86_64.
+            - "threads": write every file in a pool of `concurrency` threads.
+            - `None`: "io_uring" if it is supported, otherwise "threads".
+
+        concurrency(int):
+            is the number of threads of the "threads" backend.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.open*, *os.write*, *os.fsync* or
+                *os.close*.
+
+    Returns:
+        Nothing
+    """
+
+    if onerror is None:
+        onerror = 'raise'
+
+    items = list(items)
+    backend = _batch_backend(backend)
+
+    uid = uid or k3confloader.conf.uid
+    gid = gid or k3confloader.conf.gid
+
+    if backend == 'threads':
+        _run_many(concurrency, _write_one, [(path, cont, uid, gid, fsync) for path, cont in items],
+                  [path for path, _ in items], onerror)
+        return
+
+    ring = _get_io_uring()
+    for i in range(0, len(items), ring.entries):
+        _io_uring_write(ring, items[i:i + ring.entries], uid, gid, fsync, onerror)
+
+
+def _batch_backend(backend):
+
+    if backend is None:
+        if _io_uring_supported():
+            return 'io_uring'
+        return 'threads'
+
+    if backend == 'io_uring' and not _io_uring_supported():
+        raise FSUtilError('io_uring is not supported')
+
+    if backend not in ('io_uring', 'threads'):
+        raise FSUtilError('unknown backend: {backend}'.format(backend=backend))
+
+    return backend
+
+
+def _run_many(concurrency, func, args, paths, onerror):
+
+    # `func` is called with a list as the first argument, in which it keeps
+    # the syscall in progress: the one reported to `onerror` if it fails, as
+    # the io_uring backend does.
+
+    if concurrency <= 0:
+        raise FSUtilError('concurrency must be positive')
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        steps = [[None] for _ in args]
+        futs = [pool.submit(func, step, *a) for step, a in zip(steps, args)]
+
+        rst = []
+        for path, step, fut in zip(paths, steps, futs):
+            try:
+                rst.append(fut.result())
+            except EnvironmentError:
+                rst.append(None)
+                _on_error(onerror, step[0], path)
+
+    return rst
+
+
+def _read_one(step, path):
+
+    step[0] = os.open
+    with open(path, 'rb', buffering=0) as f:
+        step[0] = os.read
+        return f.read()
+
+
+def _write_one(step, path, cont, uid, gid, fsync):
+
+    step[0] = os.open
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    closed = False
+    try:
+        # A failed fchown() is reported as os.write, as the io_uring backend
+        # does.
+        step[0] = os.write
+        _write_content(fd, cont)
+        _chown_fd(fd, uid, gid)
+
+        if fsync:
+            step[0] = os.fsync
+            os.fsync(fd)
+
+        step[0] = os.close
+        closed = True
+        os.close(fd)
+    finally:
+        if not closed:
+            os.close(fd)
+
+
+# Number of operations submitted to io_uring at a time.
+IO_URING_ENTRIES = 256
+
+_SYS_io_uring_setup = 425
+_SYS_io_uring_enter = 426
+
+_IORING_OFF_SQ_RING = 0
+_IORING_OFF_CQ_RING = 0x8000000
+_IORING_OFF_SQES = 0x10000000
+
+_IORING_ENTER_GETEVENTS = 1
+
+_IORING_OP_FSYNC = 3
+_IORING_OP_OPENAT = 18
+_IORING_OP_CLOSE = 19
+_IORING_OP_READ = 22
+_IORING_OP_WRITE = 23
+
+_AT_FDCWD = -100
+
+# struct io_uring_sqe: opcode, flags, ioprio, fd, off, addr, len, op_flags,
+# user_data, buf_index, personality, file_index, addr3, pad.
+_SQE_FORMAT = '<BBHiQQIIQHHiQQ'
+_SQE_SIZE = 64
+
+# struct io_uring_cqe: user_data, res, flags.
+_CQE_FORMAT = '<QiI'
+_CQE_SIZE = 16
+
+
+def _io_uring_supported():
+
+    # The rings are shared with kernel without memory barriers, which is safe
+    # only on x86, where stores are not reordered with other stores.
+    if sys.platform != 'linux' or os.uname().machine != 'x86_64':
+        return False
+
+    try:
+        release = tuple(int(x) for x in re.match(r'(\d+)\.(\d+)', os.uname().release).groups())
+    except (AttributeError, ValueError):
+        return False
+
+    # IORING_OP_OPENAT, IORING_OP_READ and others are available since 5.6.
+    if release < (5, 6):
+        return False
+
+    global _io_uring_probed
+    if _io_uring_probed is None:
+        try:
+            _IoUring(1).close()
+            _io_uring_probed = True
+        except (OSError, AttributeError):
+            _io_uring_probed = False
+
+    return _io_uring_probed
+
+
+# Whether a ring can be set up, probed once per process.
+_io_uring_probed = None
+
+
+class _IoUring(object):
+    """
+    A minimal io_uring with ctypes. `run()` submits a list of operations and
+    waits for all of them to complete. It is safe to call `run()` from
+    multiple threads, one call at a time runs.
+    """
+
+    def __init__(self, entries):
+
+        self.lock = threading.Lock()
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.syscall.restype = ctypes.c_long
+
+        params = ctypes.create_string_buffer(120)
+        fd = self.libc.syscall(ctypes.c_long(_SYS_io_uring_setup), ctypes.c_long(entries), params)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.fd = fd
+
+        sq_entries, cq_entries = struct.unpack_from('<II', params, 0)
+        # struct io_sqring_offsets and io_cqring_offsets
+        sq_off = struct.unpack_from('<8IQ', params, 40)
+        cq_off = struct.unpack_from('<8IQ', params, 80)
+
+        self.entries = sq_entries
+
+        flags = mmap.MAP_SHARED | getattr(mmap, 'MAP_POPULATE', 0)
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+
+        try:
+            self.sq = mmap.mmap(fd, sq_off[6] + sq_entries * 4, flags, prot,
+                                offset=_IORING_OFF_SQ_RING)
+            self.cq = mmap.mmap(fd, cq_off[5] + cq_entries * _CQE_SIZE, flags, prot,
+                                offset=_IORING_OFF_CQ_RING)
+            self.sqes = mmap.mmap(fd, sq_entries * _SQE_SIZE, flags, prot,
+                                  offset=_IORING_OFF_SQES)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self.sq_head, self.sq_tail, self.sq_mask = sq_off[0], sq_off[1], sq_off[2]
+        self.sq_array = sq_off[6]
+        self.cq_head, self.cq_tail, self.cq_mask = cq_off[0], cq_off[1], cq_off[2]
+        self.cqes = cq_off[5]
+
+    def _u32(self, m, off):
+        return struct.unpack_from('<I', m, off)[0]
+
+    def _enter(self, to_submit, min_complete):
+
+        n = self.libc.syscall(ctypes.c_long(_SYS_io_uring_enter), ctypes.c_long(self.fd),
+                              ctypes.c_long(to_submit), ctypes.c_long(min_complete),
+                              ctypes.c_long(_IORING_ENTER_GETEVENTS), None, ctypes.c_long(0))
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EINTR, errno.EAGAIN, errno.EBUSY):
+                return 0
+            raise OSError(err, os.strerror(err))
+
+        return n
+
+    def run(self, ops):
+        """
+        Run `ops`, a list of `(opcode, fd, off, addr, len, op_flags)`, at most
+        `entries` of them, and return the result of every one in order.
+        Buffers referred to by `addr` must be kept alive by caller.
+        """
+
+        with self.lock:
+            return self._run(ops)
+
+    def _run(self, ops):
+
+        n = len(ops)
+        tail = self._u32(self.sq, self.sq_tail)
+        mask = self._u32(self.sq, self.sq_mask)
+
+        for i, (opcode, fd, off, addr, length, op_flags) in enumerate(ops):
+            idx = (tail + i) & mask
+            struct.pack_into(_SQE_FORMAT, self.sqes, idx * _SQE_SIZE,
+                             opcode, 0, 0, fd, off, addr, length, op_flags, i, 0, 0, 0, 0, 0)
+            struct.pack_into('<I', self.sq, self.sq_array + idx * 4, idx)
+
+        # Publish the entries after they are written.
+        struct.pack_into('<I', self.sq, self.sq_tail, (tail + n) & 0xffffffff)
+
+        results = [None] * n
+        submitted = 0
+        reaped = 0
+
+        while reaped < n:
+            submitted += self._enter(n - submitted, n - reaped)
+
+            head = self._u32(self.cq, self.cq_head)
+            cq_tail = self._u32(self.cq, self.cq_tail)
+            cq_mask = self._u32(self.cq, self.cq_mask)
+
+            while head != cq_tail:
+                user_data, res, _ = struct.unpack_from(
+                    _CQE_FORMAT, self.cq, self.cqes + (head & cq_mask) * _CQE_SIZE)
+                results[user_data] = res
+                reaped += 1
+                head = (head + 1) & 0xffffffff
+
+            struct.pack_into('<I', self.cq, self.cq_head, head)
+
+        return results
+
+    def close(self):
+        for m in (self.sq, self.cq, self.sqes):
+            m.close()
+        os.close(self.fd)
+
+
+_io_uring_lock = threading.Lock()
+_io_uring = None
+_io_uring_pid = None
+
+
+def _get_io_uring():
+
+    # One ring per process, shared by all threads. A ring inherited from the
+    # parent process is not usable in the child and is closed.
+    global _io_uring, _io_uring_pid
+
+    with _io_uring_lock:
+        if _io_uring is not None and _io_uring_pid != os.getpid():
+            _io_uring.close()
+            _io_uring = None
+
+        if _io_uring is None:
+            _io_uring = _IoUring(IO_URING_ENTRIES)
+            _io_uring_pid = os.getpid()
+
+        return _io_uring
+
+
+def _addr(buf):
+    # Keep the returned ctypes array alive as long as the address is in use.
+    arr = (ctypes.c_char * len(buf)).from_buffer(buf)
+    return arr, ctypes.addressof(arr)
+
+
+def _io_uring_error(onerror, func, path, res):
+    try:
+        raise OSError(-res, os.strerror(-res), path)
+    except OSError:
+        _on_error(onerror, func, path)
+
+
+def _io_uring_open(ring, paths, flags, onerror):
+
+    # Return a list of fd or None of every path.
+
+    keep = []
+    ops = []
+    for path in paths:
+        arr, addr = _addr(bytearray(os.fsencode(path) + b'\0'))
+        keep.append(arr)
+        ops.append((_IORING_OP_OPENAT, _AT_FDCWD, 0, addr, 0o666, flags | os.O_CLOEXEC))
+
+    fds = []
+    errs = []
+    for path, res in zip(paths, ring.run(ops)):
+        if res < 0:
+            fds.append(None)
+            errs.append((path, res))
+        else:
+            fds.append(res)
+
+    try:
+        for path, res in errs:
+            _io_uring_error(onerror, os.open, path, res)
+    except BaseException:
+        _io_uring_close(ring, fds, paths, 'ignore')
+        raise
+
+    return fds
+
+
+def _io_uring_close(ring, fds, paths, onerror):
+
+    opened = [(fd, path) for fd, path in zip(fds, paths) if fd is not None]
+    rsts = ring.run([(_IORING_OP_CLOSE, fd, 0, 0, 0, 0) for fd, _ in opened])
+
+    for (fd, path), res in zip(opened, rsts):
+        if res < 0:
+            _io_uring_error(onerror, os.close, path, res)
+
+
+def _io_uring_read(ring, paths, read_size, onerror):
+
+    fds = _io_uring_open(ring, paths, os.O_RDONLY, onerror)
+
+    try:
+        keep = []
+        ops = []
+        bufs = []
+        for fd in fds:
+            if fd is None:
+                continue
+            buf = bytearray(read_size)
+            arr, addr = _addr(buf)
+            keep.append(arr)
+            bufs.append(buf)
+            ops.append((_IORING_OP_READ, fd, 0, addr, read_size, 0))
+
+        rsts = iter(zip(bufs, ring.run(ops)))
+
+        conts = []
+        for path, fd in zip(paths, fds):
+            if fd is None:
+                conts.append(None)
+                continue
+
+            buf, res = next(rsts)
+            if res < 0:
+                conts.append(None)
+                _io_uring_error(onerror, os.read, path, res)
+                continue
+
+            if res < read_size:
+                conts.append(bytes(memoryview(buf)[:res]))
+                continue
+
+            # A file not smaller than read_size.
+            parts = [buf]
+            while True:
+                chunk = os.pread(fd, READ_BLOCK, res)
+                if not chunk:
+                    break
+                parts.append(chunk)
+                res += len(chunk)
+
+            conts.append(b''.join(parts))
+    finally:
+        _io_uring_close(ring, fds, paths, 'ignore')
+
+    return conts
+
+
+def _io_uring_write(ring, items, uid, gid, fsync, onerror):
+
+    paths = [path for path, _ in items]
+    fds = _io_uring_open(ring, paths, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, onerror)
+
+    closed = False
+    try:
+        keep = []
+        ops = []
+        todo = []
+        for (path, cont), fd in zip(items, fds):
+            if fd is None:
+                continue
+
+            if isinstance(cont, str):
+                cont = cont.encode(locale.getpreferredencoding(False))
+
+            try:
+                view = _byte_view(cont)
+            except TypeError:
+                # Chunks may share a buffer, copy each before pulling the next.
+                view = memoryview(b''.join([_byte_view(c).tobytes() for c in cont]))
+
+            buf = bytearray(view) if view.readonly else view
+            arr, addr = _addr(buf)
+            keep.append(arr)
+            todo.append((path, fd, buf))
+            ops.append((_IORING_OP_WRITE, fd, 0, addr, len(buf), 0))
+
+        failed = set()
+        for (path, fd, buf), res in zip(todo, ring.run(ops)):
+            try:
+                if res < 0:
+                    failed.add(fd)
+                    _io_uring_error(onerror, os.write, path, res)
+                    continue
+
+                # A short write, such as on a signal: write the rest.
+                while res < len(buf):
+                    res += os.pwrite(fd, buf[res:], res)
+
+                if uid is not None and gid is not None:
+                    os.fchown(fd, uid, gid)
+            except EnvironmentError:
+                failed.add(fd)
+                _on_error(onerror, os.write, path)
+
+        if fsync:
+            synced = [(path, fd) for path, fd, _ in todo if fd not in failed]
+            rsts = ring.run([(_IORING_OP_FSYNC, fd, 0, 0, 0, 0) for _, fd in synced])
+            for (path, fd), res in zip(synced, rsts):
+                if res < 0:
+                    _io_uring_error(onerror, os.fsync, path, res)
+
+        closed = True
+        _io_uring_close(ring, fds, paths, onerror)
+    finally:
+        if not closed:
+            _io_uring_close(ring, fds, paths, 'ignore')
+
+
+def remove(*paths, onerror=None, fast=False, concurrency=8, background=False, io_limit=None,
+           progress=None):
+    """
+    Recursively delete `path`, the `path` is *file*, *directory* or *symbolic link*.
+
+    Args:
+
+        paths:
+            is the path to remove.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.listdir*, *os.remove*, *os.rmdir*
+                or *os.path.isdir*.
+
+        fast(bool):
+            remove a directory tree with `os.scandir()` and `unlink()`
+            relative to an open directory fd, so that the kernel does not walk
+            the full path for every file. Sub directories are removed by a pool of
+            `concurrency` threads, without recursion, thus there is no limit on
+            the depth of the tree.
+            Symbolic links are never followed, including `path` itself.
+            With "raise", the first error stops the removal and is raised once
+            running threads finish. A callable `onerror` may be called from
+            worker threads, one call at a time.
+            If the platform does not support `dir_fd`, it is ignored.
+
+        concurrency(int):
+            is the number of threads removing a tree in `fast` mode.
+
+        background(bool):
+            atomically rename `path` into the trash dir `.k3fs_trash` at the
+            root of its mount point and return at once. The trash is purged in
+            `fast` mode by background threads, one tree at a time per thread.
+            If the trash dir can not be used, `path` is renamed to a hidden name
+            in its own dir instead.
+            Progress of all background removals is reported by
+            `get_remove_stats`.
+            Errors of `rename()` are handled by `onerror` in the calling thread,
+            with func *os.rename*. Trees left in the trash dir by an exited
+            process are purged, with "ignore", when the trash dir is used for
+            the first time by this process.
+
+        io_limit(IOLimiter):
+            limits the number of files and dirs removed per second in `fast` or
+            `background` mode. Every removed entry costs one.
+
+        progress(callable):
+            is called with the number of files and dirs removed, after every
+            dir, in `fast` mode. It may be called from worker threads, one call
+            at a time. An exception raised by it aborts the removal and is
+            raised.
+
+    Returns:
+        concurrent.futures.Future: in `background` mode, which is done when the
+        tree is purged. With "raise" it holds the first error. `None` otherwise.
+    """
+
+    path = os.path.join(*paths)
+
+    if onerror is None:
+        onerror = 'raise'
+
+    if background:
+        return _remove_background(path, onerror, io_limit)
+
+    if fast and _SUPPORT_DIR_FD:
+        return _remove_fast(path, onerror, concurrency, io_limit, progress)
+
+    try:
+        is_dir = os.path.isdir(path)
+    except os.error as e:
+        if onerror == 'raise':
+            raise e
+        elif onerror == 'ignore':
+            pass
+        else:
+            onerror(os.path.isdir, path, sys.exc_info())
+
+        return
+
+    if not is_dir:
+        try:
+            os.remove(path)
+        except os.error as e:
+            if onerror == 'raise':
+                raise e
+            elif onerror == 'ignore':
+                pass
+            else:
+                onerror(os.remove, path, sys.exc_info())
+        return
+
+    names = []
+    try:
+        names = os.listdir(path)
+    except os.error as e:
+        if onerror == 'raise':
+            raise e
+        elif onerror == 'ignore':
+            pass
+        else:
+            onerror(os.listdir, path, sys.exc_info())
+
+    for name in names:
+        fullname = os.path.join(path, name)
+        remove(fullname, onerror=onerror)
+
+    try:
+        os.rmdir(path)
+    except os.error as e:
+        if onerror == 'raise':
+            raise e
+        elif onerror == 'ignore':
+            pass
+        else:
+            onerror(os.rmdir, path, sys.exc_info())
+
+
+def _remove_background(path, onerror, io_limit):
+
+    name = '{base}.{pid}_{timestamp}_{rand}'.format(
+        base=os.path.basename(path),
+        pid=os.getpid(),
+        timestamp=int(time.time() * (1000 ** 3)),
+        rand=binascii.hexlify(os.urandom(4)).decode(),
+    )
+
+    # The dir of `path` but not `path` itself is resolved: `path` may be a
+    # symbolic link to remove.
+    parent = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+
+    try:
+        trash = os.path.join(get_mountpoint(parent), TRASH_DIR)
+        try:
+            os.mkdir(trash, 0o700)
+        except os.error as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        trash_path = os.path.join(trash, name)
+        os.rename(path, trash_path)
+
+        _trash_purger.scan(trash, io_limit)
+
+    except os.error:
+        # No permission on the mount point dir, or it is on another mount, e.g.,
+        # `path` is under a bind mount of a sub dir.
+        trash_path = os.path.join(parent, TRASH_DIR + '.' + name)
+        try:
+            os.rename(path, trash_path)
+        except os.error:
+            _on_error(onerror, os.rename, path)
+
+            fut = concurrent.futures.Future()
+            fut.set_result(None)
+            return fut
+
+    return _trash_purger.submit(trash_path, onerror, io_limit)
+
+
+class _TrashPurger(object):
+    """
+    Purges renamed trees with daemon threads, so that a process exits without
+    waiting for purging. The rest is left in trash, and is purged when the
+    trash is used next time by another process.
+    """
+
+    def __init__(self, concurrency=2):
+        self.concurrency = concurrency
+
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+
+        # Trash dirs scanned for trees left by exited processes.
+        self.scanned = set()
+
+        self.stats = {
+            'pending': 0,
+            'done': 0,
+            'failed': 0,
+            'removed': 0,
+        }
+
+    def submit(self, path, onerror, io_limit):
+
+        fut = concurrent.futures.Future()
+
+        with self.lock:
+            self._start()
+            self.stats['pending'] += 1
+
+        self.queue.put((fut, path, onerror, io_limit))
+
+        return fut
+
+    def scan(self, trash, io_limit):
+
+        # Purge trees left in `trash` by exited processes, once per process.
+        # Scanning is done by a purging thread.
+
+        with self.lock:
+            self._start()
+
+            if trash in self.scanned:
+                return
+            self.scanned.add(trash)
+
+        self.queue.put((None, trash, 'ignore', io_limit))
+
+    def _start(self):
+
+        # Threads do not survive fork.
+        if self.pid == os.getpid():
+            return
+
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.scanned = set()
+
+        for _ in range(self.concurrency):
+            th = threading.Thread(target=self._work, args=(self.queue,))
+            th.daemon = True
+            th.start()
+
+    def _scan(self, trash, io_limit):
+
+        try:
+            names = os.listdir(trash)
+        except os.error:
+            return
+
+        for name in names:
+            # A tree is named "<base>.<pid>_<timestamp>_<rand>". One of a
+            # running process is being purged by that process.
+            try:
+                pid = int(name.rsplit('.', 1)[-1].split('_')[0])
+            except ValueError:
+                continue
+
+            if pid == os.getpid() or psutil.pid_exists(pid):
+                continue
+
+            self.submit(os.path.join(trash, name), 'ignore', io_limit)
+
+    def add_removed(self, n):
+        with self.lock:
+            self.stats['removed'] += n
+
+    def _work(self, q):
+
+        while True:
+            fut, path, onerror, io_limit = q.get()
+
+            if fut is None:
+                self._scan(path, io_limit)
+                continue
+
+            # A cancelled removal is purged anyway: it is already in trash.
+            running = fut.set_running_or_notify_cancel()
+
+            err = None
+            try:
+                if _SUPPORT_DIR_FD:
+                    _remove_fast(path, onerror, 1, io_limit, self.add_removed)
+                else:
+                    remove(path, onerror=onerror)
+            except BaseException as e:
+                err = e
+
+            with self.lock:
+                self.stats['pending'] -= 1
+                if err is None:
+                    self.stats['done'] += 1
+                else:
+                    self.stats['failed'] += 1
+
+            if running:
+                if err is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(err)
+
+
+_trash_purger = _TrashPurger()
+
+
+def get_remove_stats():
+    """
+    Return the progress of all `remove(background=True)` of this process.
+
+    :return: a dictionary in the following format:
+    {
+        'pending': number of trees not yet purged,
+        'done':    number of trees purged,
+        'failed':  number of trees that failed with an error raised,
+        'removed': number of files and dirs removed,
+    }
+    """
+    with _trash_purger.lock:
+        return dict(_trash_purger.stats)
+
+
+def _remove_fast(path, onerror, concurrency, io_limit=None, on_removed=None):
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        try:
+            os.remove(path)
+        except os.error:
+            _on_error(onerror, os.remove, path)
+        else:
+            if on_removed is not None:
+                on_removed(1)
+        return
+
+    remover = _TreeRemover(onerror, io_limit, on_removed)
+    root = _RemovingDir(path, None)
+
+    # When stopped by an error, fds kept for sub dirs not opened yet are closed
+    # by `remover.close()`, once no thread uses them.
+
+    if concurrency <= 1:
+        # A stack: depth first keeps the number of pending dirs small.
+        dirs = [root]
+        try:
+            while len(dirs) > 0:
+                dirs.extend(remover.remove_entries(dirs.pop()))
+        finally:
+            remover.close()
+        return
+
+    q = queue.LifoQueue()
+    q.put(root)
+
+    threads = []
+    for _ in range(concurrency):
+        th = threading.Thread(target=_remove_worker, args=(remover, q))
+        th.daemon = True
+        th.start()
+        threads.append(th)
+
+    q.join()
+
+    for th in threads:
+        q.put(None)
+    for th in threads:
+        th.join()
+
+    remover.close()
+
+    if remover.error is not None:
+        raise remover.error
+
+
+def _remove_worker(remover, q):
+
+    while True:
+        d = q.get()
+        if d is None:
+            return
+
+        try:
+            if remover.error is None:
+                for sub in remover.remove_entries(d):
+                    q.put(sub)
+        except BaseException as e:
+            remover.fail(e)
+        finally:
+            q.task_done()
+
+
+class _RemovingDir(object):
+
+    def __init__(self, path, parent):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.parent = parent
+
+        # (st_dev, st_ino), to check the dir found by ".." of a sub dir.
+        self.ident = None
+
+        # The dir is removed when its entries are removed and all of its
+        # sub dirs are removed.
+        self.pending = 1
+
+        # The fd is kept open until all of its sub dirs are opened relative to
+        # it.
+        self.fd = None
+        self.unopened = 0
+
+
+_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+
+
+class _TreeRemover(object):
+    """
+    Removes entries of a dir with fd relative `unlink()`, and removes a dir
+    when its last sub dir is removed.
+
+    A sub dir is opened relative to the fd of its parent, and a dir is removed
+    relative to the fd of its parent found by "..", so that the path is never
+    walked again and a path component swapped with a symbolic link is never
+    followed.
+    """
+
+    def __init__(self, onerror, io_limit=None, on_removed=None):
+        self.lock = threading.Lock()
+        self.error = None
+        self.io_limit = io_limit
+
+        # Dirs whose fd is kept open for their sub dirs.
+        self.holding = set()
+
+        if on_removed is not None:
+            on_removed = self._serialize(on_removed)
+        self.on_removed = on_removed
+
+        if callable(onerror):
+            onerror = self._serialize(onerror)
+        self.onerror = onerror
+
+    def _serialize(self, func):
+
+        def _func(*args):
+            with self.lock:
+                func(*args)
+
+        return _func
+
+    def fail(self, e):
+        with self.lock:
+            if self.error is None:
+                self.error = e
+
+    def remove_entries(self, d):
+        """
+        Remove non-dir entries of `d` and return its sub dirs.
+        """
+
+        subs = []
+        removed = 0
+
+        try:
+            fd = self._open(d)
+        except os.error:
+            self._unreadable(d)
+            return subs
+
+        try:
+            try:
+                with os.scandir(fd) as it:
+                    entries = list(it)
+            except os.error:
+                _on_error(self.onerror, os.listdir, d.path)
+                entries = []
+
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except os.error:
+                    is_dir = False
+
+                if is_dir:
+                    subs.append(_RemovingDir(os.path.join(d.path, entry.name), d))
+                    continue
+
+                if self.io_limit is not None:
+                    self.io_limit.consume(1)
+
+                try:
+                    os.unlink(entry.name, dir_fd=fd)
+                except os.error:
+                    _on_error(self.onerror, os.remove, os.path.join(d.path, entry.name))
+                else:
+                    removed += 1
+
+            if self.on_removed is not None and removed > 0:
+                self.on_removed(removed)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        if len(subs) > 0:
+            with self.lock:
+                d.pending += len(subs)
+                d.unopened = len(subs)
+                d.fd = fd
+                self.holding.add(d)
+            fd = None
+
+        self._done(d, fd)
+
+        return subs
+
+    def _open(self, d):
+
+        # If it fails, the fd of the parent is kept for `_unreadable()`.
+
+        if d.parent is None:
+            fd = os.open(d.path, _DIR_FLAGS)
+        else:
+            fd = os.open(d.name, _DIR_FLAGS, dir_fd=d.parent.fd)
+
+        try:
+            st = os.fstat(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        d.ident = (st.st_dev, st.st_ino)
+
+        if d.parent is not None:
+            self._release(d.parent)
+
+        return fd
+
+    def _release(self, d):
+
+        # A sub dir of `d` is opened.
+        with self.lock:
+            d.unopened -= 1
+            if d.unopened > 0:
+                return
+            fd, d.fd = d.fd, None
+            self.holding.discard(d)
+
+        os.close(fd)
+
+    def close(self):
+
+        # Close fds kept for sub dirs those are not going to be opened, after
+        # all workers stopped.
+        with self.lock:
+            holding, self.holding = self.holding, set()
+
+        for d in holding:
+            os.close(d.fd)
+            d.fd = None
+
+    def _unreadable(self, d):
+
+        # `d` can not be opened. It is removed if it is an empty dir.
+
+        if d.parent is None:
+            try:
+                _on_error(self.onerror, os.listdir, d.path)
+            finally:
+                self._done(d, None)
+            return
+
+        pfd = None
+        try:
+            _on_error(self.onerror, os.listdir, d.path)
+            self._rmdir(d, d.parent.fd)
+            pfd = os.dup(d.parent.fd)
+        finally:
+            self._release(d.parent)
+
+        self._done(d.parent, pfd)
+
+    def _done(self, d, fd):
+
+        # Remove `d` and then its ancestors whose last sub dir is `d`. `fd` is
+        # the fd of `d` or `None`, and is closed.
+
+        while d is not None:
+
+            try:
+                with self.lock:
+                    d.pending -= 1
+                    if d.pending > 0:
+                        return
+
+                if d.parent is None:
+                    self._rmdir(d, None)
+                    return
+
+                pfd = self._open_parent(d, fd)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+            try:
+                self._rmdir(d, pfd)
+            except BaseException:
+                os.close(pfd)
+                raise
+
+            d, fd = d.parent, pfd
+
+    def _open_parent(self, d, fd):
+
+        try:
+            if fd is None:
+                raise OSError(errno.EBADF, os.strerror(errno.EBADF), d.path)
+
+            pfd = os.open('..', _DIR_FLAGS, dir_fd=fd)
+            try:
+                st = os.fstat(pfd)
+                if (st.st_dev, st.st_ino) != d.parent.ident:
+                    # `d` is moved out of its parent.
+                    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), d.path)
+            except BaseException:
+                os.close(pfd)
+                raise
+        except os.error:
+            _on_error(self.onerror, os.rmdir, d.path)
+            return None
+
+        return pfd
+
+    def _rmdir(self, d, pfd):
+
+        if d.parent is not None and pfd is None:
+            return
+
+        if self.io_limit is not None:
+            self.io_limit.consume(1)
+
+        try:
+            if pfd is None:
+                os.rmdir(d.path)
+            else:
+                os.rmdir(d.name, dir_fd=pfd)
+        except os.error:
+            _on_error(self.onerror, os.rmdir, d.path)
+        else:
+            if self.on_removed is not None:
+                self.on_removed(1)
+
+
+def calc_checksums(path, sha1=False, md5=False, crc32=False, sha256=False,
+                   block_size=READ_BLOCK, io_limit=READ_BLOCK, parallel=False,
+                   offset=0, length=None, chunk_size=None, checkpoint=None,
+                   use_mmap=False, cache=None, algorithms=None, progress=None):
+    """
+    Calculate checksums of the content of file `path`.
+
+    Args:
+
+        path(str):
+            is the path of the file.
+
+        sha1, md5, crc32, sha256(bool):
+            specify which checksums to calculate.
+
+        algorithms(list):
+            are names of more checksums to calculate, such as
+            `['blake2b', 'sha512']`. A name is one added by `register_hasher`,
+            `crc32c` if the `crc32c` package is installed, `xxh32`, `xxh64`,
+            `xxh3_64` or `xxh3_128` if the `xxhash` package is installed, or
+            any in `hashlib.algorithms_available` except `shake_*`.
+            An unknown name raises `FSUtilError`.
+
+        block_size(int):
+            is the size in byte to read in one `readinto()`.
+            Read buffers are taken from a process wide pool and reused by later
+            calls with the same `block_size`. The pool keeps at most 64 MiB of
+            free buffers.
+
+        io_limit(int or IOLimiter):
+            is the max bytes to read per second. A negative value means no limit.
+            The time spent on every block is at least `block_size / io_limit`.
+
+            An `IOLimiter` instance is charged for every byte read instead, and
+            can be shared with other calls to limit their total rate.
+
+        parallel(bool):
+            calculate every checksum in its own thread.
+            `hashlib` and `zlib` release the GIL on large buffers, thus with
+            several checksums enabled it takes about as long as the slowest one.
+            The next block is read while the current one is being hashed, with
+            three rotating read buffers.
+            Without it a block is read only after the previous one is hashed:
+            reading and hashing do not overlap. Use `parallel=True` to overlap
+            them even with a single checksum.
+
+        offset(int):
+            is the position in the file to start from.
+
+        length(int):
+            is the max number of bytes to checksum. By default it is `None`,
+            to checksum until the end of file.
+
+        chunk_size(int):
+            also calculate checksums of every `chunk_size` bytes since `offset`.
+            The result then has a `"chunks"` list, every element of which is a
+            dict in the same format as the result, plus the `"offset"` and
+            `"size"` of the chunk.
+            Every enabled checksum is calculated twice: for the whole range and
+            for the chunks.
+
+        checkpoint(callable):
+            is called with every chunk dict in order, as soon as all of its
+            checksums are done. Save the last one to resume an interrupted scrub
+            with `offset=chunk["offset"] + chunk["size"]`.
+            The whole range checksums of a resumed call covers only the bytes
+            since the new `offset`: `hashlib` states can not be saved.
+
+        use_mmap(bool):
+            hash views of a read-only `mmap` of the file instead of reading
+            into buffers, saving a copy from the page cache to user space.
+            The kernel is advised to read ahead sequentially, and to prefetch
+            the next block while the current one is being hashed.
+            Then `block_size` is the size of every view.
+            Accessing a page beyond the end of a file kills the process with
+            `SIGBUS`. The size of the file is checked before every block, and
+            hashing stops at the end of a truncated file, but a truncation
+            while a block is being hashed is fatal. Do not use it on files
+            other processes may truncate.
+
+        cache(ChecksumCache):
+            look up checksums of the whole file in `cache` first, calculate
+            only the missing ones and save them to `cache`.
+            It is not used with `offset`, `length` or `chunk_size`.
+
+        progress(callable):
+            is called with the number of bytes hashed after every block.
+            An exception raised by it aborts the calculation and is raised.
+
+    Returns:
+        dict: of checksum name to hex string, or to `None` if not enabled.
+    """
+
+    names = _checksum_names(sha1, md5, crc32, sha256, algorithms)
+    checksums = _new_checksums(names)
+
+    if chunk_size is not None:
+        checksums['chunks'] = []
+
+    if len(names) == 0:
+        return checksums
+
+    if block_size <= 0:
+        raise FSUtilError('block_size must be positive integer')
+
+    if not isinstance(io_limit, IOLimiter) and io_limit == 0:
+        raise FSUtilError('io_limit shoud not be zero')
+
+    if offset < 0:
+        raise FSUtilError('offset must not be negative')
+
+    if length is not None and length < 0:
+        raise FSUtilError('length must not be negative')
+
+    if chunk_size is not None and chunk_size <= 0:
+        raise FSUtilError('chunk_size must be positive integer')
+
+    if offset != 0 or length is not None or chunk_size is not None:
+        cache = None
+
+    if cache is not None:
+        st = os.stat(path)
+        cached = cache.get(st, names)
+        checksums.update(cached)
+
+        names = [name for name in names if name not in cached]
+        if len(names) == 0:
+            return checksums
+
+    hashers = dict([(name, _hasher_factory(name)()) for name in names])
+    all_hashers = list(hashers.values())
+
+    chunk_hashers = []
+    if chunk_size is not None:
+        chunks = _Chunks(names, offset, chunk_size, checkpoint)
+        chunk_hashers = [_ChunkHasher(name, chunk_size, chunks) for name in names]
+        all_hashers.extend(chunk_hashers)
+
+    if progress is not None:
+        all_hashers.append(_ProgressHasher(progress))
+
+    if use_mmap:
+        _update_mmap(all_hashers, path, block_size, io_limit, offset, length, parallel)
+    else:
+        _update_read(all_hashers, path, block_size, io_limit, offset, length, parallel)
+
+    for name, h in hashers.items():
+        checksums[name] = h.hexdigest()
+
+    for h in chunk_hashers:
+        h.flush()
+
+    if chunk_size is not None:
+        checksums['chunks'] = chunks.chunks
+
+    if cache is not None:
+        # Do not save checksums of a file modified while being hashed.
+        st_after = os.stat(path)
+        if _file_version(st_after) == _file_version(st):
+            cache.put(st, dict([(name, checksums[name]) for name in names]))
+
+    return checksums
+
+
+def calc_checksums_tree(root, concurrency=4, per_device=2, large_size=64 * 1024 ** 2,
+                        processes=False, onerror=None, **kwargs):
+    """
+    Calculate checksums of every regular file in the directory tree `root`,
+    with a pool of workers. Symbolic links are not followed.
+
+    Files are scheduled per device: one slow disk occupies at most
+    `per_device` workers. Files not smaller than `large_size` occupy at most
+    half of the workers, so that small files keep flowing while large files are
+    being hashed.
+
+    Args:
+
+        root(str):
+            is the directory to scan.
+
+        concurrency(int):
+            is the number of workers.
+
+        per_device(int):
+            is the max number of files being hashed on one device, as returned
+            by `get_device`.
+
+        large_size(int):
+            is the size in byte from which a file is considered large.
+
+        processes(bool):
+            use a pool of processes instead of threads, for CPU bound hashing.
+            Then arguments passed to `calc_checksums` must be picklable, thus an
+            `IOLimiter` can not be used.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.scandir*, *os.lstat* or
+                *calc_checksums*.
+
+        kwargs:
+            are passed to `calc_checksums`, such as `sha1=True`.
+
+    Returns:
+        generator: of `(path, checksums)`, in the order files are done.
+    """
+
+    if onerror is None:
+        onerror = 'raise'
+
+    if concurrency <= 0 or per_device <= 0:
+        raise FSUtilError('concurrency and per_device must be positive')
+
+    # Validate above at call time, not at the first next() of the generator.
+    return _iter_checksums_tree(root, concurrency, per_device, large_size, processes,
+                                onerror, kwargs)
+
+
+def _iter_checksums_tree(root, concurrency, per_device, large_size, processes, onerror,
+                         kwargs):
+
+    files = _iter_tree_files(root, onerror)
+    devices = _Devices()
+
+    # device -> (small files, large files)
+    queues = collections.OrderedDict()
+    queued = 0
+
+    if processes:
+        pool = concurrent.futures.ProcessPoolExecutor(concurrency)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    large_cap = max(1, concurrency // 2)
+
+    # future -> (path, device, is_large)
+    running = {}
+    running_by_dev = collections.defaultdict(int)
+    running_large = 0
+
+    try:
+        while True:
+
+            # Scan ahead a bounded number of files, so that hashing starts at
+            # once and memory does not grow with the tree.
+            while files is not None and queued < concurrency * _SCAN_AHEAD:
+                try:
+                    path, size, dev = next(files)
+                except StopIteration:
+                    files = None
+                    break
+
+                device = devices.get(dev, path)
+                small, large = queues.setdefault(device, (collections.deque(), collections.deque()))
+                if size < large_size:
+                    small.append(path)
+                else:
+                    large.append(path)
+                queued += 1
+
+            submitted = True
+            while submitted and len(running) < concurrency:
+                submitted = False
+
+                for device, (small, large) in queues.items():
+
+                    if len(running) >= concurrency:
+                        break
+
+                    if running_by_dev[device] >= per_device:
+                        continue
+
+                    if len(small) > 0:
+                        path, is_large = small.popleft(), False
+                    elif len(large) > 0 and running_large < large_cap:
+                        path, is_large = large.popleft(), True
+                    else:
+                        continue
+
+                    fut = pool.submit(calc_checksums, path, **kwargs)
+                    queued -= 1
+                    running[fut] = (path, device, is_large)
+                    running_by_dev[device] += 1
+                    running_large += is_large
+                    submitted = True
+
+            if len(running) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(running,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for fut in done:
+                path, device, is_large = running.pop(fut)
+                running_by_dev[device] -= 1
+                running_large -= is_large
+
+                try:
+                    checksums = fut.result()
+                except EnvironmentError:
+                    _on_error(onerror, calc_checksums, path)
+                    continue
+
+                yield path, checksums
+    finally:
+        for fut in running:
+            fut.cancel()
+        pool.shutdown(wait=True)
+
+
+# Number of files per worker scanned ahead of hashing or copying.
+_SCAN_AHEAD = 64
+
+
+class _Devices(object):
+    """
+    Maps `st_dev` to the device name returned by `get_device`, looking up the
+    mount table once per `st_dev`.
+    """
+
+    def __init__(self):
+        self.devices = {}
+
+    def get(self, dev, path):
+        device = self.devices.get(dev)
+        if device is None:
+            device = get_path_partitions([path])[path]['device']
+            self.devices[dev] = device
+
+        return device
+
+
+def _iter_tree_files(root, onerror):
+
+    # Yield (path, size, st_dev) of regular files under `root`.
+    # Iterative, thus a deep tree does not hit the recursion limit.
+
+    dirs = [root]
+
+    while len(dirs) > 0:
+        path = dirs.pop()
+
+        try:
+            entries = list(os.scandir(path))
+        except EnvironmentError:
+            _on_error(onerror, os.scandir, path)
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    yield entry.path, st.st_size, st.st_dev
+            except EnvironmentError:
+                _on_error(onerror, os.lstat, entry.path)
+
+
+def calc_fingerprint(path, samples=8, sample_size=64 * 1024, io_limit=None, algorithm=None):
+    """
+    Calculate a quick fingerprint of file `path` from its size and `samples`
+    ranges of `sample_size` bytes, spread evenly from the head to the tail,
+    with `blake2b`.
+    A file not larger than `samples * sample_size` is hashed entirely.
+
+    Files with different fingerprints have different content. Files with the
+    same fingerprint probably have the same content, and a full checksum by
+    `calc_checksums` tells for sure.
+
+    Args:
+
+        path(str):
+            is the path of the file.
+
+        samples(int):
+            is the number of ranges to read, at least 2: the head and the tail.
+
+        sample_size(int):
+            is the size in byte of every range.
+
+        io_limit(int or IOLimiter):
+            limits the read rate, as `calc_checksums` does. By default it is
+            `None`, no limit.
+
+        algorithm(str):
+            is the name of the checksum algorithm to use, as
+            `calc_checksums(algorithms=)` accepts, such as a fast `xxh3_128`.
+            By default it is a 128 bit `blake2b`.
+
+    Returns:
+        str: of the hex fingerprint.
+    """
+
+    if samples < 2:
+        raise FSUtilError('samples must be at least 2')
+
+    if sample_size <= 0:
+        raise FSUtilError('sample_size must be positive integer')
+
+    if algorithm is None:
+        h = hashlib.blake2b(digest_size=16)
+    else:
+        h = _hasher_factory(algorithm)()
+
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode() + b'\n')
+
+        if size <= samples * sample_size:
+            offsets = range(0, size, sample_size)
+        else:
+            offsets = [i * (size - sample_size) // (samples - 1) for i in range(samples)]
+
+        buf = _buffer_pool.get(sample_size)
+        try:
+            view = memoryview(buf)
+            for offset in offsets:
+                t0 = time.time()
+
+                f.seek(offset)
+                n = f.readinto(view)
+                _throttle(io_limit, sample_size, t0, n)
+
+                h.update(view[:n])
+        finally:
+            _buffer_pool.put(buf)
+
+    return h.hexdigest()
+
+
+def find_duplicates(paths, samples=8, sample_size=64 * 1024, io_limit=None, onerror=None):
+    """
+    Find files with the same content among `paths`.
+
+    Files are compared by size first, then files of the same size by
+    `calc_fingerprint`, and only files of the same fingerprint are read
+    entirely for their `sha1`. Thus files those differ are mostly ruled out by
+    reading a few samples.
+
+    Args:
+
+        paths:
+            is an iterable of file paths.
+
+        samples, sample_size(int):
+            are passed to `calc_fingerprint`.
+
+        io_limit(int or IOLimiter):
+            limits the read rate, as `calc_checksums` does.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.stat*, *calc_fingerprint* or
+                *calc_checksums*.
+
+    Returns:
+        list: of lists of paths with the same content, in the order of
+        `paths`. Every list has at least two paths.
+    """
+
+    if onerror is None:
+        onerror = 'raise'
+
+    paths = list(collections.OrderedDict.fromkeys(paths))
+
+    def _group(groups, func, key):
+
+        # Split every group by `key` of its paths into (key, paths) and drop
+        # singletons.
+        rst = []
+        for group in groups:
+            by_key = collections.OrderedDict()
+            for path in group:
+                try:
+                    k = key(path)
+                except EnvironmentError:
+                    _on_error(onerror, func, path)
+                    continue
+
+                by_key.setdefault(k, []).append(path)
+
+            rst.extend([(k, g) for k, g in by_key.items() if len(g) > 1])
+
+        return rst
+
+    rst = []
+    small = []
+    large = []
+    for size, group in _group([paths], os.stat, os.path.getsize):
+
+        # All empty files are the same.
+        if size == 0:
+            rst.append(group)
+        # A fingerprint of a small file is a hash of the entire content.
+        elif size <= samples * sample_size:
+            small.append(group)
+        else:
+            large.append(group)
+
+    def fingerprint(p):
+        return calc_fingerprint(p, samples, sample_size, io_limit)
+
+    def sha1(p):
+        return calc_checksums(p, sha1=True, io_limit=io_limit)['sha1']
+
+    rst.extend([g for _, g in _group(small, calc_fingerprint, fingerprint)])
+
+    large = [g for _, g in _group(large, calc_fingerprint, fingerprint)]
+    rst.extend([g for _, g in _group(large, calc_checksums, sha1)])
+
+    order = {}
+    for i, path in enumerate(paths):
+        order.setdefault(path, i)
+
+    rst.sort(key=lambda g: order[g[0]])
+
+    return rst
+
+
+def sync_tree(src, dst, checksum=False, dry_run=False, concurrency=4, per_device=2,
+              io_limit=None, onerror=None, **kwargs):
+    """
+    Make the directory tree `dst` have the same files as `src`, by copying only
+    the files those are missing or changed in `dst`, with a pool of threads.
+    Files in `dst` but not in `src` are left as is.
+
+    Sub dirs are found with `iter_dirs` and made with `makedirs`. Symbolic
+    links to dirs are not descended into. A symbolic link to a file is copied
+    as a file.
+
+    A file is considered unchanged if the file in `dst` has the same size and
+    modification time, which are copied with `copy_file(keep_stat=True)`.
+
+    Args:
+
+        src(str):
+            is the directory to copy from.
+
+        dst(str):
+            is the directory to copy to.
+
+        checksum(bool):
+            compare files of the same size by their `sha1` calculated by
+            `calc_checksums`, instead of the modification time. Files with
+            different `calc_fingerprint` are not read entirely.
+
+        dry_run(bool):
+            do not make dirs or copy files, only report what would be done.
+
+        concurrency(int):
+            is the number of threads.
+
+        per_device(int):
+            is the max number of files being compared or copied on one
+            device, as returned by `get_device`. A file occupies both the
+            device of its source and that of `dst`.
+
+        io_limit(int or IOLimiter):
+            limits copying and reading for checksums, as `copy_file` does.
+
+        onerror(str or callable):
+            - "raise": when error occur it raises the original error.
+            - "ignore": ignore error and go on.
+            - A callable:
+                it is called to handle the error with arguments `(func, path,
+                exc_info)` where func is *os.scandir*, *os.stat*, *makedirs* or
+                *copy_file*.
+
+        kwargs:
+            are passed to `copy_file`, such as `uid`. `atomic` is `True` by
+            default.
+
+    Returns:
+        generator: of event dicts, in the order things are done:
+        `{'action': 'mkdir', 'path': 'foo', 'size': 0}`, or
+        `{'action': 'copy' or 'skip', 'path': 'foo/bar', 'size': 3}`,
+        where `path` is relative to `src` and `dst`.
+    """
+
+    if onerror is None:
+        onerror = 'raise'
+
+    if concurrency <= 0 or per_device <= 0:
+        raise FSUtilError('concurrency and per_device must be positive')
+
+    kwargs.setdefault('atomic', True)
+
+    # Validate above and look up dst at call time, not at the first next() of
+    # the generator.
+    dst_device = get_device(dst)
+
+    return _sync_tree(src, dst, dst_device, checksum, dry_run, concurrency, per_device,
+                      io_limit, onerror, kwargs)
+
+
+def _sync_tree(src, dst, dst_device, checksum, dry_run, concurrency, per_device, io_limit,
+               onerror, kwargs):
+
+    items = _iter_sync_tree(src, dst, dry_run, onerror)
+    devices = _Devices()
+
+    queues = collections.OrderedDict()
+    queued = 0
+
+    pool = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    # future -> (path, size, devices)
+    running = {}
+    running_by_dev = collections.defaultdict(int)
+
+    try:
+        while True:
+
+            # Scan ahead a bounded number of files, so that copying starts at
+            # once and memory does not grow with the tree.
+            while items is not None and queued < concurrency * _SCAN_AHEAD:
+                try:
+                    action, path, size, dev = next(items)
+                except StopIteration:
+                    items = None
+                    break
+
+                if action == 'mkdir':
+                    yield {'action': action, 'path': path, 'size': size}
+                    continue
+
+                device = devices.get(dev, os.path.join(src, path))
+                queues.setdefault(device, collections.deque()).append((path, size))
+                queued += 1
+
+            for device, q in queues.items():
+
+                if len(running) >= concurrency:
+                    break
 
-            By default they are `None`, which means the file that has been written
-            inheirts ownership of the running python script.
+                devs = set([device, dst_device])
 
-        atomic(bool):
-            atomically write fcont to the path.
+                while (len(q) > 0 and len(running) < concurrency
+                       and all(running_by_dev[d] < per_device for d in devs)):
 
-            Write fcont to a temporary file, then rename to the path.
-            The temporary file names of same path in one process distinguish with
-            nanosecond, it is not atomic if the temporary files of same path
-            created at the same nanosecond.
-            The renaming will be an atomic operation (this is a POSIX requirement).
+                    path, size = q.popleft()
+                    fut = pool.submit(_sync_file, os.path.join(src, path), os.path.join(dst, path),
+                                      checksum, dry_run, io_limit, kwargs)
+                    queued -= 1
+                    running[fut] = (path, size, devs)
+                    for d in devs:
+                        running_by_dev[d] += 1
 
-        fsync(bool):
-            specify if need to synchronize data to storage device.
+            if len(running) == 0:
+                break
 
-    """
+            done, _ = concurrent.futures.wait(running,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
 
-    fcont = paths_content[-1]
-    path = os.path.join(*paths_content[:-1])
-    if not atomic:
-        return _write_file(path, fcont, uid, gid, fsync)
+            for fut in done:
+                path, size, devs = running.pop(fut)
+                for d in devs:
+                    running_by_dev[d] -= 1
 
-    tmp_path = '{path}._tmp_.{pid}_{timestamp}'.format(
-        path=path,
-        pid=os.getpid(),
-        timestamp=int(time.time() * (1000 ** 3)),
-    )
-    _write_file(tmp_path, fcont, uid, gid, fsync)
+                try:
+                    action = fut.result()
+                except EnvironmentError:
+                    _on_error(onerror, copy_file, os.path.join(src, path))
+                    continue
+
+                yield {'action': action, 'path': path, 'size': size}
+    finally:
+        for fut in running:
+            fut.cancel()
+        pool.shutdown(wait=True)
+
+
+def _iter_sync_tree(src, dst, dry_run, onerror):
+
+    # Make dirs of `dst` and yield ("mkdir", rel path, 0, None) for them, and
+    # yield ("file", rel path, size, st_dev) for files of `src`, dir by dir.
+
+    dirs = ['']
+
+    while len(dirs) > 0:
+        rel = dirs.pop()
+        src_dir = os.path.join(src, rel)
+        dst_dir = os.path.join(dst, rel)
+
+        try:
+            subs = list(iter_dirs(src_dir))
+            names = list(iter_files(src_dir))
+        except EnvironmentError:
+            _on_error(onerror, os.scandir, src_dir)
+            continue
+
+        if not os.path.isdir(dst_dir):
+            if not dry_run:
+                try:
+                    makedirs(dst_dir)
+                except EnvironmentError:
+                    _on_error(onerror, makedirs, dst_dir)
+                    continue
+
+            yield 'mkdir', rel, 0, None
+
+        for name in sorted(subs, reverse=True):
+            if not os.path.islink(os.path.join(src_dir, name)):
+                dirs.append(os.path.join(rel, name))
+
+        for name in sorted(names):
+            path = os.path.join(rel, name)
+            try:
+                st = os.stat(os.path.join(src, path))
+            except EnvironmentError:
+                _on_error(onerror, os.stat, os.path.join(src, path))
+                continue
+
+            yield 'file', path, st.st_size, st.st_dev
+
+
+def _sync_file(src, dst, checksum, dry_run, io_limit, copy_kwargs):
+
+    if not _file_changed(src, dst, checksum, io_limit):
+        return 'skip'
+
+    if not dry_run:
+        copy_file(src, dst, io_limit=io_limit, keep_stat=True, **copy_kwargs)
+
+    return 'copy'
+
+
+def _file_changed(src, dst, checksum, io_limit):
 
     try:
-        os.rename(tmp_path, path)
-    except EnvironmentError:
-        os.remove(tmp_path)
+        dst_st = os.stat(dst)
+    except EnvironmentError as e:
+        if e.errno == errno.ENOENT:
+            return True
         raise
 
+    src_st = os.stat(src)
 
-def _write_file(path, fcont, uid=None, gid=None, fsync=True):
+    if src_st.st_size != dst_st.st_size:
+        return True
 
-    uid = uid or k3confloader.conf.uid
-    gid = gid or k3confloader.conf.gid
+    if not checksum:
+        return src_st.st_mtime_ns != dst_st.st_mtime_ns
 
-    with open(path, 'w') as f:
-        f.write(fcont)
-        f.flush()
-        if fsync:
-            os.fsync(f.fileno())
+    if calc_fingerprint(src, io_limit=io_limit) != calc_fingerprint(dst, io_limit=io_limit):
+        return True
 
-    if uid is not None and gid is not None:
-        os.chown(path, uid, gid)
+    return (calc_checksums(src, sha1=True, io_limit=io_limit)
+            != calc_checksums(dst, sha1=True, io_limit=io_limit))
 
 
-def remove(*paths, onerror=None):
-    """
-    Recursively delete `path`, the `path` is *file*, *directory* or *symbolic link*.
+def _file_version(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
 
-    Args:
 
-        paths:
-            is the path to remove.
+def _on_error(onerror, func, path):
 
-        onerror(str or callable):
-            - "raise": when error occur it raises the original error.
-            - "ignore": ignore error and go on.
-            - A callable:
-                it is called to handle the error with arguments `(func, path,
-                exc_info)` where func is *os.listdir*, *os.remove*, *os.rmdir*
-                or *os.path.isdir*.
-    """
+    # Handle the error being handled by the calling `except` clause, in the
+    # way `remove(onerror=)` does.
 
-    path = os.path.join(*paths)
+    exc_info = sys.exc_info()
 
-    if onerror is None:
-        onerror = 'raise'
+    if onerror == 'raise':
+        raise exc_info[1]
+    elif onerror == 'ignore':
+        pass
+    else:
+        onerror(func, path, exc_info)
 
-    try:
-        is_dir = os.path.isdir(path)
-    except os.error as e:
-        if onerror == 'raise':
-            raise e
-        elif onerror == 'ignore':
-            pass
-        else:
-            onerror(os.path.isdir, path, sys.exc_info())
 
-        return
+def _checksum_names(sha1, md5, crc32, sha256, algorithms=None):
 
-    if not is_dir:
-        try:
-            os.remove(path)
-        except os.error as e:
-            if onerror == 'raise':
-                raise e
-            elif onerror == 'ignore':
-                pass
-            else:
-                onerror(os.remove, path, sys.exc_info())
-        return
+    names = [name for name, enabled in (('sha1', sha1),
+                                        ('md5', md5),
+                                        ('crc32', crc32),
+                                        ('sha256', sha256))
+             if enabled]
 
-    names = []
-    try:
-        names = os.listdir(path)
-    except os.error as e:
-        if onerror == 'raise':
-            raise e
-        elif onerror == 'ignore':
-            pass
-        else:
-            onerror(os.listdir, path, sys.exc_info())
+    for name in algorithms or ():
+        if name not in names:
+            names.append(name)
 
     for name in names:
-        fullname = os.path.join(path, name)
-        remove(fullname, onerror=onerror)
+        _hasher_factory(name)
 
-    try:
-        os.rmdir(path)
-    except os.error as e:
-        if onerror == 'raise':
-            raise e
-        elif onerror == 'ignore':
-            pass
-        else:
-            onerror(os.rmdir, path, sys.exc_info())
+    return names
 
-def calc_checksums(path, sha1=False, md5=False, crc32=False, sha256=False,
-                   block_size=READ_BLOCK, io_limit=READ_BLOCK):
 
+def _new_checksums(names=()):
+
+    # The four classic names are always present, for compatibility.
     checksums = {
         'sha1': None,
         'md5': None,
         'crc32': None,
         'sha256': None
     }
+    for name in names:
+        checksums[name] = None
 
-    if (sha1 or md5 or crc32 or sha256) is False:
-        return checksums
+    return checksums
 
-    if block_size <= 0:
-        raise FSUtilError('block_size must be positive integer')
 
-    if io_limit == 0:
-        raise FSUtilError('io_limit shoud not be zero')
+class _Crc32(object):
+    """
+    crc32 with the `update()`/`hexdigest()` interface of `hashlib` objects.
+    """
 
-    min_io_time = float(block_size) / io_limit
+    def __init__(self):
+        self.crc = 0
 
-    sum_sha1 = hashlib.sha1()
-    sum_md5 = hashlib.md5()
-    sum_crc32 = 0
-    sum_sha256 = hashlib.sha256()
+    def update(self, buf):
+        self.crc = zlib.crc32(buf, self.crc)
 
-    with open(path, 'rb') as f_path:
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
 
-        while True:
+
+class _Crc32c(object):
+    """
+    crc32c(Castagnoli) by the optional `crc32c` package, which uses the SSE4.2
+    or ARMv8 crc instruction.
+    """
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, buf):
+        self.crc = crc32c.crc32c(buf, self.crc)
+
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
+
+
+_hashers = {
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+    'crc32': _Crc32,
+    'sha256': hashlib.sha256,
+}
+
+if crc32c is not None:
+    _hashers['crc32c'] = _Crc32c
+
+if xxhash is not None:
+    for _name in ('xxh32', 'xxh64', 'xxh3_64', 'xxh3_128'):
+        if hasattr(xxhash, _name):
+            _hashers[_name] = getattr(xxhash, _name)
+
+
+def register_hasher(name, factory):
+    """
+    Add a checksum algorithm for `calc_checksums(algorithms=[name])` and
+    others accepting `algorithms`, or replace an existent one.
+
+    :param name: is the name of the algorithm, which is also the key of its
+    checksum in results.
+    :param factory: is a callable that returns a new hasher object, with
+    `update(buf)` and `hexdigest()` methods like `hashlib` objects have.
+    `buf` may be a `memoryview`.
+    :return: Nothing
+    """
+    _hashers[name] = factory
+
+
+def _hasher_factory(name):
+
+    factory = _hashers.get(name)
+    if factory is not None:
+        return factory
+
+    # shake_* require a length for hexdigest().
+    if name in hashlib.algorithms_available and not name.startswith('shake_'):
+        return functools.partial(hashlib.new, name)
+
+    raise FSUtilError('unknown checksum algorithm: {name}'.format(name=name))
+
+
+class _Chunks(object):
+    """
+    Collects checksums of chunks from `_ChunkHasher`s, which may run in
+    different threads, and reports a chunk once all of its checksums are done.
+    """
+
+    def __init__(self, names, offset, chunk_size, checkpoint):
+        self.lock = threading.Lock()
+        self.names = names
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.checkpoint = checkpoint
+
+        self.chunks = []
+        self.pending = []
+
+    def add(self, name, i, size, hexdigest):
+
+        with self.lock:
+            while len(self.chunks) <= i:
+                chunk = _new_checksums(self.names)
+                chunk['offset'] = self.offset + len(self.chunks) * self.chunk_size
+                chunk['size'] = size
+                self.chunks.append(chunk)
+                self.pending.append(len(self.names))
+
+            self.chunks[i][name] = hexdigest
+            self.pending[i] -= 1
+
+            # Every hasher finishes chunks in order, thus chunks are completed
+            # in order too.
+            if self.pending[i] == 0 and self.checkpoint is not None:
+                self.checkpoint(dict(self.chunks[i]))
+
+
+class _ChunkHasher(object):
+
+    def __init__(self, name, chunk_size, chunks):
+        self.name = name
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+
+        self.i = 0
+        self.size = 0
+        self.hasher = _hasher_factory(name)()
+
+    def update(self, buf):
+
+        while len(buf) > 0:
+            n = min(len(buf), self.chunk_size - self.size)
+
+            self.hasher.update(buf[:n])
+            self.size += n
+            buf = buf[n:]
+
+            if self.size == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+
+        if self.size == 0:
+            return
+
+        self.chunks.add(self.name, self.i, self.size, self.hasher.hexdigest())
+
+        self.i += 1
+        self.size = 0
+        self.hasher = _hasher_factory(self.name)()
+
+
+class _ProgressHasher(object):
+    """
+    Reports the bytes passed to it, as if it were a hasher.
+    """
+
+    def __init__(self, progress):
+        self.progress = progress
+
+    def update(self, buf):
+        self.progress(len(buf))
+
+
+# Max bytes of free read buffers kept for reuse.
+_BUFFER_POOL_BYTES = 64 * 1024 * 1024
+
+
+class _BufferPool(object):
+    """
+    Keeps freed read buffers for reuse, so that reading a large file does not
+    allocate, fault in and free a new block of memory for every block read.
+    At most `max_bytes` of free buffers are kept, the oldest are dropped first.
+    """
+
+    def __init__(self, max_bytes=_BUFFER_POOL_BYTES):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.free = []
+        self.free_bytes = 0
+
+    def get(self, size):
+        with self.lock:
+            for i, buf in enumerate(self.free):
+                if len(buf) == size:
+                    self.free_bytes -= size
+                    return self.free.pop(i)
+
+        return bytearray(size)
+
+    def put(self, buf):
+        if len(buf) > self.max_bytes:
+            return
+
+        with self.lock:
+            self.free.append(buf)
+            self.free_bytes += len(buf)
+            while self.free_bytes > self.max_bytes:
+                self.free_bytes -= len(self.free.pop(0))
+
+
+_buffer_pool = _BufferPool()
+
+
+def _read_blocks(f, bufs, io_limit, length=None):
+
+    # Fill `bufs` in turn with readinto() and yield a view of the filled part.
+    # A buffer is overwritten after `len(bufs) - 1` more blocks are yielded.
+    # Stop after `length` bytes if it is not None.
+
+    block_size = len(bufs[0])
+
+    i = 0
+    while True:
+        t0 = time.time()
+
+        buf = bufs[i % len(bufs)]
+        i += 1
+
+        if length is None:
+            n = f.readinto(buf)
+        elif length > 0:
+            n = f.readinto(memoryview(buf)[:length])
+            length -= n or 0
+        else:
+            break
+
+        if not n:
+            break
+
+        _throttle(io_limit, block_size, t0, n)
+
+        yield memoryview(buf)[:n]
+
+
+def _update_read(hashers, path, block_size, io_limit, offset, length, parallel):
+
+    # In parallel mode a hasher may be working on one block and have another
+    # queued while the next one is being read.
+    if parallel:
+        nbuf = 3
+    else:
+        nbuf = 1
+
+    bufs = [_buffer_pool.get(block_size) for _ in range(nbuf)]
+    try:
+        with open(path, 'rb', buffering=0) as f:
+
+            if offset > 0:
+                f.seek(offset)
+
+            blocks = _read_blocks(f, bufs, io_limit, length)
+            _update(hashers, blocks, parallel)
+    finally:
+        for buf in bufs:
+            _buffer_pool.put(buf)
+
+
+def _update_mmap(hashers, path, block_size, io_limit, offset, length, parallel):
+
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset >= size:
+            return
+
+        # mmap of an empty file is not allowed.
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            _madvise(mm, 'MADV_SEQUENTIAL', 0, size)
+
+            end = size
+            if length is not None:
+                end = min(size, offset + length)
+
+            blocks = _map_blocks(mm, f.fileno(), offset, end, block_size, io_limit)
+            _update(hashers, blocks, parallel)
+        finally:
+            try:
+                mm.close()
+            except BufferError:
+                # A view is still referenced, e.g., by the traceback of an
+                # error. The map is unmapped when the last view is garbage
+                # collected.
+                pass
+
+
+def _map_blocks(mm, fd, start, end, block_size, io_limit):
+
+    with memoryview(mm) as view:
+        for i in range(start, end, block_size):
             t0 = time.time()
 
-            buf = f_path.read(block_size)
-            if len(buf) == 0:
+            # Pages beyond the end of a file truncated meanwhile raise SIGBUS.
+            end = min(end, os.fstat(fd).st_size)
+            if i >= end:
+                return
+
+            n = min(block_size, end - i)
+            _madvise(mm, 'MADV_WILLNEED', i + n, min(block_size, end - i - n))
+
+            _throttle(io_limit, block_size, t0, n)
+
+            yield view[i:i + n]
+
+
+def _madvise(mm, advice, start, length):
+
+    # madvise() is available since python 3.8
+    if not hasattr(mm, 'madvise') or not hasattr(mmap, advice) or length <= 0:
+        return
+
+    # madvise(2) requires a page aligned start
+    aligned = start - start % mmap.PAGESIZE
+    mm.madvise(getattr(mmap, advice), aligned, length + start - aligned)
+
+
+def _update(hashers, blocks, parallel):
+    if parallel:
+        _update_parallel(hashers, blocks)
+    else:
+        for buf in blocks:
+            for h in hashers:
+                h.update(buf)
+
+
+def _throttle(io_limit, block_size, t0, n):
+
+    # Sleep after handling `n` bytes of a block started at `t0`.
+
+    if io_limit is None:
+        return
+
+    if isinstance(io_limit, IOLimiter):
+        io_limit.consume(n)
+        return
+
+    min_io_time = float(block_size) / io_limit
+
+    time_sleep = max(0, min_io_time - (time.time() - t0))
+    if time_sleep > 0:
+        time.sleep(time_sleep)
+
+
+def _update_parallel(hashers, blocks):
+
+    # Every hasher has its own thread and a queue of one block: the reader
+    # goes at most one block ahead of the slowest hasher. When the reader has
+    # queued block i to every hasher, all of them have finished block i-2, thus
+    # three rotating buffers are enough.
+    queues = []
+    threads = []
+    errors = []
+
+    for h in hashers:
+        q = queue.Queue(maxsize=1)
+        th = threading.Thread(target=_hash_worker, args=(h, q, errors))
+        th.daemon = True
+        th.start()
+
+        queues.append(q)
+        threads.append(th)
+
+    try:
+        for buf in blocks:
+            # Stop reading once a hasher fails.
+            if len(errors) > 0:
                 break
+            for q in queues:
+                q.put(buf)
+    finally:
+        for q in queues:
+            q.put(None)
+        for th in threads:
+            th.join()
 
-            t1 = time.time()
-
-            time_sleep = max(0, min_io_time - (t1 - t0))
-            if time_sleep > 0:
-                time.sleep(time_sleep)
-
-            if sha1:
-                sum_sha1.update(buf)
-            if md5:
-                sum_md5.update(buf)
-            if crc32:
-                sum_crc32 = binascii.crc32(buf, sum_crc32)
-            if sha256:
-                sum_sha256.update(buf)
-
-    if sha1:
-        checksums['sha1'] = sum_sha1.hexdigest()
-    if md5:
-        checksums['md5'] = sum_md5.hexdigest()
-    if crc32:
-        checksums['crc32'] = '%08x' % (sum_crc32 & 0xffffffff)
-    if sha256:
-        checksums['sha256'] = sum_sha256.hexdigest()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def _hash_worker(hasher, q, errors):
+
+    while True:
+        buf = q.get()
+        if buf is None:
+            return
+
+        # Keep draining the queue after an error, or the reader blocks.
+        if len(errors) > 0:
+            continue
+
+        try:
+            hasher.update(buf)
+        except BaseException as e:
+            errors.append(e)
 
-    return checksums
 
 def _to_dict(_namedtuple):
     return dict(_namedtuple._asdict())
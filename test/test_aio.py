@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import asyncio
+import os
+import unittest
+
+import k3fs
+import k3fs.aio
+import k3ut
+
+dd = k3ut.dd
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAio(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = '/tmp/pykit-ut-k3fs-aio'
+        k3fs.remove(self.dirname, onerror='ignore')
+        k3fs.makedirs(self.dirname)
+
+    def tearDown(self):
+        k3fs.remove(self.dirname, onerror='ignore')
+
+    def test_read_write(self):
+
+        d = self.dirname
+
+        async def _test():
+            await k3fs.aio.makedirs(d, 'a', 'b')
+            await k3fs.aio.fwrite(d, 'a', 'foo', 'foo')
+            await k3fs.aio.fwrite(d, 'a', 'bar', b'bar', atomic=True)
+
+            self.assertEqual('foo', await k3fs.aio.fread(d, 'a', 'foo'))
+            self.assertEqual(b'bar', await k3fs.aio.fread(d, 'a', 'bar', mode='b'))
+            self.assertEqual(['bar', 'foo'], await k3fs.aio.ls_files(d, 'a'))
+            self.assertEqual(['b'], await k3fs.aio.ls_dirs(d, 'a'))
+
+            with self.assertRaises(OSError):
+                await k3fs.aio.fread(d, 'inexistent')
+
+            dd('calls run concurrently')
+            conts = await asyncio.gather(*[k3fs.aio.fread(d, 'a', 'foo') for _ in range(10)])
+            self.assertEqual(['foo'] * 10, conts)
+
+        run(_test())
+
+    def test_calc_checksums(self):
+
+        fn = os.path.join(self.dirname, 'foo')
+        cont = os.urandom(1024 * 1024 * 3 + 1)
+        k3fs.fwrite(fn, cont)
+
+        expected = k3fs.calc_checksums(fn, sha1=True, md5=True, io_limit=-1)
+
+        reported = []
+
+        async def _test():
+            return await k3fs.aio.calc_checksums(fn, sha1=True, md5=True, io_limit=-1,
+                                                 block_size=1024 * 1024,
+                                                 progress=reported.append)
+
+        self.assertEqual(expected, run(_test()))
+
+        # progress callbacks are scheduled before the result is set
+        self.assertEqual([1, 2, 3], [x // (1024 * 1024) for x in reported[:3]])
+        self.assertEqual(len(cont), reported[-1])
+
+        dd('cancel stops hashing')
+        calls = {'n': 0}
+
+        def _count(n):
+            calls['n'] += 1
+
+        async def _cancel():
+            task = asyncio.ensure_future(
+                k3fs.aio.calc_checksums(fn, sha1=True, block_size=1024,
+                                        io_limit=k3fs.IOLimiter(1024 * 1024), progress=_count))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+            n = calls['n']
+            await asyncio.sleep(0.2)
+            return n
+
+        n = run(_cancel())
+        self.assertLess(calls['n'], len(cont) // 1024)
+        self.assertLessEqual(calls['n'] - n, 1)
+
+    def test_remove(self):
+
+        d = os.path.join(self.dirname, 'tree')
+        for i in range(5):
+            k3fs.makedirs(d, str(i))
+            for j in range(10):
+                k3fs.fwrite(d, str(i), str(j), 'x')
+
+        reported = []
+
+        async def _test():
+            await k3fs.aio.remove(d, progress=reported.append)
+
+        run(_test())
+
+        self.assertFalse(os.path.exists(d))
+        if k3fs.fs._SUPPORT_DIR_FD:
+            self.assertEqual(5 * 10 + 5 + 1, reported[-1])
+
+        with self.assertRaises(OSError):
+            run(k3fs.aio.remove(d))
+        run(k3fs.aio.remove(d, onerror='ignore'))
+
+    def test_set_device_concurrency(self):
+
+        k3fs.aio.set_device_concurrency(1)
+        try:
+            fn = os.path.join(self.dirname, 'foo')
+            run(k3fs.aio.fwrite(fn, 'foo'))
+            self.assertEqual('foo', run(k3fs.aio.fread(fn)))
+        finally:
+            k3fs.aio.set_device_concurrency(k3fs.aio.PER_DEVICE)
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.aio.set_device_concurrency, 0)
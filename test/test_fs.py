@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import errno
+import io
 import os
+import stat
 import time
 import unittest
 
@@ -61,6 +64,30 @@ class TestFS(unittest.TestCase):
             self.assertRaises(k3fs.NotMountPoint,
                               k3fs.assert_mountpoint, path + '/aaa')
 
+    def test_get_mountpoints(self):
+
+        prts = k3fs.get_disk_partitions()
+
+        def walk_up(path):
+            path = os.path.realpath(path)
+            while path != '/' and path not in prts:
+                path = os.path.dirname(path)
+            return path
+
+        paths = ['/', '/bin/ls', '/dev/', '/dev/random', '/dev/inexistent', '/tmp/a/b/c']
+        for mp in prts:
+            paths.extend([mp, mp + '/', os.path.join(mp, 'foo', 'bar')])
+
+        rst = k3fs.get_mountpoints(paths)
+        self.assertEqual(len(paths), len(rst))
+
+        for path, mp in zip(paths, rst):
+            dd(path, ' --> ', mp)
+            self.assertEqual(walk_up(path), mp)
+            self.assertEqual(k3fs.get_mountpoint(path), mp)
+
+        self.assertEqual([], k3fs.get_mountpoints([]))
+
     def test_get_disk_partitions(self):
 
         rst = k3fs.get_disk_partitions()
@@ -75,6 +102,47 @@ class TestFS(unittest.TestCase):
         self.assertTrue(len(rst) > len(notall))
         self.assertEqual(set([]), set(notall) - set(rst))
 
+    def test_mount_table_cache(self):
+
+        load_count = {'n': 0}
+        disk_partitions = k3fs.fs.psutil.disk_partitions
+
+        def _counted(all=False):
+            load_count['n'] += 1
+            return disk_partitions(all=all)
+
+        k3fs.fs.psutil.disk_partitions = _counted
+        try:
+            k3fs.refresh_mount_table()
+
+            expected = k3fs.get_disk_partitions()
+            for path in ('/', '/dev/random', '/blabla'):
+                k3fs.get_mountpoint(path)
+                k3fs.get_path_fs(path)
+
+            if os.path.exists(k3fs.fs.MOUNTINFO):
+                self.assertEqual(1, load_count['n'])
+
+            dd('returned table is a copy')
+            expected['/']['fstype'] = 'foo'
+            self.assertNotEqual('foo', k3fs.get_disk_partitions()['/']['fstype'])
+
+            dd('refresh reloads')
+            n = load_count['n']
+            k3fs.refresh_mount_table()
+            k3fs.get_mountpoint('/')
+            self.assertEqual(n + 1, load_count['n'])
+
+            dd('disabled cache loads every time')
+            k3fs.set_mount_table_cache(False)
+            n = load_count['n']
+            k3fs.get_device('/')
+            k3fs.get_device('/')
+            self.assertEqual(n + 2, load_count['n'])
+        finally:
+            k3fs.fs.psutil.disk_partitions = disk_partitions
+            k3fs.set_mount_table_cache(True)
+
     def test_get_device(self):
         if is_ci():
             return
@@ -110,6 +178,28 @@ class TestFS(unittest.TestCase):
         dd('fs of /blabla: ', rst)
         self.assertIn(rst, ('hfs', 'xfs', 'ext2', 'ext3', 'ext4'))
 
+    def test_get_path_partitions(self):
+
+        paths = ['/', '/bin/ls', '/dev', '/dev/random', '/dev/inexistent', '/blabla', this_base]
+        rst = k3fs.get_path_partitions(paths)
+
+        self.assertEqual(set(paths), set(rst))
+
+        for path in paths:
+            prt = rst[path]
+            dd(path, ' --> ', prt)
+
+            for k in ('device', 'mountpoint', 'fstype', 'opts'):
+                self.assertIn(k, prt)
+
+            self.assertEqual(k3fs.get_device(path), prt['device'])
+            self.assertEqual(k3fs.get_path_fs(path), prt['fstype'])
+
+        dd('paths on one device share the lookup')
+        self.assertIs(rst['/dev'], rst['/dev/random'])
+
+        self.assertEqual({}, k3fs.get_path_partitions([]))
+
     def test_get_path_usage(self):
 
         path = '/'
@@ -160,6 +250,103 @@ class TestFS(unittest.TestCase):
         total = inode_st['used'] + inode_st['available']
         self.assertEqual(inode_st['total'], total)
 
+    def test_dir_usage(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-dir-usage'
+        k3fs.remove(dirname, onerror='ignore')
+
+        k3fs.makedirs(dirname, 'a', 'b')
+        k3fs.makedirs(dirname, 'c')
+        k3fs.fwrite(dirname, 'foo', 'x' * 10)
+        k3fs.fwrite(dirname, 'a', 'bar', 'x' * 5000)
+        k3fs.fwrite(dirname, 'a', 'b', 'baz', 'x' * 3)
+        os.link(os.path.join(dirname, 'a', 'bar'), os.path.join(dirname, 'c', 'bar-link'))
+        os.symlink('foo', os.path.join(dirname, 'link'))
+
+        def expected():
+            size = disk_size = files = dirs = 0
+            seen = set()
+            for root, ds, fs in os.walk(dirname):
+                st = os.lstat(root)
+                size += st.st_size
+                disk_size += st.st_blocks * 512
+                dirs += 1
+                for f in fs:
+                    st = os.lstat(os.path.join(root, f))
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                    size += st.st_size
+                    disk_size += st.st_blocks * 512
+                    files += 1
+            return {'size': size, 'disk_size': disk_size, 'files': files, 'dirs': dirs}
+
+        exp = expected()
+        self.assertEqual(4, exp['files'])
+        self.assertEqual(4, exp['dirs'])
+
+        for concurrency in (1, 3):
+            self.assertEqual(exp, k3fs.dir_usage(dirname, concurrency=concurrency))
+
+        rst = k3fs.dir_usage(dirname, 'a', 'bar')
+        self.assertEqual((5000, 1, 0), (rst['size'], rst['files'], rst['dirs']))
+
+        dd('cache')
+        cache = k3fs.DirUsageCache()
+        self.assertEqual(exp, k3fs.dir_usage(dirname, cache=cache))
+        self.assertEqual({'hit': 0, 'miss': 4, 'evicted': 0, 'entries': 4}, cache.stats())
+
+        self.assertEqual(exp, k3fs.dir_usage(dirname, cache=cache))
+        self.assertEqual({'hit': 4, 'miss': 4, 'evicted': 0, 'entries': 4}, cache.stats())
+
+        dd('a new file changes mtime of its dir')
+        k3fs.fwrite(dirname, 'a', 'b', 'new', 'x' * 7)
+        os.utime(os.path.join(dirname, 'a', 'b'), ns=(1, 1))
+        exp = expected()
+        self.assertEqual(exp, k3fs.dir_usage(dirname, cache=cache))
+        self.assertEqual({'hit': 7, 'miss': 5, 'evicted': 0, 'entries': 4}, cache.stats())
+
+        cache.clear()
+        self.assertEqual(0, cache.stats()['entries'])
+
+        dd('least recently used dirs are evicted')
+        cache = k3fs.DirUsageCache(max_entries=2)
+        self.assertEqual(exp, k3fs.dir_usage(dirname, cache=cache))
+        self.assertEqual(2, cache.stats()['entries'])
+        self.assertEqual(2, cache.stats()['evicted'])
+        self.assertRaises(k3fs.FSUtilError, k3fs.DirUsageCache, max_entries=0)
+
+        dd('a dir with an error is not cached')
+        add_entry = k3fs.fs._add_entry
+
+        def _add_entry(entries, st):
+            if st.st_size == 10:
+                raise OSError(errno.EACCES, 'denied')
+            return add_entry(entries, st)
+
+        cache = k3fs.DirUsageCache()
+        k3fs.fs._add_entry = _add_entry
+        try:
+            rst = k3fs.dir_usage(dirname, cache=cache, onerror='ignore')
+        finally:
+            k3fs.fs._add_entry = add_entry
+
+        self.assertEqual(exp['files'] - 1, rst['files'])
+        self.assertEqual(3, cache.stats()['entries'])
+        self.assertEqual(exp, k3fs.dir_usage(dirname, cache=cache))
+
+        dd('one_fs')
+        if os.path.ismount('/dev/pts'):
+            self.assertLess(k3fs.dir_usage('/dev', onerror='ignore')['dirs'],
+                            k3fs.dir_usage('/dev', one_fs=False, onerror='ignore')['dirs'])
+
+        dd('errors')
+        inexistent = os.path.join(dirname, 'inexistent')
+        self.assertRaises(OSError, k3fs.dir_usage, inexistent)
+        self.assertRaises(k3fs.FSUtilError, k3fs.dir_usage, dirname, concurrency=0)
+
+        k3fs.remove(dirname, fast=True)
+
     def test_makedirs(self):
 
         fn = '/tmp/pykit-ut-k3fs-foo'
@@ -204,6 +391,84 @@ class TestFS(unittest.TestCase):
         # self.assertRaises(PermissionError, k3fs.makedirs, fn, uid=1, gid=1)
         k3fs.makedirs(fn, uid=1, gid=1)
 
+    def test_makedirs_many(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-makedirs-many'
+        k3fs.remove(dirname, onerror='ignore')
+
+        paths = [
+            (dirname, 'a', 'b'),
+            dirname + '/a',
+            dirname + '/a/',
+            dirname + '/c/d/e',
+            dirname + '/a/b/f',
+        ]
+        k3fs.makedirs_many(paths, mode=0o700)
+
+        for path in ('a', 'a/b', 'c/d/e', 'a/b/f'):
+            path = os.path.join(dirname, path)
+            self.assertTrue(os.path.isdir(path))
+            self.assertEqual(0o700, get_mode(path))
+
+        dd('existent dirs are fine')
+        k3fs.makedirs_many(paths)
+
+        dd('file is not a dir')
+        k3fs.fwrite(dirname, 'a', 'file', '')
+        self.assertRaises(OSError, k3fs.makedirs_many, [dirname + '/a', dirname + '/a/file'])
+
+        k3fs.makedirs_many([], uid=1, gid=1)
+        k3fs.makedirs_many([dirname + '/a/g'], uid=1, gid=1)
+        st = os.stat(dirname + '/a/g')
+        self.assertEqual((1, 1), (st.st_uid, st.st_gid))
+
+        k3fs.remove(dirname)
+
+    def test_makedirs_cache(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-makedirs-cache'
+        k3fs.remove(dirname, onerror='ignore')
+
+        os_chown = os.chown
+        chowned = []
+
+        def _chown(path, uid, gid):
+            chowned.append(path)
+            return os_chown(path, uid, gid)
+
+        os.chown = _chown
+        k3fs.set_makedirs_cache(2)
+        try:
+            for _ in range(3):
+                k3fs.makedirs(dirname, 'a', uid=1, gid=1)
+            self.assertEqual([dirname + '/a'], chowned)
+
+            dd('different owner is not cached')
+            k3fs.makedirs(dirname, 'a', uid=2, gid=2)
+            self.assertEqual(2, len(chowned))
+
+            dd('evicted')
+            k3fs.makedirs_many([dirname + '/b', dirname + '/c'], uid=1, gid=1)
+            k3fs.makedirs(dirname, 'a', uid=1, gid=1)
+            self.assertEqual(5, len(chowned))
+
+            dd('removed dirs are forgotten')
+            k3fs.remove(dirname)
+            k3fs.makedirs(dirname, 'a', uid=1, gid=1)
+            self.assertTrue(os.path.isdir(dirname + '/a'))
+            self.assertEqual(6, len(chowned))
+
+            dd('dirs removed by other means are forgotten')
+            os.rmdir(dirname + '/a')
+            k3fs.makedirs(dirname, 'a', uid=1, gid=1)
+            self.assertTrue(os.path.isdir(dirname + '/a'))
+            self.assertEqual(7, len(chowned))
+        finally:
+            os.chown = os_chown
+            k3fs.set_makedirs_cache(0)
+
+        k3fs.remove(dirname)
+
     def test_ls_dirs(self):
         k3fs.makedirs('test_dir/sub_dir1/foo')
         k3fs.makedirs('test_dir/sub_dir2')
@@ -216,6 +481,14 @@ class TestFS(unittest.TestCase):
         sub_dirs = k3fs.ls_dirs('test_dir', 'sub_dir1')
         self.assertListEqual(['foo'], sub_dirs)
 
+        dd('symlink to dir is a dir, broken symlink is not')
+        os.symlink('sub_dir2', 'test_dir/link_dir')
+        os.symlink('inexistent', 'test_dir/broken_link')
+        self.assertListEqual(['link_dir', 'sub_dir1', 'sub_dir2'], k3fs.ls_dirs('test_dir'))
+
+        self.assertEqual(set(['link_dir', 'sub_dir1', 'sub_dir2']), set(k3fs.iter_dirs('test_dir')))
+        self.assertEqual(['foo'], list(k3fs.iter_dirs('test_dir', 'sub_dir1')))
+
         k3fs.remove('test_dir')
 
     def test_ls_files(self):
@@ -237,6 +510,14 @@ class TestFS(unittest.TestCase):
         # test multi path segments
         self.assertEqual(['bar', 'foo'], k3fs.ls_files('test_dir', 'foo_dir'))
 
+        dd('symlink to file is a file, broken symlink is not')
+        os.symlink('foo1', 'test_dir/link_file')
+        os.symlink('inexistent', 'test_dir/broken_link')
+        self.assertEqual(['foo1', 'foo2', 'foo21', 'link_file'], k3fs.ls_files('test_dir'))
+
+        self.assertEqual(set(['foo2', 'foo21']), set(k3fs.iter_files('test_dir', pattern='2')))
+        self.assertEqual(set(['bar', 'foo']), set(k3fs.iter_files('test_dir', 'foo_dir')))
+
         k3fs.remove('test_dir')
 
     def test_makedirs_with_config(self):
@@ -286,6 +567,149 @@ class TestFS(unittest.TestCase):
 
         force_remove(fn)
 
+    def test_fread_mmap(self):
+
+        fn = '/tmp/pykit-ut-fread-mmap'
+        force_remove(fn)
+
+        k3fs.fwrite(fn, '')
+        self.assertEqual(b'', k3fs.fread_mmap(fn).tobytes())
+
+        cont = '123' * (1024 ** 2)
+        k3fs.fwrite(fn, cont)
+
+        for kwargs in ({}, {'sequential': False}, {'willneed': True}):
+            view = k3fs.fread_mmap('/tmp', 'pykit-ut-fread-mmap', **kwargs)
+            self.assertTrue(view.readonly)
+            self.assertEqual(len(cont), len(view))
+            self.assertEqual(cont.encode('utf-8'), view.tobytes())
+            self.assertEqual(b'231', bytes(view[1:4]))
+            view.release()
+
+        force_remove(fn)
+
+    def test_write_bytes(self):
+
+        fn = '/tmp/pykit-ut-rw-bytes'
+        force_remove(fn)
+
+        import array
+
+        big = b'0123456789' * (1024 ** 2)
+
+        for cont, expected in (
+                (b'', b''),
+                (b'foo', b'foo'),
+                (bytearray(b'bar'), b'bar'),
+                (memoryview(b'xxfooxx')[2:5], b'foo'),
+                (memoryview(b'fxoxo')[::2], b'foo'),
+                ([memoryview(b'bxaxr')[::2]], b'bar'),
+                (array.array('i', [1, 2]), array.array('i', [1, 2]).tobytes()),
+                (big, big),
+                ([], b''),
+                ([b'a', bytearray(b'b'), b'', memoryview(b'c')], b'abc'),
+                ((b'%d,' % i for i in range(3000)), b''.join(b'%d,' % i for i in range(3000))),
+                ([big, b'-', big], big + b'-' + big),
+        ):
+            for atomic in (False, True):
+                k3fs.fwrite(fn, cont, atomic=atomic)
+                self.assertEqual(expected, k3fs.fread(fn, mode='b'))
+
+                if not isinstance(cont, (list, bytes, bytearray, memoryview, array.array)):
+                    # generator is consumed
+                    break
+
+        dd('chunks of a generator reusing one buffer')
+        for chunk_size, total in ((2, 10), (100 * 1024, 1024 ** 2 + 3)):
+            src = os.urandom(total)
+
+            def _chunks():
+                f = io.BytesIO(src)
+                buf = bytearray(chunk_size)
+                while True:
+                    n = f.readinto(buf)
+                    if n == 0:
+                        break
+                    yield memoryview(buf)[:n]
+
+            for atomic in (False, True):
+                k3fs.fwrite(fn, _chunks(), atomic=atomic)
+                self.assertEqual(src, k3fs.fread(fn, mode='b'))
+
+        dd('text is still text')
+        k3fs.fwrite(fn, 'It  바로')
+        self.assertEqual('It  바로', k3fs.fread(fn))
+
+        dd('uid/gid')
+        k3fs.fwrite(fn, b'1', uid=1, gid=1)
+        stat = os.stat(fn)
+        self.assertEqual((1, 1), (stat.st_uid, stat.st_gid))
+
+        force_remove(fn)
+
+    def test_write_stream(self):
+
+        import hashlib
+        import io
+
+        fn = '/tmp/pykit-ut-write-stream'
+        force_remove(fn)
+
+        chunks = [b'%d,' % i for i in range(10000)]
+        cont = b''.join(chunks)
+        exp = k3fs.calc_checksums
+        sha1 = hashlib.sha1(cont).hexdigest()
+
+        for source in (
+                chunks,
+                iter(chunks),
+                io.BytesIO(cont),
+                io.BufferedReader(io.BytesIO(cont)),
+        ):
+            k3fs.fwrite(fn, 'old')
+            rst = k3fs.fwrite_stream(fn, source, sha1=True, crc32=True, block_size=1000)
+            self.assertEqual(cont, k3fs.fread(fn, mode='b'))
+            self.assertEqual(sha1, rst['sha1'])
+            self.assertEqual(exp(fn, crc32=True, io_limit=-1)['crc32'], rst['crc32'])
+            self.assertIsNone(rst['md5'])
+
+        dd('source with read() only')
+
+        class Reader(object):
+            def __init__(self):
+                self.f = io.BytesIO(cont)
+
+            def read(self, n):
+                return self.f.read(n)
+
+        force_remove(fn)
+        k3fs.fwrite_stream('/tmp', 'pykit-ut-write-stream', Reader())
+        self.assertEqual(cont, k3fs.fread(fn, mode='b'))
+
+        dd('AtomicFile is invisible until committed')
+        k3fs.fwrite(fn, 'old')
+        with k3fs.AtomicFile(fn, md5=True, uid=1, gid=1) as f:
+            f.write(b'new')
+            f.write(memoryview(b'content'))
+            self.assertEqual('old', k3fs.fread(fn))
+
+        self.assertEqual('newcontent', k3fs.fread(fn))
+        self.assertEqual(hashlib.md5(b'newcontent').hexdigest(), f.checksums['md5'])
+        self.assertEqual(10, f.size)
+        self.assertEqual(1, os.stat(fn).st_uid)
+
+        dd('error aborts')
+
+        def _error_chunks():
+            yield b'foo'
+            raise ValueError('broken source')
+
+        self.assertRaises(ValueError, k3fs.fwrite_stream, fn, _error_chunks())
+        self.assertEqual('newcontent', k3fs.fread(fn))
+        self.assertEqual([], [x for x in os.listdir('/tmp') if x.startswith('pykit-ut-write-stream._tmp_')])
+
+        force_remove(fn)
+
     def test_write_file_with_config(self):
 
         fn = '/tmp/pykit-ut-k3fs-foo'
@@ -314,7 +738,9 @@ class TestFS(unittest.TestCase):
         os_fsync = os.fsync
 
         def _wait_fsync(fildes):
-            time.sleep(3)
+            # Only the file is slow to synchronize, not the dir.
+            if not stat.S_ISDIR(os.fstat(fildes).st_mode):
+                time.sleep(3)
 
             os_fsync(fildes)
 
@@ -376,6 +802,372 @@ class TestFS(unittest.TestCase):
         os.fsync = os_fsync
         force_remove(fn)
 
+        dd('the dir is synchronized after renaming')
+        synced = []
+
+        def _fsync(fildes):
+            synced.append(os.path.realpath('/proc/self/fd/{fd}'.format(fd=fildes)))
+            os_fsync(fildes)
+
+        os.fsync = _fsync
+        try:
+            for kwargs in ({}, {'tmpfile': True}):
+                del synced[:]
+                k3fs.fwrite(fn, 'foo', atomic=True, **kwargs)
+                self.assertEqual(os.path.realpath('/tmp'), synced[-1])
+
+                del synced[:]
+                k3fs.fwrite(fn, 'foo', atomic=True, fsync=False, **kwargs)
+                self.assertEqual([], synced)
+        finally:
+            os.fsync = os_fsync
+
+        force_remove(fn)
+
+    def test_write_file_group_commit(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-group-commit'
+        k3fs.remove(dirname, onerror='ignore')
+        k3fs.makedirs(dirname, 'a')
+        k3fs.makedirs(dirname, 'b')
+
+        os_fsync = os.fsync
+        synced = []
+
+        def _slow_fsync(fd):
+            synced.append(os.readlink('/proc/self/fd/%d' % fd))
+            time.sleep(0.1)
+            os_fsync(fd)
+
+        def _write(i):
+            k3fs.fwrite(dirname, 'ab'[i % 2], str(i), str(i), atomic=i % 3 == 0, group_commit=True)
+
+        os.fsync = _slow_fsync
+        try:
+            t0 = time.time()
+            ths = [k3thread.daemon(_write, args=(i,)) for i in range(20)]
+            for th in ths:
+                th.join()
+            elapsed = time.time() - t0
+        finally:
+            os.fsync = os_fsync
+
+        dd('files of a batch are synced in parallel:', elapsed)
+        self.assertLess(elapsed, 20 * 0.1)
+
+        for i in range(20):
+            self.assertEqual(str(i), k3fs.fread(dirname, 'ab'[i % 2], str(i)))
+
+        self.assertEqual([], [x for x in os.listdir(dirname + '/a') if '_tmp_' in x])
+
+        dd('synced:', synced)
+        files = [x for x in synced if os.path.basename(x).split('.')[0].isdigit()]
+        dirs = [x for x in synced if x in (dirname + '/a', dirname + '/b')]
+        self.assertEqual(20, len(files))
+        # dirs are synced once per batch, batches accumulate while syncing
+        self.assertLess(len(dirs), 20)
+
+        dd('error is raised to the writer')
+        self.assertRaises(EnvironmentError, k3fs.fwrite, dirname, 'inexistent', 'x', '', group_commit=True)
+        self.assertRaises(EnvironmentError, k3fs.fwrite, dirname, 'a', '', atomic=True, group_commit=True)
+        self.assertEqual([], [x for x in os.listdir(dirname) if '_tmp_' in x])
+
+        k3fs.remove(dirname)
+
+    def test_write_file_tmpfile(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-write-tmpfile'
+        k3fs.remove(dirname, onerror='ignore')
+        k3fs.makedirs(dirname)
+        fn = os.path.join(dirname, 'foo')
+
+        def no_tmp():
+            return [x for x in os.listdir(dirname) if '_tmp_' in x] == []
+
+        for cont, expected in (('bar', b'bar'),
+                               ('바로', '바로'.encode('utf-8')),
+                               (b'bytes', b'bytes'),
+                               ([b'a', b'b'], b'ab')):
+            k3fs.fwrite(fn, cont, atomic=True, tmpfile=True)
+            self.assertEqual(expected, k3fs.fread(fn, mode='b'))
+            self.assertTrue(no_tmp())
+
+        k3fs.fwrite(fn, '1', atomic=True, tmpfile=True, uid=1, gid=1)
+        st = os.stat(fn)
+        self.assertEqual((1, 1), (st.st_uid, st.st_gid))
+
+        k3fs.fwrite(fn, 'group', atomic=True, tmpfile=True, group_commit=True)
+        self.assertEqual('group', k3fs.fread(fn))
+        self.assertTrue(no_tmp())
+
+        dd('concurrent writers of one path')
+        errs = []
+
+        def _write(i):
+            try:
+                for _ in range(50):
+                    k3fs.fwrite(fn, str(i) * 100, atomic=True, tmpfile=True, fsync=False)
+            except Exception as e:
+                errs.append(e)
+
+        ths = [k3thread.daemon(_write, args=(i,)) for i in range(4)]
+        for th in ths:
+            th.join()
+
+        self.assertEqual([], errs)
+        cont = k3fs.fread(fn)
+        self.assertIn(cont, [str(i) * 100 for i in range(4)])
+        self.assertTrue(no_tmp())
+
+        dd('aborted AtomicFile leaves nothing')
+        try:
+            with k3fs.AtomicFile(fn, tmpfile=True) as f:
+                f.write(b'partial')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(cont, k3fs.fread(fn))
+        self.assertTrue(no_tmp())
+
+        rst = k3fs.fwrite_stream(fn, [b'x', b'y'], tmpfile=True, md5=True)
+        self.assertEqual('xy', k3fs.fread(fn))
+        self.assertEqual('3e44107170a520582ade522fa73c1d15', rst['md5'])
+
+        dd('fall back to O_EXCL on a file system without O_TMPFILE')
+        tmpfile_fs = k3fs.fs.TMPFILE_FS
+        k3fs.fs.TMPFILE_FS = ()
+        try:
+            with k3fs.AtomicFile(fn, tmpfile=True) as f:
+                self.assertIsNotNone(f.tmp_path)
+                f.write(b'excl')
+        finally:
+            k3fs.fs.TMPFILE_FS = tmpfile_fs
+        self.assertEqual('excl', k3fs.fread(fn))
+        self.assertTrue(no_tmp())
+
+        k3fs.remove(dirname)
+
+    def test_read_write_many(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-read-write-many'
+        k3fs.remove(dirname, onerror='ignore')
+        k3fs.makedirs(dirname)
+
+        backends = ['threads']
+        if k3fs.fs._io_uring_supported():
+            backends.append('io_uring')
+
+        items = [(os.path.join(dirname, str(i)), os.urandom(i * 997 % (100 * 1024)))
+                 for i in range(600)]
+        items.extend([
+            (os.path.join(dirname, 'big'), os.urandom(1024 * 1024 + 1)),
+            (os.path.join(dirname, 'empty'), b''),
+            (os.path.join(dirname, 'str'), 'It 바로\r\nfoo'),
+            (os.path.join(dirname, 'chunks'), [b'a', bytearray(b'b'), memoryview(b'c')]),
+        ])
+        expected = [cont for _, cont in items[:-2]] + ['It 바로\r\nfoo'.encode('utf-8'), b'abc']
+        paths = [path for path, _ in items]
+
+        # Set up the ring shared by the process and the log file before
+        # counting fds.
+        for backend in backends:
+            dd(backend)
+            k3fs.fread_many([], backend=backend)
+
+        nfd = len(os.listdir('/proc/self/fd'))
+
+        for backend in backends:
+            dd(backend)
+            for path in paths:
+                k3fs.remove(path, onerror='ignore')
+
+            for fsync in (True, False):
+                k3fs.fwrite_many(items, backend=backend, fsync=fsync)
+                self.assertEqual(expected, [k3fs.fread(p, mode='b') for p in paths])
+
+                self.assertEqual(expected, k3fs.fread_many(paths, backend=backend))
+                self.assertEqual(expected, k3fs.fread_many(paths, backend=backend, read_size=1))
+
+            self.assertEqual(['It 바로\nfoo'],
+                             k3fs.fread_many([os.path.join(dirname, 'str')], mode='', backend=backend))
+
+            k3fs.fwrite_many([(os.path.join(dirname, 'owned'), 'x')], uid=1, gid=1, backend=backend)
+            st = os.stat(os.path.join(dirname, 'owned'))
+            self.assertEqual((1, 1), (st.st_uid, st.st_gid))
+
+            dd('errors')
+            inexistent = os.path.join(dirname, 'inexistent')
+            self.assertRaises(OSError, k3fs.fread_many, [paths[0], inexistent], backend=backend)
+            self.assertEqual([expected[0], None],
+                             k3fs.fread_many([paths[0], inexistent], backend=backend, onerror='ignore'))
+
+            dd('the failed syscall is reported')
+            errs = []
+            k3fs.fread_many([paths[0], inexistent], backend=backend,
+                            onerror=lambda func, path, exc_info: errs.append((func, path)))
+            self.assertEqual([(os.open, inexistent)], errs)
+
+            errs = []
+            k3fs.fwrite_many([(os.path.join(inexistent, 'foo'), 'x'), (paths[0], b'y')], backend=backend,
+                             onerror=lambda func, path, exc_info: errs.append((func, path)))
+            self.assertEqual([(os.open, os.path.join(inexistent, 'foo'))], errs)
+            self.assertEqual(b'y', k3fs.fread(paths[0], mode='b'))
+            k3fs.fwrite(paths[0], expected[0])
+
+            self.assertEqual([], k3fs.fread_many([], backend=backend))
+
+            dd('from many threads')
+            rsts = []
+            ths = [k3thread.daemon(lambda: rsts.append(k3fs.fread_many(paths[:50], backend=backend)))
+                   for _ in range(20)]
+            for th in ths:
+                th.join()
+            self.assertEqual([expected[:50]] * 20, rsts)
+
+        dd('no fd leaks')
+        self.assertLessEqual(len(os.listdir('/proc/self/fd')), nfd)
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.fread_many, paths, backend='foo')
+        self.assertRaises(k3fs.FSUtilError, k3fs.fread_many, paths, read_size=0)
+
+        k3fs.remove(dirname)
+
+    def test_copy_file(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-copy-file'
+        k3fs.remove(dirname, onerror='ignore')
+        k3fs.makedirs(dirname)
+        src = os.path.join(dirname, 'src')
+        dst = os.path.join(dirname, 'dst')
+
+        cont = os.urandom(1024 * 1024 + 3)
+        k3fs.fwrite(src, cont)
+        os.chmod(src, 0o640)
+        os.utime(src, (1000, 2000))
+
+        for kwargs in ({},
+                       {'reflink': False},
+                       {'reflink': False, 'block_size': 4096},
+                       {'atomic': True},
+                       {'atomic': True, 'tmpfile': True},
+                       {'io_limit': k3fs.IOLimiter(1024 ** 3)},
+                       ):
+            dd(kwargs)
+            k3fs.remove(dst, onerror='ignore')
+
+            rst = k3fs.copy_file(src, dst, **kwargs)
+            self.assertEqual(cont, k3fs.fread(dst, mode='b'))
+            self.assertEqual({'sha1': None, 'md5': None, 'crc32': None, 'sha256': None}, rst)
+
+        dd('checksums are calculated while copying')
+        expected = k3fs.calc_checksums(src, sha1=True, md5=True, crc32=True, sha256=True,
+                                       io_limit=-1)
+        for atomic in (False, True):
+            rst = k3fs.copy_file(src, dst, sha1=True, md5=True, crc32=True, sha256=True,
+                                 atomic=atomic, block_size=64 * 1024)
+            self.assertEqual(expected, rst)
+            self.assertEqual(cont, k3fs.fread(dst, mode='b'))
+
+        dd('overwrite a longer file')
+        k3fs.fwrite(dst, b'x' * 2 * len(cont))
+        k3fs.copy_file(src, dst)
+        self.assertEqual(cont, k3fs.fread(dst, mode='b'))
+
+        dd('empty file')
+        empty = os.path.join(dirname, 'empty')
+        k3fs.fwrite(empty, b'')
+        k3fs.copy_file(empty, dst, md5=True)
+        self.assertEqual(b'', k3fs.fread(dst, mode='b'))
+
+        dd('keep_stat')
+        k3fs.copy_file(src, dst, keep_stat=True)
+        st = os.stat(dst)
+        self.assertEqual(0o640, st.st_mode & 0o777)
+        self.assertEqual(2000, st.st_mtime)
+
+        k3fs.copy_file(src, dst, uid=1, gid=1, atomic=True)
+        st = os.stat(dst)
+        self.assertEqual((1, 1), (st.st_uid, st.st_gid))
+
+        self.assertEqual([], [x for x in os.listdir(dirname) if '_tmp_' in x])
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.copy_file, src, src)
+        self.assertRaises(k3fs.FSUtilError, k3fs.copy_file, src, dst, block_size=0)
+        self.assertRaises(OSError, k3fs.copy_file, src + '-inexistent', dst)
+
+        k3fs.remove(dirname)
+
+    def test_sync_tree(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-sync-tree'
+        k3fs.remove(dirname, onerror='ignore', fast=True)
+        src = os.path.join(dirname, 'src')
+        dst = os.path.join(dirname, 'dst')
+
+        k3fs.makedirs(src, 'a', 'b')
+        k3fs.makedirs(src, 'c')
+        k3fs.fwrite(src, 'foo', 'foo')
+        k3fs.fwrite(src, 'a', 'bar', 'bar')
+        k3fs.fwrite(src, 'a', 'b', 'baz', 'baz')
+        os.symlink(os.path.join(src, 'a'), os.path.join(src, 'link'))
+
+        def sync(s=src, **kwargs):
+            rst = {}
+            for ev in k3fs.sync_tree(s, dst, **kwargs):
+                rst.setdefault(ev['action'], []).append(ev['path'])
+            return dict([(k, sorted(v)) for k, v in rst.items()])
+
+        files = ['a/b/baz', 'a/bar', 'foo']
+
+        dd('dry run does nothing')
+        rst = sync(dry_run=True)
+        self.assertEqual({'mkdir': ['', 'a', 'a/b', 'c'], 'copy': files}, rst)
+        self.assertFalse(os.path.exists(dst))
+
+        rst = sync()
+        self.assertEqual({'mkdir': ['', 'a', 'a/b', 'c'], 'copy': files}, rst)
+        for f in files:
+            self.assertEqual(k3fs.fread(src, f), k3fs.fread(dst, f))
+        self.assertFalse(os.path.exists(os.path.join(dst, 'link')))
+
+        dd('unchanged files are skipped')
+        self.assertEqual({'skip': files}, sync())
+        self.assertEqual({'skip': files}, sync(checksum=True, concurrency=1, per_device=1))
+
+        dd('changed size or mtime')
+        k3fs.fwrite(src, 'foo', 'foo2')
+        os.utime(os.path.join(src, 'a', 'bar'), (1000, 1000))
+        self.assertEqual({'copy': ['a/bar', 'foo'], 'skip': ['a/b/baz']}, sync(dry_run=True))
+        self.assertEqual({'copy': ['a/bar', 'foo'], 'skip': ['a/b/baz']}, sync())
+        self.assertEqual('foo2', k3fs.fread(dst, 'foo'))
+
+        dd('same size and mtime but different content, found by checksum')
+        k3fs.fwrite(dst, 'a', 'b', 'baz', 'BAZ')
+        st = os.stat(os.path.join(src, 'a', 'b', 'baz'))
+        os.utime(os.path.join(dst, 'a', 'b', 'baz'), ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual({'skip': files}, sync())
+        self.assertEqual({'copy': ['a/b/baz'], 'skip': ['a/bar', 'foo']}, sync(checksum=True))
+        self.assertEqual('baz', k3fs.fread(dst, 'a', 'b', 'baz'))
+
+        dd('errors')
+        self.assertRaises(OSError, sync, s=src + '-inexistent')
+        self.assertEqual({}, sync(s=src + '-inexistent', onerror='ignore'))
+        self.assertRaises(k3fs.FSUtilError, k3fs.sync_tree, src, dst, concurrency=0)
+        self.assertRaises(k3fs.FSUtilError, k3fs.sync_tree, src, dst, per_device=0)
+
+        dd('files are copied before the whole tree is scanned')
+        k3fs.remove(dirname, fast=True)
+        for i in range(200):
+            k3fs.makedirs(src, str(i))
+            k3fs.fwrite(src, str(i), 'foo', '')
+
+        actions = [ev['action'] for ev in k3fs.sync_tree(src, dst, concurrency=1)]
+        self.assertEqual(201, actions.count('mkdir'))
+        self.assertEqual(200, actions.count('copy'))
+        self.assertLess(actions.index('copy'), 100)
+
+        k3fs.remove(dirname, fast=True)
+
     def test_remove_normal_file(self):
 
         f = 'pykit-ut-k3fs-remove-file-normal'
@@ -480,6 +1272,261 @@ class TestFS(unittest.TestCase):
         k3fs.remove(dirname)
         self.assertFalse(os.path.exists(dirname))
 
+    def test_remove_fast(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-remove-fast'
+        k3fs.remove(dirname, onerror='ignore')
+
+        for concurrency in (1, 4):
+
+            dd('concurrency:', concurrency)
+
+            k3fs.makedirs(dirname)
+            for i in range(5):
+                for j in range(5):
+                    k3fs.makedirs(dirname, str(i), str(j))
+                    k3fs.fwrite(dirname, str(i), str(j), 'file', '')
+                k3fs.fwrite(dirname, str(i), 'file', '')
+            k3fs.makedirs(dirname, 'empty')
+
+            os.link(os.path.join(dirname, '0', 'file'), os.path.join(dirname, 'hard_link'))
+            os.symlink('/tmp', os.path.join(dirname, 'symlink_to_dir'))
+
+            removed = []
+            k3fs.remove(dirname, fast=True, concurrency=concurrency, progress=removed.append)
+            self.assertFalse(os.path.exists(dirname))
+            self.assertTrue(os.path.isdir('/tmp'))
+            self.assertEqual(32 + 32, sum(removed))
+
+        dd('sub dirs are opened and removed relative to the parent')
+        k3fs.makedirs(dirname, 'a', 'b')
+        os_open, os_rmdir = os.open, os.rmdir
+        paths = []
+
+        def _open(path, *args, **kwargs):
+            paths.append(path)
+            return os_open(path, *args, **kwargs)
+
+        def _rmdir(path, *args, **kwargs):
+            paths.append(path)
+            return os_rmdir(path, *args, **kwargs)
+
+        nfd = len(os.listdir('/proc/self/fd'))
+        os.open, os.rmdir = _open, _rmdir
+        try:
+            k3fs.remove(dirname, fast=True)
+        finally:
+            os.open, os.rmdir = os_open, os_rmdir
+
+        self.assertFalse(os.path.exists(dirname))
+        dd('only the root is opened and removed by path')
+        self.assertEqual([dirname, dirname], [p for p in paths if '/' in p])
+        self.assertEqual(nfd, len(os.listdir('/proc/self/fd')))
+
+        dd('deeper than recursion limit')
+        path = dirname
+        os.mkdir(path)
+        for _ in range(1200):
+            path += '/d'
+            os.mkdir(path)
+        k3fs.fwrite(path, 'file', '')
+        k3fs.remove(dirname, fast=True)
+        self.assertFalse(os.path.exists(dirname))
+
+        dd('file and symlink to dir')
+        k3fs.fwrite(dirname, '')
+        k3fs.remove(dirname, fast=True)
+        self.assertFalse(os.path.exists(dirname))
+
+        k3fs.makedirs(dirname + '-target')
+        k3fs.fwrite(dirname + '-target', 'foo', '')
+        os.symlink(dirname + '-target', dirname)
+        k3fs.remove(dirname, fast=True)
+        self.assertFalse(os.path.lexists(dirname))
+        self.assertEqual(['foo'], k3fs.ls_files(dirname + '-target'))
+        k3fs.remove(dirname + '-target')
+
+    def test_remove_fast_error(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-remove-fast-on-error'
+        k3fs.remove(dirname, onerror='ignore')
+
+        self.assertRaises(os.error, k3fs.remove, dirname, fast=True)
+        k3fs.remove(dirname, onerror='ignore', fast=True)
+
+        errs = []
+        k3fs.remove(dirname, fast=True, onerror=lambda func, path, exc_info: errs.append((func, path)))
+        self.assertEqual([(os.remove, dirname)], errs)
+
+        dd('errors in a tree')
+        os_unlink = os.unlink
+
+        def _unlink(path, *args, **kwargs):
+            if path == 'bad':
+                raise OSError(errno.EACCES, 'denied', path)
+            return os_unlink(path, *args, **kwargs)
+
+        for concurrency in (1, 4):
+
+            for sub in ('a', 'b'):
+                k3fs.makedirs(dirname, sub)
+                k3fs.fwrite(dirname, sub, 'bad', '')
+                k3fs.fwrite(dirname, sub, 'good', '')
+
+            nfd = len(os.listdir('/proc/self/fd'))
+
+            os.unlink = _unlink
+            try:
+                self.assertRaises(OSError, k3fs.remove, dirname, fast=True, concurrency=concurrency)
+
+                dd('no fd leaks when stopped by an error')
+                self.assertEqual(nfd, len(os.listdir('/proc/self/fd')))
+
+                errs = []
+                k3fs.remove(dirname, fast=True, concurrency=concurrency,
+                            onerror=lambda func, path, exc_info: errs.append((func, path)))
+            finally:
+                os.unlink = os_unlink
+
+            self.assertEqual(set([(os.remove, os.path.join(dirname, 'a', 'bad')),
+                                  (os.remove, os.path.join(dirname, 'b', 'bad')),
+                                  (os.rmdir, os.path.join(dirname, 'a')),
+                                  (os.rmdir, os.path.join(dirname, 'b')),
+                                  (os.rmdir, dirname)]),
+                             set(errs))
+            self.assertEqual(['bad'], k3fs.ls_files(dirname, 'a'))
+
+            k3fs.remove(dirname)
+
+            dd('no fd leaks when stopped by progress')
+            for i in range(5):
+                k3fs.makedirs(dirname, str(i), 'sub')
+                k3fs.fwrite(dirname, str(i), 'foo', '')
+
+            def _progress(n):
+                raise ValueError('stop')
+
+            nfd = len(os.listdir('/proc/self/fd'))
+            self.assertRaises(ValueError, k3fs.remove, dirname, fast=True, concurrency=concurrency,
+                              progress=_progress)
+            self.assertEqual(nfd, len(os.listdir('/proc/self/fd')))
+
+            k3fs.remove(dirname)
+
+        dd('sub dirs can not be opened')
+        os_open = os.open
+
+        def _open(path, *args, **kwargs):
+            if path == 'bad':
+                raise OSError(errno.EACCES, 'denied', path)
+            return os_open(path, *args, **kwargs)
+
+        for concurrency in (1, 4):
+
+            k3fs.makedirs(dirname, 'bad')
+            k3fs.makedirs(dirname, 'a', 'bad', 'c')
+
+            errs = []
+            os.open = _open
+            try:
+                k3fs.remove(dirname, fast=True, concurrency=concurrency,
+                            onerror=lambda func, path, exc_info: errs.append((func, path)))
+            finally:
+                os.open = os_open
+
+            self.assertEqual(set([(os.listdir, os.path.join(dirname, 'bad')),
+                                  (os.listdir, os.path.join(dirname, 'a', 'bad')),
+                                  (os.rmdir, os.path.join(dirname, 'a', 'bad')),
+                                  (os.rmdir, os.path.join(dirname, 'a')),
+                                  (os.rmdir, dirname)]),
+                             set(errs))
+
+            dd('an empty one is removed')
+            self.assertEqual(['a'], k3fs.ls_dirs(dirname))
+
+            k3fs.remove(dirname)
+
+    def test_remove_background(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-remove-background'
+        k3fs.remove(dirname, onerror='ignore')
+
+        trash = os.path.join(k3fs.get_mountpoint(os.path.dirname(dirname)), k3fs.fs.TRASH_DIR)
+        trash_existed = os.path.exists(trash)
+
+        def make_tree():
+            for i in range(3):
+                k3fs.makedirs(dirname, str(i))
+                for j in range(10):
+                    k3fs.fwrite(dirname, str(i), str(j), '')
+
+        dd('a tree left by an exited process is purged')
+        rc, out, err = k3proc.shell_script('echo $$')
+        left = os.path.join(trash, 'foo.{pid}_0_0'.format(pid=out.strip()))
+        k3fs.makedirs(left)
+        k3fs.fwrite(left, 'bar', '')
+
+        stats = k3fs.get_remove_stats()
+
+        make_tree()
+        fut = k3fs.remove(dirname, background=True)
+        self.assertFalse(os.path.exists(dirname))
+        self.assertIsNone(fut.result(timeout=10))
+
+        for _ in range(100):
+            if not os.path.exists(left) and k3fs.get_remove_stats()['pending'] == 0:
+                break
+            time.sleep(0.1)
+
+        self.assertFalse(os.path.exists(left))
+
+        rst = k3fs.get_remove_stats()
+        dd('stats:', rst)
+        self.assertEqual(stats['done'] + 2, rst['done'])
+        self.assertEqual(stats['removed'] + 34 + 2, rst['removed'])
+
+        dd('trash is empty')
+        self.assertEqual([], os.listdir(trash))
+
+        dd('single file with io_limit')
+        k3fs.fwrite(dirname, '')
+        fut = k3fs.remove(dirname, background=True, io_limit=k3fs.IOLimiter(100))
+        self.assertFalse(os.path.exists(dirname))
+        fut.result(timeout=10)
+
+        dd('fall back to trash in the same dir')
+        os_mkdir = os.mkdir
+
+        def _mkdir(path, *args, **kwargs):
+            if path == trash:
+                raise OSError(errno.EACCES, 'denied', path)
+            return os_mkdir(path, *args, **kwargs)
+
+        make_tree()
+        os.mkdir = _mkdir
+        try:
+            fut = k3fs.remove(dirname, background=True)
+        finally:
+            os.mkdir = os_mkdir
+
+        self.assertFalse(os.path.exists(dirname))
+        fut.result(timeout=10)
+        self.assertEqual([], [x for x in os.listdir(os.path.dirname(dirname))
+                              if x.startswith(k3fs.fs.TRASH_DIR)])
+        self.assertEqual([], os.listdir(trash))
+
+        dd('rename error')
+        self.assertRaises(OSError, k3fs.remove, dirname, background=True)
+        fut = k3fs.remove(dirname, background=True, onerror='ignore')
+        self.assertIsNone(fut.result(timeout=10))
+
+        errs = []
+        k3fs.remove(dirname, background=True, onerror=lambda func, path, exc_info: errs.append((func, path)))
+        self.assertEqual([(os.rename, dirname)], errs)
+
+        if not trash_existed:
+            os.rmdir(trash)
+
     def test_remove_error(self):
 
         dirname = '/tmp/pykit-ut-k3fs-remove-on-error'
@@ -685,6 +1732,548 @@ class TestFS(unittest.TestCase):
 
         force_remove(fn)
 
+    def test_calc_checksums_buffer_pool(self):
+        import hashlib
+
+        fn = '/tmp/pykit-ut-fs-calc-checksums-pool'
+        force_remove(fn)
+
+        # block_size does not divide the file size
+        block_size = 4096
+        cont = os.urandom(block_size * 5 + 1234)
+        k3fs.fwrite(fn, cont)
+
+        buffer_pool = k3fs.fs._buffer_pool
+        pool = k3fs.fs._BufferPool(max_bytes=block_size * 2)
+        k3fs.fs._buffer_pool = pool
+
+        got = []
+
+        def _get(size, _get=pool.get):
+            buf = _get(size)
+            got.append(buf)
+            return buf
+
+        pool.get = _get
+
+        try:
+            for parallel in (False, True):
+                for _ in range(2):
+                    del got[:]
+                    rst = k3fs.calc_checksums(fn, sha1=True, md5=True, block_size=block_size,
+                                              io_limit=-1, parallel=parallel)
+                    dd(parallel, rst)
+                    self.assertEqual(hashlib.sha1(cont).hexdigest(), rst['sha1'])
+                    self.assertEqual(hashlib.md5(cont).hexdigest(), rst['md5'])
+
+                    dd('free buffers are capped by bytes')
+                    self.assertLessEqual(pool.free_bytes, block_size * 2)
+                    self.assertEqual(pool.free_bytes, sum([len(b) for b in pool.free]))
+
+                    freed = pool.free[:]
+
+                dd('buffers freed by the last call are reused')
+                del got[:]
+                k3fs.calc_checksums(fn, sha1=True, block_size=block_size, io_limit=-1,
+                                    parallel=parallel)
+                for buf in freed:
+                    self.assertTrue(any([buf is b for b in got]))
+
+            dd('a buffer larger than max_bytes is not kept')
+            pool.put(bytearray(block_size * 3))
+            self.assertLessEqual(pool.free_bytes, block_size * 2)
+
+        finally:
+            k3fs.fs._buffer_pool = buffer_pool
+            force_remove(fn)
+
+    def test_calc_checksums_parallel(self):
+
+        M = 1024 ** 2
+
+        fn = '/tmp/pykit-ut-fsutil-calc_checksums_parallel'
+
+        for cont, block_size in (
+                ('', M),
+                ('It  바로 とても 氣!', M),
+                ('!' * M * 10, M),
+                ('!' * M * 10 + '?', M * 3),
+        ):
+            force_remove(fn)
+            k3fs.fwrite(fn, cont)
+
+            for algs in (
+                    {'sha1': True, 'md5': True, 'crc32': True, 'sha256': True},
+                    {'md5': True, 'crc32': True},
+                    {'sha256': True},
+                    {},
+            ):
+                serial = k3fs.calc_checksums(fn, block_size=block_size, io_limit=-1, **algs)
+                parallel = k3fs.calc_checksums(fn, block_size=block_size, io_limit=-1,
+                                               parallel=True, **algs)
+                dd(algs, parallel)
+                self.assertEqual(serial, parallel)
+
+                for p in (False, True):
+                    mapped = k3fs.calc_checksums(fn, block_size=block_size, io_limit=-1,
+                                                 parallel=p, use_mmap=True, **algs)
+                    self.assertEqual(serial, mapped)
+
+        dd('mmap stops at the end of a file truncated meanwhile')
+        import hashlib
+
+        cont = os.urandom(1024 * 64)
+        k3fs.fwrite(fn, cont)
+
+        def _truncate(n):
+            os.truncate(fn, 1024 * 8)
+
+        rst = k3fs.calc_checksums(fn, sha1=True, block_size=1024 * 4, io_limit=-1,
+                                  use_mmap=True, progress=_truncate)
+        self.assertEqual(hashlib.sha1(cont[:1024 * 8]).hexdigest(), rst['sha1'])
+
+        force_remove(fn)
+
+    def test_calc_checksums_range(self):
+
+        import hashlib
+
+        fn = '/tmp/pykit-ut-fsutil-calc_checksums_range'
+        force_remove(fn)
+
+        cont = bytes(bytearray(range(256))) * 40
+        with open(fn, 'wb') as f:
+            f.write(cont)
+
+        def sha1(b):
+            return hashlib.sha1(b).hexdigest()
+
+        for parallel, use_mmap in ((False, False), (True, False), (False, True), (True, True)):
+            for offset, length in ((0, None), (100, None), (100, 1000), (0, 0), (len(cont), None),
+                                   (len(cont) - 10, 1000)):
+
+                dd('parallel:', parallel, 'use_mmap:', use_mmap, 'offset:', offset, 'length:', length)
+
+                end = len(cont) if length is None else offset + length
+                exp = cont[offset:end]
+
+                rst = k3fs.calc_checksums(fn, sha1=True, md5=True, block_size=333, io_limit=-1,
+                                          parallel=parallel, use_mmap=use_mmap,
+                                          offset=offset, length=length)
+                self.assertEqual(sha1(exp), rst['sha1'])
+                self.assertNotIn('chunks', rst)
+
+                saved = []
+                rst = k3fs.calc_checksums(fn, sha1=True, md5=True, block_size=333, io_limit=-1,
+                                          parallel=parallel, use_mmap=use_mmap,
+                                          offset=offset, length=length,
+                                          chunk_size=1024, checkpoint=saved.append)
+                self.assertEqual(sha1(exp), rst['sha1'])
+
+                exp_chunks = [exp[i:i + 1024] for i in range(0, len(exp), 1024)]
+                self.assertEqual(len(exp_chunks), len(rst['chunks']))
+                self.assertEqual(rst['chunks'], saved)
+
+                for i, (c, exp_c) in enumerate(zip(rst['chunks'], exp_chunks)):
+                    self.assertEqual(offset + i * 1024, c['offset'])
+                    self.assertEqual(len(exp_c), c['size'])
+                    self.assertEqual(sha1(exp_c), c['sha1'])
+                    self.assertEqual(hashlib.md5(exp_c).hexdigest(), c['md5'])
+                    self.assertIsNone(c['crc32'])
+
+        dd('resume from the last checkpoint')
+        saved = []
+
+        def _interrupt(chunk):
+            saved.append(chunk)
+            if len(saved) == 3:
+                raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, k3fs.calc_checksums, fn, sha256=True,
+                          chunk_size=1000, checkpoint=_interrupt)
+
+        last = saved[-1]
+        rst = k3fs.calc_checksums(fn, sha256=True, chunk_size=1000,
+                                  offset=last['offset'] + last['size'])
+        full = k3fs.calc_checksums(fn, sha256=True, chunk_size=1000)
+        self.assertEqual(full['chunks'], saved + rst['chunks'])
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums, fn, sha1=True, offset=-1)
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums, fn, sha1=True, length=-1)
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums, fn, sha1=True, chunk_size=0)
+
+        self.assertEqual([], k3fs.calc_checksums(fn, chunk_size=10)['chunks'])
+
+        force_remove(fn)
+
+    def test_calc_checksums_tree(self):
+
+        M = 1024 ** 2
+
+        dirname = '/tmp/pykit-ut-k3fs-checksums-tree'
+        k3fs.remove(dirname, onerror='ignore')
+
+        for path, cont in (
+                (('a',), ''),
+                (('b',), 'b' * M * 3),
+                (('sub', 'c'), 'c'),
+                (('sub', 'd'), 'd' * M),
+                (('sub', 'sub', 'e'), 'e' * 10),
+                (('empty_dir',), None),
+        ):
+            path = os.path.join(dirname, *path)
+            if cont is None:
+                k3fs.makedirs(path)
+            else:
+                k3fs.makedirs(os.path.dirname(path))
+                k3fs.fwrite(path, cont)
+
+        os.symlink(os.path.join(dirname, 'a'), os.path.join(dirname, 'link'))
+
+        expected = {}
+        for path in ('a', 'b', 'sub/c', 'sub/d', 'sub/sub/e'):
+            path = os.path.join(dirname, path)
+            expected[path] = k3fs.calc_checksums(path, sha1=True, crc32=True, io_limit=-1)
+
+        for kwargs in (
+                {},
+                {'concurrency': 1},
+                {'concurrency': 3, 'per_device': 1, 'large_size': M},
+                {'large_size': 0},
+                {'processes': True},
+        ):
+            dd(kwargs)
+            rst = k3fs.calc_checksums_tree(dirname, sha1=True, crc32=True, io_limit=-1, **kwargs)
+            self.assertEqual(expected, dict(rst))
+
+        dd('error handling')
+        inexistent = '/tmp/pykit-ut-k3fs-checksums-tree-inexistent'
+        self.assertRaises(OSError, list, k3fs.calc_checksums_tree(inexistent, sha1=True))
+        self.assertEqual([], list(k3fs.calc_checksums_tree(inexistent, sha1=True, onerror='ignore')))
+
+        errs = []
+        list(k3fs.calc_checksums_tree(inexistent, sha1=True,
+                                      onerror=lambda func, path, exc_info: errs.append((func, path))))
+        self.assertEqual([(os.scandir, inexistent)], errs)
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums_tree, dirname, concurrency=0)
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums_tree, dirname, per_device=0)
+
+        dd('results are yielded before the whole tree is scanned')
+        k3fs.remove(dirname)
+        for i in range(200):
+            k3fs.makedirs(dirname, str(i))
+            k3fs.fwrite(dirname, str(i), 'foo', '')
+
+        os_scandir = os.scandir
+        scanned = []
+
+        def _scandir(path):
+            scanned.append(path)
+            return os_scandir(path)
+
+        os.scandir = _scandir
+        try:
+            rst = k3fs.calc_checksums_tree(dirname, concurrency=1, sha1=True, io_limit=-1)
+            next(rst)
+            self.assertLess(len(scanned), 100)
+            self.assertEqual(200 - 1, len(list(rst)))
+        finally:
+            os.scandir = os_scandir
+
+        k3fs.remove(dirname)
+
+    def test_calc_checksums_algorithms(self):
+
+        import hashlib
+        import zlib
+
+        fn = '/tmp/pykit-ut-k3fs-checksums-algorithms'
+        force_remove(fn)
+
+        cont = os.urandom(1024 * 1024 + 7)
+        k3fs.fwrite(fn, cont)
+
+        expected = {
+            'blake2b': hashlib.blake2b(cont).hexdigest(),
+            'sha512': hashlib.sha512(cont).hexdigest(),
+            'sha1': hashlib.sha1(cont).hexdigest(),
+        }
+
+        for kwargs in ({}, {'parallel': True}, {'use_mmap': True}, {'block_size': 4096}):
+            dd(kwargs)
+            rst = k3fs.calc_checksums(fn, sha1=True, algorithms=['blake2b', 'sha512', 'sha1'],
+                                      io_limit=-1, **kwargs)
+            for name, digest in expected.items():
+                self.assertEqual(digest, rst[name])
+            self.assertIsNone(rst['md5'])
+
+        dd('registered hasher')
+
+        class Adler32(object):
+            def __init__(self):
+                self.v = 1
+
+            def update(self, buf):
+                self.v = zlib.adler32(buf, self.v)
+
+            def hexdigest(self):
+                return '%08x' % self.v
+
+        k3fs.register_hasher('adler32', Adler32)
+        try:
+            rst = k3fs.calc_checksums(fn, algorithms=['adler32'], io_limit=-1, chunk_size=1024 * 1024)
+            self.assertEqual('%08x' % zlib.adler32(cont), rst['adler32'])
+            self.assertEqual('%08x' % zlib.adler32(cont[:1024 * 1024]), rst['chunks'][0]['adler32'])
+            self.assertEqual('%08x' % zlib.adler32(cont[1024 * 1024:]), rst['chunks'][1]['adler32'])
+
+            dd('writers accept algorithms')
+            dst = fn + '-dst'
+            rst = k3fs.fwrite_stream(dst, [cont], algorithms=['adler32', 'blake2b'])
+            self.assertEqual('%08x' % zlib.adler32(cont), rst['adler32'])
+            self.assertEqual(expected['blake2b'], rst['blake2b'])
+
+            rst = k3fs.copy_file(fn, dst, algorithms=['sha512'])
+            self.assertEqual(expected['sha512'], rst['sha512'])
+            force_remove(dst)
+        finally:
+            del k3fs.fs._hashers['adler32']
+
+        dd('optional fast hashers')
+        fast = [name for name in ('crc32c', 'xxh3_64', 'xxh3_128') if name in k3fs.fs._hashers]
+        rst = k3fs.calc_checksums(fn, algorithms=fast, io_limit=-1)
+        for name in fast:
+            self.assertIsNotNone(rst[name])
+
+        fp = k3fs.calc_fingerprint(fn, algorithm='sha1')
+        self.assertEqual(40, len(fp))
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums, fn, algorithms=['inexistent'])
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_checksums, fn, algorithms=['shake_128'])
+
+        force_remove(fn)
+
+    def test_calc_fingerprint(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-fingerprint'
+        k3fs.remove(dirname, onerror='ignore')
+        k3fs.makedirs(dirname)
+
+        K = 1024
+        big = os.urandom(1024 * K)
+
+        def write(name, cont):
+            path = os.path.join(dirname, name)
+            k3fs.fwrite(path, cont)
+            return path
+
+        a = write('a', big)
+        a2 = write('a2', big)
+
+        # a byte that always differs from the one at `i` of `big`
+        def flip(i):
+            return bytes([big[i] ^ 0xff])
+
+        # differs in the head, tail, or only between samples
+        head = write('head', flip(0) + big[1:])
+        tail = write('tail', big[:-1] + flip(-1))
+        hole = write('hole', big[:100 * K] + flip(100 * K) + big[100 * K + 1:])
+        small = write('small', b'small')
+        small2 = write('small2', b'small')
+        other = write('other', b'smalL')
+        e1 = write('e1', b'')
+        e2 = write('e2', b'')
+
+        fp = k3fs.calc_fingerprint(a)
+        self.assertEqual(32, len(fp))
+        self.assertEqual(fp, k3fs.calc_fingerprint(a2))
+        self.assertNotEqual(fp, k3fs.calc_fingerprint(head))
+        self.assertNotEqual(fp, k3fs.calc_fingerprint(tail))
+        self.assertNotEqual(k3fs.calc_fingerprint(small), k3fs.calc_fingerprint(other))
+
+        dd('sampled fingerprint misses a change between samples')
+        self.assertEqual(k3fs.calc_fingerprint(a, samples=2, sample_size=K),
+                         k3fs.calc_fingerprint(hole, samples=2, sample_size=K))
+        self.assertNotEqual(k3fs.calc_fingerprint(a, sample_size=128 * K),
+                            k3fs.calc_fingerprint(hole, sample_size=128 * K))
+
+        dd('size is part of fingerprint')
+        self.assertNotEqual(k3fs.calc_fingerprint(e1), k3fs.calc_fingerprint(small))
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_fingerprint, a, samples=1)
+        self.assertRaises(k3fs.FSUtilError, k3fs.calc_fingerprint, a, sample_size=0)
+
+        dd('find_duplicates confirms same fingerprint with full checksum')
+        paths = [a, head, small, e1, tail, hole, a2, small2, other, e2, a]
+        rst = k3fs.find_duplicates(paths, samples=2, sample_size=K)
+        self.assertEqual([[a, a2], [small, small2], [e1, e2]], rst)
+
+        rst = k3fs.find_duplicates(iter(paths))
+        self.assertEqual([[a, a2], [small, small2], [e1, e2]], rst)
+
+        inexistent = os.path.join(dirname, 'inexistent')
+        self.assertRaises(OSError, k3fs.find_duplicates, [a, inexistent])
+
+        errs = []
+        rst = k3fs.find_duplicates([a, inexistent, a2],
+                                   onerror=lambda func, path, exc_info: errs.append((func, path)))
+        self.assertEqual([[a, a2]], rst)
+        self.assertEqual([(os.stat, inexistent)], errs)
+
+        k3fs.remove(dirname)
+
+    def test_checksum_cache(self):
+
+        dirname = '/tmp/pykit-ut-k3fs-checksum-cache'
+        k3fs.remove(dirname, onerror='ignore')
+        k3fs.makedirs(dirname)
+
+        fn = os.path.join(dirname, 'foo')
+        k3fs.fwrite(fn, 'foo')
+
+        db = os.path.join(dirname, 'cache.db')
+        cache = k3fs.ChecksumCache(db)
+
+        expected = k3fs.calc_checksums(fn, sha1=True, md5=True, sha256=True, io_limit=-1)
+
+        calls = {'n': 0}
+        update_read = k3fs.fs._update_read
+
+        def _counted(hashers, *args):
+            calls['n'] += 1
+            calls['hashers'] = len(hashers)
+            return update_read(hashers, *args)
+
+        k3fs.fs._update_read = _counted
+        try:
+            rst = k3fs.calc_checksums(fn, sha1=True, cache=cache, io_limit=-1)
+            self.assertEqual(expected['sha1'], rst['sha1'])
+            self.assertEqual(1, calls['n'])
+            self.assertEqual({'hit': 0, 'miss': 1, 'evicted': 0, 'entries': 1}, cache.stats())
+
+            dd('hit does not read')
+            rst = k3fs.calc_checksums(fn, sha1=True, cache=cache, io_limit=-1)
+            self.assertEqual(expected['sha1'], rst['sha1'])
+            self.assertIsNone(rst['md5'])
+            self.assertEqual(1, calls['n'])
+            self.assertEqual(1, cache.stats()['hit'])
+
+            dd('only missing algorithms are calculated')
+            rst = k3fs.calc_checksums(fn, sha1=True, md5=True, sha256=True, cache=cache, io_limit=-1)
+            self.assertEqual(expected, rst)
+            self.assertEqual(2, calls['n'])
+            self.assertEqual(2, calls['hashers'])
+            self.assertEqual(3, cache.stats()['entries'])
+
+            dd('persistent across instances')
+            cache.close()
+            cache = k3fs.ChecksumCache(db)
+            rst = k3fs.calc_checksums(fn, sha1=True, md5=True, sha256=True, cache=cache, io_limit=-1)
+            self.assertEqual(expected, rst)
+            self.assertEqual(2, calls['n'])
+            self.assertEqual({'hit': 1, 'miss': 0, 'evicted': 0, 'entries': 3}, cache.stats())
+
+            dd('ranges are not cached')
+            k3fs.calc_checksums(fn, sha1=True, offset=1, cache=cache, io_limit=-1)
+            self.assertEqual(3, calls['n'])
+
+            dd('changed file is calculated again')
+            k3fs.fwrite(fn, 'bar')
+            os.utime(fn, ns=(1, 1))
+            rst = k3fs.calc_checksums(fn, sha1=True, cache=cache, io_limit=-1)
+            self.assertEqual(k3fs.calc_checksums(fn, sha1=True, io_limit=-1)['sha1'], rst['sha1'])
+            self.assertEqual(1, cache.stats()['entries'])
+        finally:
+            k3fs.fs._update_read = update_read
+
+        dd('replacing a checksum does not count as a new entry')
+        st = os.stat(fn)
+        cache.put(st, {'sha1': 'x', 'md5': 'y'})
+        cache.put(st, {'sha1': 'x2'})
+        self.assertEqual(2, cache.stats()['entries'])
+        self.assertEqual({'sha1': 'x2', 'md5': 'y'}, cache.get(st, ['sha1', 'md5']))
+
+        dd('hits do not write')
+        changes = cache.conn.total_changes
+        for _ in range(10):
+            cache.get(st, ['sha1'])
+        self.assertEqual(changes, cache.conn.total_changes)
+        cache.close()
+
+        dd('least recently used are evicted')
+        cache = k3fs.ChecksumCache(db, max_entries=10)
+        cache.clear()
+        for i in range(20):
+            path = os.path.join(dirname, str(i))
+            k3fs.fwrite(path, str(i))
+            k3fs.calc_checksums(path, sha1=True, cache=cache, io_limit=-1)
+
+        st = cache.stats()
+        self.assertLessEqual(st['entries'], 10)
+        self.assertGreater(st['evicted'], 0)
+        self.assertEqual(20, st['miss'])
+
+        k3fs.calc_checksums(os.path.join(dirname, '19'), sha1=True, cache=cache, io_limit=-1)
+        self.assertEqual(1, cache.stats()['hit'])
+
+        cache.close()
+        self.assertRaises(k3fs.FSUtilError, k3fs.ChecksumCache, db, max_entries=0)
+
+        k3fs.remove(dirname)
+
+    def test_io_limiter(self):
+
+        M = 1024 ** 2
+
+        self.assertRaises(k3fs.FSUtilError, k3fs.IOLimiter, 0)
+        self.assertRaises(k3fs.FSUtilError, k3fs.IOLimiter, M, burst=0)
+
+        dd('burst is not throttled')
+        limiter = k3fs.IOLimiter(10 * M, burst=2 * M)
+        t0 = time.time()
+        self.assertEqual(0, limiter.consume(2 * M))
+        self.assertLess(time.time() - t0, 0.1)
+
+        dd('debt is paid back at rate')
+        slept = limiter.consume(M)
+        self.assertAlmostEqual(0.1, slept, delta=0.05)
+
+        dd('the wall clock going back does not drain the bucket')
+        limiter = k3fs.IOLimiter(10 * M, burst=2 * M)
+        wall_time = time.time
+        time.time = lambda: wall_time() - 3600
+        try:
+            self.assertEqual(0, limiter.consume(M))
+        finally:
+            time.time = wall_time
+
+        dd('limiter is shared by concurrent calc_checksums')
+        fns = ['/tmp/pykit-ut-fsutil-io-limiter-1', '/tmp/pykit-ut-fsutil-io-limiter-2']
+        for fn in fns:
+            force_remove(fn)
+            k3fs.fwrite(fn, '!' * M * 5)
+
+        limiter = k3fs.IOLimiter(10 * M, burst=M)
+        rst = []
+
+        def _calc(fn):
+            rst.append(k3fs.calc_checksums(fn, md5=True, block_size=M, io_limit=limiter))
+
+        t0 = time.time()
+        ths = [k3thread.daemon(_calc, args=(fn,)) for fn in fns]
+        for th in ths:
+            th.join()
+        spend_time = time.time() - t0
+
+        dd('spend_time:', spend_time)
+        # 10M in total, 1M burst at 10M/s
+        self.assertTrue(0.8 < spend_time < 1.5)
+        self.assertEqual(2, len(rst))
+        self.assertEqual(rst[0], rst[1])
+
+        for fn in fns:
+            force_remove(fn)
+
 
 def force_remove(fn):
     try: